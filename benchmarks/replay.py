@@ -0,0 +1,375 @@
+"""
+Module: replay
+
+Description:
+Load test of the bot without network: replays Telegram updates through the handlers
+registered by main.add_handlers, against a fake Bot that records all Bot API calls.
+
+Generated streams simulate complete sessions:
+
+    /start + registration button      for every user
+    /schuld conversation              creditor chooses debtor, category, amount, deadline
+    accept button                     debtor accepts the debt (button taken from the bot's message)
+    /ichSchulde + pay buttons         debtor reports payment, creditor confirms
+
+Recorded streams (JSON lines of updates, e.g. written with --record or captured from the
+webhook) are replayed as they are; --database seeds the database they refer to.
+
+Updates are processed one after another on the calling thread (dispatcher.process_update).
+Messages the handlers queue in the outbound queue are sent at once, so the recorded calls
+are complete when an update returns. The report shows updates per second and p50/p95/p99
+latency per handler.
+
+Usage (from the repository root):
+
+python benchmarks/replay.py --users 200 --debts 1000
+python benchmarks/replay.py --users 50 --debts 100 --record updates.jsonl
+python benchmarks/replay.py --replay updates.jsonl --database database.json --json
+"""
+
+import argparse
+import collections
+import contextlib
+import itertools
+import json
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+SRC = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+BOT_USER = {'id': 1, 'is_bot': True, 'first_name': 'Schuldbot', 'username': 'schuldestmirbot'}
+
+
+class FakeRequest:
+    """
+    Stands in for telegram.utils.request.Request: records Bot API calls and returns
+    plausible results instead of sending HTTP requests.
+    """
+
+    def __init__(self):
+        self.calls = collections.Counter()
+        # chat_id -> last message of the bot with an inline keyboard
+        self.inline_messages = {}
+        self._message_ids = itertools.count(1)
+
+    def post(self, url, data, timeout=None):
+        """Records a call, returns the "result" field of a Bot API response
+        """
+
+        method = url.rsplit('/', 1)[-1]
+        self.calls[method] += 1
+
+        if method == 'getMe':
+            return BOT_USER
+
+        if method in ('sendMessage', 'editMessageText'):
+            chat_id = int(data['chat_id'])
+            message = {'message_id': int(data.get('message_id') or next(self._message_ids)),
+                       'date': int(time.time()), 'from': BOT_USER,
+                       'chat': {'id': chat_id, 'type': 'private'}, 'text': data.get('text', '')}
+            markup = data.get('reply_markup')
+
+            if hasattr(markup, 'to_dict'):
+                markup = markup.to_dict()
+            elif isinstance(markup, str):
+                markup = json.loads(markup)
+
+            if markup and 'inline_keyboard' in markup:
+                message['reply_markup'] = markup
+                self.inline_messages[chat_id] = message
+
+            return message
+
+        return True
+
+    def stop(self):
+        """Nothing to close
+        """
+
+
+class DirectOutbox:
+    """
+    Replaces the outbound queue: sends at once on the calling thread.
+    """
+
+    def __init__(self, bot):
+        self.bot = bot
+
+    def send_message(self, chat_id, priority=0, **kwargs):  # pylint: disable=unused-argument
+        """See outbound.OutboundQueue.send_message
+        """
+        self.bot.send_message(chat_id, **kwargs)
+        return True
+
+
+class Session:
+    """
+    Builds update dictionaries the way Telegram would send them.
+    """
+
+    def __init__(self, request):
+        self.request = request
+        self._update_ids = itertools.count(1)
+        self._message_ids = itertools.count(1000000)
+
+    @staticmethod
+    def user(number):
+        chat_id = 100000000 + number
+        return {'id': chat_id, 'is_bot': False, 'first_name': f'User {number}', 'username': f'user{number}'}
+
+    def message(self, user, text):
+        """Returns a text message update, commands get a bot_command entity
+        """
+
+        message = {'message_id': next(self._message_ids), 'date': int(time.time()), 'from': user,
+                   'chat': {'id': user['id'], 'type': 'private', 'username': user['username'],
+                            'first_name': user['first_name']},
+                   'text': text}
+
+        if text.startswith('/'):
+            message['entities'] = [{'type': 'bot_command', 'offset': 0, 'length': len(text.split()[0])}]
+
+        return {'update_id': next(self._update_ids), 'message': message}
+
+    def press(self, user, button=0):
+        """Returns the update of pressing a button of the last inline keyboard the bot sent to a user,
+        None if there is none
+        """
+
+        message = self.request.inline_messages.pop(user['id'], None)
+
+        if message is None:
+            return None
+
+        buttons = [button for row in message['reply_markup']['inline_keyboard'] for button in row]
+
+        return {'update_id': next(self._update_ids),
+                'callback_query': {'id': str(next(self._update_ids)), 'from': user, 'chat_instance': '1',
+                                   'message': message, 'data': buttons[button]['callback_data']}}
+
+
+def generated_stream(session, users, debts, seed=0):
+    """Yields the updates of registrations, /schuld conversations, accepts and payments.
+    Inline buttons are taken from the messages the bot sent, so the stream is consumed
+    while it is replayed.
+
+    Arguments:
+        session {Session} -- Update builder
+        users {Integer} -- Number of users
+        debts {Integer} -- Number of debts
+        seed {Integer} -- Seed of the random generator
+    """
+
+    rng = random.Random(seed)
+    people = [session.user(number) for number in range(users)]
+
+    for person in people:
+        yield session.message(person, '/start')
+        yield session.press(person, 0)
+
+    for _ in range(debts):
+        creditor, debtor = rng.sample(people, 2)
+
+        for text in ('/schuld', '👤 ' + debtor['username'], rng.choice(['Essen 🍕', 'Getränke 🍻', 'Geld 💸']),
+                     rng.choice(['1€', '2€', '5€', '10€']), rng.choice(['Morgen', 'Eine Woche', 'Ein Monat'])):
+            yield session.message(creditor, text)
+
+        # accept
+        yield session.press(debtor, 0)
+
+        if rng.random() < 0.5:
+            # the debtor reports the payment (first debt in the list), the creditor confirms
+            yield session.message(debtor, '/ichSchulde')
+            yield session.press(debtor, 0)
+            yield session.press(debtor, 0)
+            yield session.press(creditor, 0)
+
+
+def recorded_stream(path):
+    """Yields the updates of a JSON lines file
+    """
+
+    with open(path) as updates_file:
+        for line in updates_file:
+            if line.strip():
+                yield json.loads(line)
+
+
+def update_kind(update_as_dict):
+    """Returns a short description of an update for the report
+    """
+
+    if 'callback_query' in update_as_dict:
+        return 'callback:' + update_as_dict['callback_query']['data'][:1]
+    text = update_as_dict.get('message', {}).get('text', '')
+    return text.split()[0] if text.startswith('/') else 'text'
+
+
+def _percentiles(latencies):
+    latencies = sorted(latencies)
+
+    def percentile(fraction):
+        return round(latencies[min(len(latencies) - 1, int(fraction * len(latencies)))] * 1000, 3)
+
+    return {'count': len(latencies), 'p50_ms': percentile(0.5), 'p95_ms': percentile(0.95),
+            'p99_ms': percentile(0.99)}
+
+
+def _time_handlers(handlers, latencies):
+    """Wraps the callbacks of handlers (and of nested conversation handlers) to record their latency
+    """
+
+    for handler in handlers:
+        nested = [getattr(handler, 'entry_points', []), getattr(handler, 'fallbacks', [])]
+        nested += list(getattr(handler, 'states', {}).values())
+
+        for handlers_list in nested:
+            _time_handlers(handlers_list, latencies)
+
+        callback = getattr(handler, 'callback', None)
+
+        if callback is None or getattr(callback, 'timed', False):
+            continue
+
+        def timed(update, context, callback=callback, name=callback.__name__):
+            start = time.perf_counter()
+            try:
+                return callback(update, context)
+            finally:
+                latencies[name].append(time.perf_counter() - start)
+
+        timed.timed = True
+        handler.callback = timed
+
+
+def replay(stream_factory, database=None, record=None):
+    """Imports the bot in a temporary directory and replays a stream of updates
+
+    Arguments:
+        stream_factory {Callable} -- Called with the Session and the FakeRequest, returns the updates
+        database {String} -- database.json to start from, default: empty database
+        record {String} -- Write the replayed updates to this JSON lines file
+
+    Returns:
+        Dictionary -- Report
+    """
+
+    directory = tempfile.mkdtemp(prefix='replay-')
+    previous_directory = os.getcwd()
+
+    if database is not None:
+        shutil.copy(database, os.path.join(directory, 'database.json'))
+
+    os.environ.setdefault('schuldestmirbot', '123456:replay')
+    os.environ.setdefault('ASYNC_MODE', '0')
+    sys.path.insert(0, SRC)
+    os.chdir(directory)
+
+    try:
+        import main  # pylint: disable=import-outside-toplevel
+        from telegram import Update  # pylint: disable=import-outside-toplevel
+
+        logging.getLogger().setLevel(logging.WARNING)
+
+        request = FakeRequest()
+        bot = main.UPDATER.bot
+        bot._request = request  # pylint: disable=protected-access
+        main.OUTBOX = DirectOutbox(bot)
+
+        dispatcher = main.UPDATER.dispatcher
+        main.add_handlers(dispatcher)
+
+        handler_latencies = collections.defaultdict(list)
+        for handlers in dispatcher.handlers.values():
+            _time_handlers(handlers, handler_latencies)
+
+        update_latencies = collections.defaultdict(list)
+        session = Session(request)
+        record_file = open(record, 'w') if record else None
+        count = 0
+
+        with open(os.devnull, 'w') as devnull, contextlib.redirect_stdout(devnull):
+            start = time.perf_counter()
+
+            for update_as_dict in stream_factory(session, request):
+                if update_as_dict is None:
+                    continue
+
+                if record_file is not None:
+                    record_file.write(json.dumps(update_as_dict) + '\n')
+
+                update_start = time.perf_counter()
+                dispatcher.process_update(Update.de_json(update_as_dict, bot))
+                update_latencies[update_kind(update_as_dict)].append(time.perf_counter() - update_start)
+                count += 1
+
+            elapsed = time.perf_counter() - start
+
+        if record_file is not None:
+            record_file.close()
+
+        main.DB.close()
+
+        return {'updates': count, 'seconds': round(elapsed, 3),
+                'updates_per_second': round(count / elapsed, 1) if elapsed else None,
+                'handlers': {name: _percentiles(values) for name, values in sorted(handler_latencies.items())},
+                'updates_by_kind': {kind: _percentiles(values) for kind, values in sorted(update_latencies.items())},
+                'bot_api_calls': dict(request.calls)}
+
+    finally:
+        os.chdir(previous_directory)
+        shutil.rmtree(directory, ignore_errors=True)
+
+
+def print_report(report):
+    """Prints a report as tables
+    """
+
+    print(f"{report['updates']} updates in {report['seconds']} s, {report['updates_per_second']} updates/s")
+
+    for title, rows in (('handler', report['handlers']), ('update', report['updates_by_kind'])):
+        print()
+        print(f'{title:<32} {"count":>7} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9}')
+        for name, row in rows.items():
+            print(f'{name:<32} {row["count"]:>7} {row["p50_ms"]:>9} {row["p95_ms"]:>9} {row["p99_ms"]:>9}')
+
+    print()
+    print('Bot API calls:', ', '.join(f'{method} {count}' for method, count in sorted(report['bot_api_calls'].items())))
+
+
+def main():
+    """Parses the command line and runs the replay
+    """
+
+    parser = argparse.ArgumentParser(description='Replay updates through the bot handlers')
+    parser.add_argument('--users', type=int, default=100, help='users of the generated stream')
+    parser.add_argument('--debts', type=int, default=500, help='debts of the generated stream')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--replay', help='JSON lines file of updates to replay instead of generating')
+    parser.add_argument('--database', help='database.json to start from')
+    parser.add_argument('--record', help='write the replayed updates to this JSON lines file')
+    parser.add_argument('--json', action='store_true', help='print the report as JSON')
+    arguments = parser.parse_args()
+
+    if arguments.replay:
+        def stream_factory(_session, _request):
+            return recorded_stream(arguments.replay)
+    else:
+        def stream_factory(session, _request):
+            return generated_stream(session, arguments.users, arguments.debts, arguments.seed)
+
+    report = replay(stream_factory, arguments.database, arguments.record)
+
+    if arguments.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == '__main__':
+    main()
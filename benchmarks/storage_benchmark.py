@@ -0,0 +1,255 @@
+"""
+Module: storage_benchmark
+
+Description:
+Micro-benchmarks of the storage backends on synthetic datasets.
+
+For every scale (number of debts, with a tenth as many users) a dataset is generated,
+written as database.json and loaded by every backend. The benchmark times init_json,
+update_json, add_debt, set_accepted and the lookups, and measures peak memory of the
+load (tracemalloc, Python allocations only) and the size of the database files.
+In snapshot mode ("json") every write rewrites the file, so only SNAPSHOT_WRITES
+writes are timed there.
+
+Results are written as JSON lines, one per backend, scale and operation, e.g.
+
+{"backend": "json", "scale": 10000, "operation": "get_open_debts", "ops": 1000,
+ "total_s": 0.0021, "mean_us": 2.1, "p50_us": 1.9, "p99_us": 4.0, "commit": "0372012", ...}
+
+Usage (from the repository root):
+
+python benchmarks/storage_benchmark.py --scales 1000,10000,100000 --output results.jsonl
+python benchmarks/storage_benchmark.py --scales 1000000 --backends sqlite --operations 10000
+"""
+
+import argparse
+import contextlib
+import datetime
+import gc
+import json
+import os
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import uuid
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from database import Database, SqliteDatabase  # noqa: E402  pylint: disable=wrong-import-position
+from debt import Debt  # noqa: E402  pylint: disable=wrong-import-position
+from user import User  # noqa: E402  pylint: disable=wrong-import-position
+
+CATEGORIES = ['Getränke 🍻', 'Essen 🍕', 'Mobilität 🚗', 'Gefallen 🧞', 'Haushalt 🏘', 'Geld 💸']
+
+# every write rewrites the whole file in snapshot mode, fewer calls keep large scales feasible
+SNAPSHOT_WRITES = 10
+
+BACKENDS = {
+    'json': lambda directory: Database(os.path.join(directory, 'database.json')),
+    'journal': lambda directory: Database(os.path.join(directory, 'database.json'), journal=True),
+    'group_commit': lambda directory: Database(os.path.join(directory, 'database.json'), journal=True,
+                                               commit_interval=0.01),
+    'sqlite': lambda directory: SqliteDatabase(os.path.join(directory, 'database.sqlite3')),
+}
+
+
+def generate_dataset(path_to_json, debts, seed=0):
+    """Writes a synthetic database.json
+
+    Arguments:
+        path_to_json {String} -- Output file
+        debts {Integer} -- Number of debts, a tenth as many users (at least 10)
+        seed {Integer} -- Seed of the random generator
+
+    Returns:
+        Tuple -- chat_ids and debt_ids of the dataset
+    """
+
+    rng = random.Random(seed)
+    users = [User(str(100000000 + number), f'user{number}') for number in range(max(10, debts // 10))]
+    chat_ids = [user.chat_id for user in users]
+    today = datetime.date.today()
+    debt_list = []
+
+    for _ in range(debts):
+        creditor, debtor = rng.sample(chat_ids, 2)
+        deadline = today + datetime.timedelta(days=rng.randint(-30, 90))
+        state = rng.random()
+        debt_list.append(Debt(str(uuid.uuid1(clock_seq=rng.getrandbits(14))), creditor,
+                              rng.choice(CATEGORIES), f'{rng.randint(1, 200)}.{rng.randint(0, 99):02d}€',
+                              deadline.strftime('%Y:%m:%d'), debtor,
+                              is_accepted=state < 0.7, is_paid=state < 0.2))
+
+    with open(path_to_json, 'w') as json_file:
+        json.dump({'users': [user.to_dict() for user in users],
+                   'debts': [debt.to_dict() for debt in debt_list]}, json_file)
+
+    return chat_ids, [debt.debt_id for debt in debt_list]
+
+
+def _percentile(sorted_values, fraction):
+    return sorted_values[min(len(sorted_values) - 1, int(fraction * len(sorted_values)))]
+
+
+def time_operation(function, arguments):
+    """Calls a function once per argument tuple and returns the latency statistics
+
+    Arguments:
+        function {Callable} -- Operation
+        arguments {list} -- Argument tuples
+
+    Returns:
+        Dictionary -- ops, total_s, mean_us, p50_us, p99_us
+    """
+
+    latencies = []
+
+    for args in arguments:
+        start = time.perf_counter()
+        function(*args)
+        latencies.append(time.perf_counter() - start)
+
+    latencies.sort()
+    total = sum(latencies)
+
+    return {'ops': len(latencies), 'total_s': round(total, 6),
+            'mean_us': round(total / len(latencies) * 1e6, 3),
+            'p50_us': round(_percentile(latencies, 0.5) * 1e6, 3),
+            'p99_us': round(_percentile(latencies, 0.99) * 1e6, 3)}
+
+
+def _files_size(directory):
+    return sum(os.path.getsize(os.path.join(directory, name)) for name in os.listdir(directory)
+               if os.path.isfile(os.path.join(directory, name)))
+
+
+def _load(backend, directory):
+    database = BACKENDS[backend](directory)
+    database.init_json()
+    if backend == 'sqlite':
+        database.migrate_json(os.path.join(directory, 'database.json'))
+    return database
+
+
+def benchmark(backend, scale, operations, seed=0):
+    """Runs all operations of one backend on one dataset
+
+    Arguments:
+        backend {String} -- Key of BACKENDS
+        scale {Integer} -- Number of debts
+        operations {Integer} -- Calls per timed operation
+        seed {Integer} -- Seed of dataset and workload
+
+    Returns:
+        list -- Result dictionaries
+    """
+
+    directory = tempfile.mkdtemp(prefix='storage-benchmark-')
+    results = []
+
+    def result(operation, **values):
+        results.append(dict({'backend': backend, 'scale': scale, 'operation': operation}, **values))
+
+    try:
+        chat_ids, debt_ids = generate_dataset(os.path.join(directory, 'database.json'), scale, seed)
+        rng = random.Random(seed + 1)
+
+        if backend == 'sqlite':
+            # import into SQLite once, the load below measures opening the existing file
+            start = time.perf_counter()
+            _load(backend, directory).close()
+            result('migrate_json', ops=1, total_s=round(time.perf_counter() - start, 6))
+
+        gc.collect()
+        start = time.perf_counter()
+        database = _load(backend, directory)
+        result('init_json', ops=1, total_s=round(time.perf_counter() - start, 6))
+        database.close()
+
+        gc.collect()
+        tracemalloc.start()
+        database = _load(backend, directory)
+        retained, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        result('memory', retained_bytes=retained, peak_bytes=peak)
+        result('file_size', bytes=_files_size(directory))
+
+        snapshot_writes = max(1, min(operations, SNAPSHOT_WRITES))
+        writes = snapshot_writes if backend == 'json' else operations
+
+        if isinstance(database, Database):
+            result('update_json', **time_operation(database.update_json, [()] * snapshot_writes))
+
+        lookups = [(rng.choice(chat_ids),) for _ in range(operations)]
+        debt_lookups = [(rng.choice(debt_ids),) for _ in range(operations)]
+
+        result('get_user_by_chat_id', **time_operation(database.get_user_by_chat_id, lookups))
+        result('get_open_debts', **time_operation(database.get_open_debts, lookups))
+        result('get_open_claims', **time_operation(database.get_open_claims, lookups))
+        result('get_debt_by_debt_id', **time_operation(database.get_debt_by_debt_id, debt_lookups))
+
+        new_debts = [tuple([creditor, rng.choice(CATEGORIES), '5.00€', '2030:01:01', debtor])
+                     for creditor, debtor in (rng.sample(chat_ids, 2) for _ in range(writes))]
+
+        result('add_debt', **time_operation(database.add_debt, new_debts))
+
+        result('set_accepted', **time_operation(database.set_accepted,
+                                                [(debt_id, True) for (debt_id,) in debt_lookups[:writes]]))
+
+        start = time.perf_counter()
+        database.wait_durable()
+        result('wait_durable', ops=1, total_s=round(time.perf_counter() - start, 6))
+
+        database.close()
+        result('file_size_after_writes', bytes=_files_size(directory))
+
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    return results
+
+
+def environment():
+    """Returns the fields identifying the code version and machine of a run
+    """
+
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__)), check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+
+    return {'commit': commit, 'python': platform.python_version(), 'machine': platform.machine(),
+            'timestamp': datetime.datetime.now().isoformat(timespec='seconds')}
+
+
+def main():
+    """Parses the command line and writes the results
+    """
+
+    parser = argparse.ArgumentParser(description='Storage micro-benchmarks')
+    parser.add_argument('--scales', default='1000,10000,100000',
+                        help='comma separated numbers of debts, e.g. 1000,10000,100000,1000000')
+    parser.add_argument('--backends', default=','.join(BACKENDS), help='comma separated backends')
+    parser.add_argument('--operations', type=int, default=1000, help='calls per timed operation')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', help='JSON lines file (appended), default: stdout')
+    arguments = parser.parse_args()
+
+    run = environment()
+
+    with (open(arguments.output, 'a') if arguments.output else contextlib.nullcontext(sys.stdout)) as output:
+        for scale in (int(scale) for scale in arguments.scales.split(',')):
+            for backend in arguments.backends.split(','):
+                for result in benchmark(backend, scale, arguments.operations, arguments.seed):
+                    output.write(json.dumps(dict(result, **run)) + '\n')
+                    output.flush()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,177 @@
+"""
+Module: archive
+
+Description:
+Cold storage for settled (paid or declined) debts.
+
+Debts are appended as JSON lines to gzip files, one file per month of settlement:
+
+    <path_to_archive>/2026-10.jsonl.gz
+
+Every add appends one gzip member. The partition is copied (still compressed) together
+with the new member to a temporary file that replaces it, so a crash never leaves a torn
+partition. Reading stops at an incomplete member, should a file end with one anyway.
+Lookups by debt_id are done on demand: debt ids are time based (uuid1), so only the
+partitions from the month the debt was created on have to be searched.
+"""
+
+import datetime
+import gzip
+import json
+import os
+import uuid
+import zlib
+
+from debt import Debt
+
+# uuid1 timestamps count 100ns intervals since 1582-10-15
+_UUID_EPOCH = datetime.datetime(1582, 10, 15)
+
+
+def _partition_of(ordinal):
+    date = datetime.date.fromordinal(ordinal)
+    return f'{date.year:04d}-{date.month:02d}'
+
+
+def _created_partition(debt_id):
+    """Returns the partition of the month a debt was created in, None if the id isn't a uuid1
+    """
+
+    try:
+        debt_uuid = uuid.UUID(debt_id)
+    except ValueError:
+        return None
+
+    if debt_uuid.version != 1:
+        return None
+
+    created = _UUID_EPOCH + datetime.timedelta(microseconds=debt_uuid.time // 10)
+    # one day of slack, the uuid time is UTC while settlement dates are local
+    return _partition_of(created.date().toordinal() - 1)
+
+
+def _members(data):
+    """Yields the complete gzip members of a partition file
+
+    Arguments:
+        data {bytes} -- Content of the file
+
+    Yields:
+        tuple -- End offset and decompressed content of the member
+    """
+
+    view = memoryview(data)
+    offset = 0
+
+    while offset < len(data):
+        decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+        try:
+            content = decompressor.decompress(view[offset:])
+        except zlib.error:
+            return
+
+        if not decompressor.eof:
+            return
+
+        offset = len(data) - len(decompressor.unused_data)
+        yield offset, content
+
+
+def _read(path):
+    try:
+        with open(path, 'rb') as archive_file:
+            return archive_file.read()
+    except FileNotFoundError:
+        return b''
+
+
+class Archive:
+    """
+    The archive class stores settled debts in compressed, date partitioned files
+    and finds them again by debt_id.
+    """
+
+    SUFFIX = '.jsonl.gz'
+
+    def __init__(self, path_to_archive):
+        self.path_to_archive = path_to_archive
+
+    def partitions(self):
+        """Returns the names of all partitions in chronological order.
+
+        Returns:
+            list -- Partition names, e.g. "2026-10"
+        """
+
+        try:
+            names = os.listdir(self.path_to_archive)
+        except FileNotFoundError:
+            return []
+
+        return sorted(name[:-len(self.SUFFIX)] for name in names if name.endswith(self.SUFFIX))
+
+    def add(self, debts):
+        """Appends settled debts to the partition of their settlement month.
+        The data is synced to disk before the method returns.
+
+        Arguments:
+            debts {list} -- debt.Debt objects with settled_on set
+        """
+
+        by_partition = {}
+
+        for debt in debts:
+            by_partition.setdefault(_partition_of(debt.settled_on), []).append(debt)
+
+        os.makedirs(self.path_to_archive, exist_ok=True)
+
+        for partition, partition_debts in by_partition.items():
+
+            path = os.path.join(self.path_to_archive, partition + self.SUFFIX)
+            lines = ''.join(json.dumps(debt.to_dict()) + '\n' for debt in partition_debts)
+
+            data = _read(path)
+            complete = 0
+            for complete, _ in _members(data):
+                pass
+
+            with open(path + '.tmp', 'wb') as archive_file:
+                archive_file.write(data[:complete])
+                archive_file.write(gzip.compress(lines.encode('utf-8')))
+                archive_file.flush()
+                os.fsync(archive_file.fileno())
+
+            os.replace(path + '.tmp', path)
+
+    def find(self, debt_id):
+        """Searches the archive for a debt.
+
+        Arguments:
+            debt_id {String} -- ID of a debt
+
+        Returns:
+            debt.Debt -- Archived debt, None if it isn't archived
+        """
+
+        first_partition = _created_partition(debt_id)
+
+        for partition in self.partitions():
+
+            if first_partition is not None and partition < first_partition:
+                continue
+
+            path = os.path.join(self.path_to_archive, partition + self.SUFFIX)
+            needle = debt_id.encode('utf-8')
+
+            for _, content in _members(_read(path)):
+                # cheap substring test before parsing the lines
+                if needle not in content:
+                    continue
+                for line in content.splitlines():
+                    if needle in line:
+                        debt_as_dict = json.loads(line)
+                        if debt_as_dict['debt_id'] == debt_id:
+                            return Debt.from_dict(debt_as_dict)
+
+        return None
@@ -0,0 +1,113 @@
+"""
+Module: async_database
+
+Description:
+Async interface for Database and SqliteDatabase.
+
+Calls run on threads, so disk work never blocks the event loop. Writes run one after
+another on a single writer thread, in the order they were made. Reads run concurrently on
+a pool of reader threads (both database classes allow reads during writes), and a read
+always sees the writes that were awaited before it.
+
+Usage:
+
+database = AsyncDatabase(Database(path_to_json))
+debt = await database.add_debt(creditor, category, amount, deadline, debtor)
+"""
+
+import asyncio
+import functools
+from concurrent.futures import ThreadPoolExecutor
+
+
+class AsyncDatabase:
+    """
+    The AsyncDatabase class exposes the methods of a database as coroutines.
+    """
+
+    def __init__(self, database, readers=8):
+        self.database = database
+        self._writer = ThreadPoolExecutor(1, thread_name_prefix='async-database-writer')
+        self._readers = ThreadPoolExecutor(readers, thread_name_prefix='async-database-reader')
+
+    async def _read(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._readers, functools.partial(function, *args))
+
+    async def _write(self, function, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self._writer, functools.partial(function, *args))
+
+    def close(self):
+        """Waits for running calls and stops the threads
+        """
+
+        self._writer.shutdown(wait=True)
+        self._readers.shutdown(wait=True)
+
+    async def user_exists(self, chat_id):
+        """See Database.user_exists
+        """
+        return await self._read(self.database.user_exists, chat_id)
+
+    async def add_user(self, chat_id, name):
+        """See Database.add_user
+        """
+        return await self._write(self.database.add_user, chat_id, name)
+
+    async def add_debt(self, creditor, category, amount, deadline, debtor):
+        """See Database.add_debt
+        """
+        return await self._write(self.database.add_debt, creditor, category, amount, deadline, debtor)
+
+    async def get_open_debts(self, chat_id):
+        """See Database.get_open_debts
+        """
+        return await self._read(self.database.get_open_debts, chat_id)
+
+    async def get_open_claims(self, chat_id):
+        """See Database.get_open_claims
+        """
+        return await self._read(self.database.get_open_claims, chat_id)
+
+    async def get_debt_by_debt_id(self, debt_id):
+        """See Database.get_debt_by_debt_id
+        """
+        return await self._read(self.database.get_debt_by_debt_id, debt_id)
+
+    async def get_user_by_chat_id(self, chat_id):
+        """See Database.get_user_by_chat_id
+        """
+        return await self._read(self.database.get_user_by_chat_id, chat_id)
+
+    async def get_user_by_name(self, name):
+        """See Database.get_user_by_name
+        """
+        return await self._read(self.database.get_user_by_name, name)
+
+    async def get_contacts(self, chat_id, limit=8):
+        """See Database.get_contacts
+        """
+        return await self._read(self.database.get_contacts, chat_id, limit)
+
+    async def set_accepted(self, debt_id, is_accepted):
+        """See Database.set_accepted
+        """
+        return await self._write(self.database.set_accepted, debt_id, is_accepted)
+
+    async def set_paid(self, debt_id, is_paid):
+        """See Database.set_paid
+        """
+        return await self._write(self.database.set_paid, debt_id, is_paid)
+
+    async def wait_durable(self, timeout=None):
+        """See Database.wait_durable
+        """
+        # not on the writer thread, waiting there would hold back the following writes
+        return await asyncio.get_running_loop().run_in_executor(
+            None, self.database.wait_durable, timeout)
+
+    async def archive_settled(self, retention_days):
+        """See Database.archive_settled
+        """
+        return await self._write(self.database.archive_settled, retention_days)
@@ -0,0 +1,116 @@
+"""
+Module: async_runtime
+
+Description:
+Runs an asyncio event loop on a background thread, next to the Dispatcher of
+python-telegram-bot (which calls handlers synchronously on its worker threads).
+
+Coroutine handlers are handed to the loop with submit() and the worker thread returns
+immediately. Blocking calls (Bot API requests, file I/O) are awaited with run_blocking(),
+which runs them on an I/O thread pool, so many of them can be in flight concurrently.
+
+Usage:
+
+runtime = AsyncRuntime()
+runtime.start()
+runtime.submit(coroutine)
+...
+runtime.stop()      # waits for the submitted coroutines
+"""
+
+import asyncio
+import concurrent.futures
+import functools
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+LOGGER = logging.getLogger(__name__)
+
+
+class AsyncRuntime:
+    """
+    The async runtime owns the event loop thread and the I/O thread pool.
+    """
+
+    def __init__(self, io_workers=32):
+        self.loop = asyncio.new_event_loop()
+        self._io_executor = ThreadPoolExecutor(io_workers, thread_name_prefix='async-io')
+        self._thread = threading.Thread(target=self._run, name='async-runtime', daemon=True)
+        # futures of submitted coroutines that haven't finished
+        self._pending = set()
+        self._pending_lock = threading.Lock()
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def start(self):
+        """Starts the event loop thread
+        """
+
+        self._thread.start()
+
+    def stop(self, timeout=10):
+        """Waits for the submitted coroutines, then stops the event loop and waits for
+        running I/O calls. Coroutines still running after timeout seconds are cancelled.
+
+        Arguments:
+            timeout {Float} -- Seconds to wait for the coroutines
+        """
+
+        with self._pending_lock:
+            pending = set(self._pending)
+
+        _, not_done = concurrent.futures.wait(pending, timeout)
+
+        for future in not_done:
+            future.cancel()
+
+        if not_done:
+            LOGGER.warning('%d coroutines cancelled at shutdown', len(not_done))
+            concurrent.futures.wait(not_done, 1)
+
+        self.loop.call_soon_threadsafe(self.loop.stop)
+        self._thread.join()
+        self._io_executor.shutdown(wait=True)
+
+    def submit(self, coroutine):
+        """Schedules a coroutine on the event loop. Can be called from any thread.
+        Exceptions of the coroutine are logged.
+
+        Arguments:
+            coroutine {Coroutine} -- Coroutine to run
+
+        Returns:
+            concurrent.futures.Future -- Future of the result
+        """
+
+        future = asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+        with self._pending_lock:
+            self._pending.add(future)
+
+        future.add_done_callback(self._done)
+
+        return future
+
+    def _done(self, future):
+        with self._pending_lock:
+            self._pending.discard(future)
+
+        if not future.cancelled() and future.exception() is not None:
+            LOGGER.error('Coroutine failed', exc_info=future.exception())
+
+    async def run_blocking(self, function, *args, **kwargs):
+        """Runs a blocking function on the I/O thread pool and awaits its result.
+
+        Arguments:
+            function {Callable} -- Blocking function, e.g. bot.send_message
+
+        Returns:
+            Result of the function
+        """
+
+        return await self.loop.run_in_executor(
+            self._io_executor, functools.partial(function, *args, **kwargs))
@@ -0,0 +1,122 @@
+"""
+Module: callback_data
+
+Description:
+Compact encoding of the callback data of inline buttons (Telegram allows 64 bytes).
+
+A callback is an action code, an optional yes/no flag and an optional debt handle:
+
+    <action><flag><handle>          e.g. "a1" + 22 characters
+
+The handle is the 16 bytes of the debt's UUID in base64url without padding (22 instead
+of 36 characters), so it needs no lookup table. Ids that are not UUIDs are kept as they
+are behind "~". Buttons sent before this format (JSON payloads, raw debt ids) are still
+decoded. Malformed callback data raises ValueError.
+
+Usage:
+
+data = encode(ACCEPT_DEBT, True, debt_id)
+action, flag, debt_id = decode(data)
+"""
+
+import base64
+import binascii
+import json
+import re
+import uuid
+
+# action codes
+REGISTRATION = 'r'      # register yes/no
+SELECT_DEBT = 's'       # debt or claim chosen from a list
+ASK_PAID = 'q'          # "has it been paid?" inside /ichSchulde and /ichBekomme
+CONFIRM_PAID = 'p'      # creditor confirms that the debtor paid
+ACCEPT_DEBT = 'a'       # debtor accepts a new debt
+
+_FLAGS = {True: '1', False: '0', None: '-'}
+_FLAG_VALUES = {'1': True, '0': False, '-': None}
+
+# keys of the JSON payloads of old buttons
+_LEGACY_KEYS = (('action', REGISTRATION), ('p', CONFIRM_PAID), ('1', ACCEPT_DEBT), ('paid', ASK_PAID))
+
+_LEGACY_PATTERNS = {
+    REGISTRATION: r'\{"action"',
+    SELECT_DEBT: r'[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$',
+    ASK_PAID: r'\{"paid"',
+    CONFIRM_PAID: r'\{"p"',
+    ACCEPT_DEBT: r'\{"1"',
+}
+
+
+def _handle(debt_id):
+    try:
+        return base64.urlsafe_b64encode(uuid.UUID(debt_id).bytes).decode('ascii').rstrip('=')
+    except ValueError:
+        return '~' + debt_id
+
+
+def _debt_id(handle):
+    if not handle:
+        return None
+    if handle[0] == '~':
+        return handle[1:]
+    return str(uuid.UUID(bytes=base64.urlsafe_b64decode(handle + '==')))
+
+
+def encode(action, flag=None, debt_id=None):
+    """Encodes a callback
+
+    Arguments:
+        action {String} -- Action code, e.g. ACCEPT_DEBT
+        flag {Boolean} -- Yes/no answer, None if the button has none
+        debt_id {String} -- ID of a debt, None if the button refers to none
+
+    Returns:
+        String -- callback_data of the button
+    """
+
+    return action + _FLAGS[flag] + ('' if debt_id is None else _handle(debt_id))
+
+
+def decode(data):
+    """Decodes the callback data of a button
+
+    Arguments:
+        data {String} -- callback_data
+
+    Returns:
+        Tuple -- action code, flag and debt_id (None where missing)
+
+    Raises:
+        ValueError -- data is not a callback of this bot
+    """
+
+    try:
+        if data[:1] == '{':
+            payload = json.loads(data)
+            for key, action in _LEGACY_KEYS:
+                if key in payload:
+                    flag = payload['data'] if action == REGISTRATION else payload[key]
+                    return action, flag, payload.get('id')
+            return None, None, None
+
+        if len(data) == 36 and data[8:9] == '-':
+            return SELECT_DEBT, None, data
+
+        return data[0], _FLAG_VALUES[data[1]], _debt_id(data[2:])
+
+    except (IndexError, KeyError, TypeError, AttributeError, binascii.Error, ValueError) as decode_error:
+        raise ValueError(f'Malformed callback data {data!r}') from decode_error
+
+
+def pattern(action):
+    """Returns a regular expression matching the callbacks of an action (also of old buttons),
+    for CallbackQueryHandler(pattern=...)
+
+    Arguments:
+        action {String} -- Action code
+
+    Returns:
+        re.Pattern -- Pattern
+    """
+
+    return re.compile(f'^(?:{re.escape(action)}[01-]|{_LEGACY_PATTERNS[action]})')
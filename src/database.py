@@ -12,6 +12,45 @@ Usage:
 
 2. Initialize data:                        database.init_json()
 
+Journal mode:                              database = Database(path_to_json, journal=True)
+
+    Every mutation is appended as one JSON line to "<path_to_json>.journal" instead of
+    rewriting the whole JSON file. After compact_after records the journal is folded
+    into the JSON file (snapshot). init_json replays snapshot + journal.
+
+SQLite backend:                            database = SqliteDatabase(path_to_db)
+                                           database.init_json()
+                                           database.migrate_json(path_to_json)
+
+    Same interface as Database, backed by indexed SQLite tables (WAL mode).
+    migrate_json imports an existing JSON database once, while the SQLite file is empty.
+
+Archive:                                   database = Database(path_to_json, path_to_archive=path)
+                                           database.archive_settled(retention_days)
+
+    Moves debts that were paid or declined at least retention_days ago into the
+    compressed archive (see module archive). get_debt_by_debt_id still finds them.
+
+Concurrency:
+
+    Both classes can be shared by the dispatcher worker threads. Reads don't take locks.
+    Mutations of the same user/debt are serialized by striped record locks, the in-memory
+    indexes are changed under a short index lock and all file writes go through one writer lock.
+
+Group commit:                              database = Database(path_to_json, commit_interval=0.05)
+
+    Mutations are applied in memory at once, but made durable by a background thread that
+    writes all mutations of commit_interval seconds (or commit_batch mutations) with one sync.
+    wait_durable() blocks until all mutations made so far are on disk.
+    SqliteDatabase takes the same arguments (synced by a completed WAL checkpoint per batch).
+
+Sharding:                                  database.on_record = publish
+                                           database.apply_record(record)
+
+    on_record is called with the mutation record (see Database._persist) of every local
+    add_user, add_debt, set_accepted and set_paid, so it can be sent to other shards.
+    apply_record applies and persists a record received from another shard.
+
 General (Access all debt and user objects):      users = database.users / debts = database.debts
 
 
@@ -29,10 +68,125 @@ Team 6:      set_paid(self, debt_id, is_paid)
 
 """
 
+import datetime
+import heapq
 import json
+import logging
+import os
+import sqlite3
+import threading
+import time
 import uuid
 from user import User
-from debt import Debt
+from debt import Debt, DEADLINE_FORMAT
+from archive import Archive
+
+LOGGER = logging.getLogger(__name__)
+
+
+class GroupCommitter:
+    """
+    The GroupCommitter collects mutations of many threads and passes them
+    to a flush function in batches, from one background thread.
+
+    """
+
+    def __init__(self, flush_function, commit_interval, commit_batch):
+
+        self.flush_function = flush_function
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self._pending = []
+        self._last_seq = 0
+        self._durable_seq = 0
+        self._error = None
+        self._closing = False
+        self._condition = threading.Condition()
+        self._thread = threading.Thread(target=self._run, name='group-commit', daemon=True)
+        self._thread.start()
+
+    def add(self, item):
+        """Queues a mutation for the next flush
+
+        Arguments:
+            item -- Mutation, passed to the flush function
+
+        Returns:
+            Integer -- Sequence number of the mutation
+        """
+
+        with self._condition:
+            self._pending.append(item)
+            self._last_seq += 1
+            self._condition.notify_all()
+            return self._last_seq
+
+    def wait(self, seq=None, timeout=None):
+        """Blocks until a mutation is durable
+
+        Arguments:
+            seq {Integer} -- Sequence number, default: all mutations queued so far
+            timeout {Float} -- Seconds to wait at most
+
+        Returns:
+            Boolean -- Mutation is durable
+        """
+
+        with self._condition:
+            seq = self._last_seq if seq is None else seq
+            durable = self._condition.wait_for(
+                lambda: self._durable_seq >= seq or self._error is not None, timeout)
+
+            if self._durable_seq < seq and self._error is not None:
+                raise self._error
+
+            return durable
+
+    def close(self):
+        """Flushes pending mutations and stops the background thread
+        """
+
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+
+        self._thread.join()
+
+    def _run(self):
+
+        while True:
+
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closing)
+                # give other threads commit_interval to join the batch
+                self._condition.wait_for(
+                    lambda: len(self._pending) >= self.commit_batch or self._closing,
+                    self.commit_interval)
+
+                if not self._pending and self._closing:
+                    return
+
+                batch, self._pending = self._pending, []
+                seq = self._last_seq
+
+            try:
+                self.flush_function(batch)
+            except OSError as flush_error:
+                with self._condition:
+                    # keep the batch, it is retried with the next flush
+                    self._pending[:0] = batch
+                    self._error = flush_error
+                    self._condition.notify_all()
+                    if self._closing:
+                        return
+                # don't spin on a persistent disk error
+                time.sleep(max(self.commit_interval, 0.1))
+                continue
+
+            with self._condition:
+                self._durable_seq = seq
+                self._error = None
+                self._condition.notify_all()
 
 
 class Database:
@@ -42,14 +196,136 @@ class Database:
 
     """
 
-    def __init__(self, path_to_json):
+    RECORD_LOCK_STRIPES = 64
+
+    def __init__(self, path_to_json, journal=False, compact_after=1000, path_to_archive=None,
+                 commit_interval=None, commit_batch=100):
 
         self.path_to_json = path_to_json
+        self.path_to_journal = path_to_json + '.journal'
+        self.journal = journal
+        self.compact_after = compact_after
+        self._journal_records = 0
+        self.archive = Archive(path_to_archive) if path_to_archive else None
         self.users = []
         self.debts = []
 
+        # hash indexes, kept in sync with the lists above
+        self._users_by_chat_id = {}
+        self._users_by_name = {}
+        self._debts_by_id = {}
+
+        # open (accepted, unpaid) debts per user: chat_id -> {debt_id: Debt}
+        self._open_debts_by_debtor = {}
+        self._open_claims_by_creditor = {}
+
+        # contact graph: chat_id -> {chat_id: [number of debts, sequence number of the last debt]}
+        self._contacts = {}
+        self._contact_seq = 0
+
+        # lock order: record lock -> write lock -> index lock (the index lock is held only briefly)
+        self._record_locks = [threading.Lock() for _ in range(self.RECORD_LOCK_STRIPES)]
+        self._index_lock = threading.Lock()
+        self._write_lock = threading.RLock()
+
+        self._committer = None
+        if commit_interval is not None:
+            self._committer = GroupCommitter(self._write_records, commit_interval, commit_batch)
+
+        # called with the records of local mutations (sharding)
+        self.on_record = None
+        # bytes written to the journal and JSON file (metrics)
+        self.bytes_written = 0
+
+    def _record_lock(self, key):
+        """Returns the lock stripe of a user or debt
+
+        Arguments:
+            key {String} -- Chat_ID or debt_id
+
+        Returns:
+            threading.Lock -- Lock that serializes mutations of the record
+        """
+
+        return self._record_locks[hash(key) % self.RECORD_LOCK_STRIPES]
+
+    def _build_indexes(self):
+        """Rebuilds all lookup indexes from the current lists of users and debts.
+        """
+
+        self._users_by_chat_id = {}
+        self._users_by_name = {}
+        self._debts_by_id = {}
+        self._open_debts_by_debtor = {}
+        self._open_claims_by_creditor = {}
+        self._contacts = {}
+        self._contact_seq = 0
+
+        for user in self.users:
+            self._index_user(user)
+
+        for debt in self.debts:
+            self._index_debt(debt)
+
+    def _index_user(self, user):
+        """Adds a user to the lookup indexes
+
+        Arguments:
+            user {user.User} -- User object
+        """
+
+        self._users_by_chat_id[user.chat_id] = user
+        # names should be unique, otherwise the first registration wins
+        self._users_by_name.setdefault(user.name, user)
+
+    def _index_debt(self, debt):
+        """Adds a debt to the lookup indexes
+
+        Arguments:
+            debt {debt.Debt} -- Debt object
+        """
+
+        self._debts_by_id[debt.debt_id] = debt
+        self._update_open_views(debt)
+
+        self._contact_seq += 1
+        for user, other in ((debt.creditor, debt.debtor), (debt.debtor, debt.creditor)):
+            weight = self._contacts.setdefault(user, {}).setdefault(other, [0, 0])
+            weight[0] += 1
+            weight[1] = self._contact_seq
+
+    def _update_open_views(self, debt):
+        """Adds a debt to or removes it from the open debts/claims views, depending on its status
+
+        Arguments:
+            debt {debt.Debt} -- Debt object
+        """
+
+        if debt.is_accepted and not debt.is_paid:
+            self._open_debts_by_debtor.setdefault(debt.debtor, {})[debt.debt_id] = debt
+            self._open_claims_by_creditor.setdefault(debt.creditor, {})[debt.debt_id] = debt
+        else:
+            self._open_debts_by_debtor.get(debt.debtor, {}).pop(debt.debt_id, None)
+            self._open_claims_by_creditor.get(debt.creditor, {}).pop(debt.debt_id, None)
+
+    def _unindex_debts(self, debt_ids):
+        """Removes debts from the list of debts and all lookup indexes
+
+        Arguments:
+            debt_ids {set} -- IDs of the debts to remove
+        """
+
+        debts = [self._debts_by_id.pop(debt_id) for debt_id in debt_ids if debt_id in self._debts_by_id]
+
+        for debt in debts:
+            self._open_debts_by_debtor.get(debt.debtor, {}).pop(debt.debt_id, None)
+            self._open_claims_by_creditor.get(debt.creditor, {}).pop(debt.debt_id, None)
+
+        self.debts = [debt for debt in self.debts if debt.debt_id not in debt_ids]
+
     def init_json(self):
         """Loads data from JSON file and initializes list of users and debts.
+        Pending journal records are replayed on top of the snapshot.
         """
 
         try:
@@ -70,32 +346,248 @@ class Database:
                           for user in json_database['users']]
             self.debts = [Debt.from_dict(debt)
                           for debt in json_database['debts']]
+            self._build_indexes()
 
         except FileNotFoundError:
             self.update_json()
 
+        if self._replay_journal():
+            self.compact()
+
     def update_json(self):
-        """Saves current users and debts to the JSON file
+        """Saves current users and debts to the JSON file.
+        The file is replaced atomically, so a crash never leaves a torn snapshot.
         """
 
-        users_as_dict = [User.to_dict(user) for user in self.users]
-        debts_as_dict = [Debt.to_dict(debt) for debt in self.debts]
+        with self._write_lock:
+
+            with self._index_lock:
+                users_as_dict = [User.to_dict(user) for user in self.users]
+                debts_as_dict = [Debt.to_dict(debt) for debt in self.debts]
+
+            default_json = {
+                'users': users_as_dict,
+                'debts': debts_as_dict
+            }
+
+            path_to_tmp = self.path_to_json + '.tmp'
 
-        default_json = {
-            'users': users_as_dict,
-            'debts': debts_as_dict
-        }
+            try:
+
+                with open(path_to_tmp, 'w') as json_database:
+
+                    data = json.dumps(default_json)
+                    json_database.write(data)
+                    json_database.flush()
+                    os.fsync(json_database.fileno())
+
+                os.replace(path_to_tmp, self.path_to_json)
+                self.bytes_written += len(data)
+
+            except FileNotFoundError:
+
+                pass
+
+    def compact(self):
+        """Folds the journal into the JSON snapshot and truncates the journal
+        """
+
+        with self._write_lock:
+
+            self.update_json()
+
+            with open(self.path_to_journal, 'w'):
+                pass
+
+            self._journal_records = 0
+
+    def _replay_journal(self):
+        """Applies all records of the journal file to the in-memory data.
+        A torn last line (crash during append) is cut off, so later appends
+        start on a line of their own.
+
+        Returns:
+            Integer -- Number of replayed records
+        """
+
+        replayed = 0
 
         try:
 
-            with open(self.path_to_json, 'w') as json_database:
+            with open(self.path_to_journal, 'rb+') as journal:
 
-                json_database.write(json.dumps(default_json))
+                good_offset = 0
 
-        except FileNotFoundError:
+                for line in journal:
 
+                    # a record without its newline was never synced completely
+                    if not line.endswith(b'\n'):
+                        break
+
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        break
+
+                    self._apply(record)
+                    replayed += 1
+                    good_offset += len(line)
+
+                if good_offset < journal.seek(0, os.SEEK_END):
+                    journal.truncate(good_offset)
+                    journal.flush()
+                    os.fsync(journal.fileno())
+
+        except FileNotFoundError:
             pass
 
+        self._journal_records = replayed
+
+        return replayed
+
+    def _apply(self, record):
+        """Applies a mutation record to the in-memory data.
+        Applying the same record twice has no further effect.
+
+        Arguments:
+            record {Dictionary} -- Mutation record, see _persist
+
+        Returns:
+            user.User / debt.Debt -- Affected object, None if the debt is unknown
+        """
+
+        operation = record['op']
+
+        if operation == 'add_user':
+            user = self._users_by_chat_id.get(record['user']['chat_id'])
+            if user is None:
+                user = User.from_dict(record['user'])
+                self.users.append(user)
+                self._index_user(user)
+            return user
+
+        if operation == 'add_debt':
+            debt = self._debts_by_id.get(record['debt']['debt_id'])
+            if debt is None:
+                debt = Debt.from_dict(record['debt'])
+                self.debts.append(debt)
+                self._index_debt(debt)
+            return debt
+
+        if operation == 'archive':
+            self._unindex_debts(set(record['debt_ids']))
+            return None
+
+        debt = self._debts_by_id.get(record['debt_id'])
+
+        if debt is not None:
+            # declined debts and paid debts are settled
+            if operation == 'set_accepted':
+                debt.is_accepted = record['value']
+                debt.settled_on = None if record['value'] else record.get('on')
+            elif operation == 'set_paid':
+                debt.is_paid = record['value']
+                debt.settled_on = record.get('on') if record['value'] else None
+            self._update_open_views(debt)
+
+        return debt
+
+    def _persist(self, record):
+        """Makes a mutation durable, or queues it for the next group commit.
+
+        Arguments:
+            record {Dictionary} -- Mutation record with key 'op' and its arguments
+        """
+
+        if self._committer is not None:
+            self._committer.add(record)
+        else:
+            self._write_records([record])
+
+    def _publish(self, record):
+        if self.on_record is not None:
+            self.on_record(record)
+
+    def apply_record(self, record):
+        """Applies and persists a mutation record of another shard
+
+        Arguments:
+            record {Dictionary} -- Mutation record, see _persist
+
+        Returns:
+            user.User / debt.Debt -- Affected object, None if the debt is unknown
+        """
+
+        operation = record['op']
+
+        if operation == 'add_user':
+            key = record['user']['chat_id']
+        elif operation == 'add_debt':
+            key = record['debt']['debt_id']
+        else:
+            key = record.get('debt_id')
+
+        # serialized with the local mutations of the same record, like set_paid
+        with self._record_lock(key):
+
+            with self._index_lock:
+                result = self._apply(record)
+
+            if result is not None:
+                self._persist(record)
+
+        return result
+
+    def _write_records(self, records):
+        """Appends records to the journal with one sync in journal mode,
+        rewrites the JSON file otherwise.
+
+        Arguments:
+            records {list} -- Mutation records
+        """
+
+        if not self.journal:
+            self.update_json()
+            return
+
+        with self._write_lock:
+
+            data = ''.join(json.dumps(record) + '\n' for record in records)
+
+            with open(self.path_to_journal, 'a') as journal:
+                journal.write(data)
+                journal.flush()
+                os.fsync(journal.fileno())
+
+            self._journal_records += len(records)
+            self.bytes_written += len(data)
+
+            if self._journal_records >= self.compact_after:
+                self.compact()
+
+    def wait_durable(self, timeout=None):
+        """Blocks until all mutations made so far are written to disk (group commit).
+        Returns immediately if group commit is disabled.
+
+        Arguments:
+            timeout {Float} -- Seconds to wait at most
+
+        Returns:
+            Boolean -- Mutations are durable
+        """
+
+        if self._committer is None:
+            return True
+
+        return self._committer.wait(timeout=timeout)
+
+    def close(self):
+        """Writes pending mutations of the group commit and stops its thread
+        """
+
+        if self._committer is not None:
+            self._committer.close()
+
     def user_exists(self, chat_id):
         """Checks whether a users exists in the database
 
@@ -106,15 +598,574 @@ class Database:
             Boolean -- User exists
         """
 
-        user_exists = False
+        return chat_id in self._users_by_chat_id
 
-        for user in self.users:
+    def add_user(self, chat_id, name):
+        """Adds new user to the database
+
+        Arguments:
+            chat_id {String} -- Telegram Chat_ID
+            name {String} -- Telegram username
+        """
+
+        with self._record_lock(chat_id):
+
+            if self.user_exists(chat_id):
+                return
+
+            record = {'op': 'add_user', 'user': User(chat_id, name).to_dict()}
+
+            with self._index_lock:
+                self._apply(record)
+
+            self._persist(record)
+            self._publish(record)
+
+    def add_debt(self, creditor, category, amount, deadline, debtor):
+        """Ads a new debt to the database
+
+        Arguments:
+            creditor {String} -- Chat_ID of creditor
+            category {String} -- Category of the debt
+            amount {String} -- Amount
+            deadline {String} -- Deadline for notification. Format: YYYY.MM.DD
+            debtor {String} -- Chat_ID of debtor
+
+        Returns:
+            debt.Debt -- Object of the recently added debt
+        """
+
+        debt = Debt(str(uuid.uuid1()), creditor, category, amount, deadline, debtor)
+        record = {'op': 'add_debt', 'debt': debt.to_dict()}
+
+        with self._index_lock:
+            debt = self._apply(record)
+
+        self._persist(record)
+        self._publish(record)
+        LOGGER.debug('Debt added', extra={'debt_id': debt.debt_id, 'creditor': creditor, 'debtor': debtor})
+
+        return debt
+
+    def get_open_debts(self, chat_id):
+        """Shows all open debts form a user
+
+        Returns:
+            debt.Debt -- Debt objects where given user is debtor
+        """
+
+        return list(self._open_debts_by_debtor.get(chat_id, {}).values())
+
+    def get_open_claims(self, chat_id):
+        """Shows all open claims form a user
+
+        Returns:
+            debt.Debt -- Debt objects where given user is creditor
+        """
+
+        return list(self._open_claims_by_creditor.get(chat_id, {}).values())
+
+    def get_all_open_debts(self):
+        """Shows all open debts of all users
+
+        Returns:
+            debt.Debt -- Accepted, unpaid debt objects
+        """
+
+        return [debt for debts in list(self._open_debts_by_debtor.values())
+                for debt in list(debts.values())]
+
+    def get_debt_by_debt_id(self, debt_id):
+        """Returns the debt of a given debt_id
+
+        Arguments:
+            debt_id {String} -- ID of a debt
+
+        Returns:
+            debt.Debt -- Object of filtered debt
+        """
+
+        debt = self._debts_by_id.get(debt_id)
+
+        if debt is None and self.archive is not None:
+            debt = self.archive.find(debt_id)
+
+        return debt
+
+    def get_user_by_chat_id(self, chat_id):
+        """Returns the user of a given Chat_id
+
+        Arguments:
+            chat_id {String} -- Telegram Chat_ID
+
+        Returns:
+            user.User -- Object of filtered user
+        """
+
+        return self._users_by_chat_id.get(chat_id)
+
+    def get_user_by_name(self, name):
+        """Returns the user of a given username
+
+        Arguments:
+            name {String} -- Telegram username
+
+        Returns:
+            user.User -- Object of filtered user, None if no user has the name
+        """
+
+        return self._users_by_name.get(name)
+
+    def get_contacts(self, chat_id, limit=8):
+        """Returns the users a user had the most debts with, most recent first among equals
+
+        Arguments:
+            chat_id {String} -- Telegram Chat_ID
+            limit {Integer} -- Maximum number of contacts
+
+        Returns:
+            list -- Chat_IDs of the contacts
+        """
+
+        contacts = list(self._contacts.get(chat_id, {}).items())
+
+        return [other for other, _ in heapq.nlargest(limit, contacts, key=lambda contact: tuple(contact[1]))]
+
+    def user_count(self):
+        """Returns the number of registered users. Users are never removed,
+        so the count changes with every registration.
+
+        Returns:
+            Integer -- Number of users
+        """
+
+        return len(self.users)
+
+    def get_users_from(self, position):
+        """Returns the users registered after the first ones, see user_count
+
+        Arguments:
+            position {Integer} -- Number of users to skip
+
+        Returns:
+            list -- user.User objects in order of registration
+        """
+
+        return self.users[position:]
+
+    def set_accepted(self, debt_id, is_accepted):
+        """Sets the accepted status of a debt request
+
+        Arguments:
+            debt_id {String} -- Unique ID of a debt
+            is_accepted {bool} -- Debtors answer to debt request
+
+        Returns:
+            debt.Debt -- Object of the current debt, None if the debt is unknown or archived
+        """
+        record = {'op': 'set_accepted', 'debt_id': debt_id, 'value': is_accepted,
+                  'on': datetime.date.today().toordinal()}
+
+        with self._record_lock(debt_id):
+
+            with self._index_lock:
+                debt = self._apply(record)
+
+            if debt is None:
+                return None
+
+            self._persist(record)
+            self._publish(record)
+
+        return debt
+
+    def set_paid(self, debt_id, is_paid):
+        """Sets the paid status of a debt request
+
+        Arguments:
+            debt_id {String} -- Unique ID of a debt
+            is_paid {bool} -- Paid status
+
+        Returns:
+            debt.Debt -- Object of the current debt, None if the debt is unknown or archived
+        """
+        record = {'op': 'set_paid', 'debt_id': debt_id, 'value': is_paid,
+                  'on': datetime.date.today().toordinal()}
+
+        with self._record_lock(debt_id):
+
+            with self._index_lock:
+                debt = self._apply(record)
+
+            if debt is None:
+                return None
+
+            self._persist(record)
+            self._publish(record)
+
+        return debt
+
+    def _settle_legacy(self, debts, today, retention_days):
+        """Records a settlement date for debts settled before settlement dates were recorded:
+        paid debts, and debts that were never accepted (declined or left unanswered) whose
+        deadline is retention_days past. They count as settled today.
+
+        Arguments:
+            debts {list} -- debt.Debt objects
+            today {Integer} -- Ordinal date of today
+            retention_days {Integer} -- Days a settled debt stays in the database
+        """
+
+        for debt in debts:
+
+            if debt.settled_on is not None:
+                continue
+
+            if debt.is_paid:
+                record = {'op': 'set_paid', 'debt_id': debt.debt_id, 'value': True, 'on': today}
+            elif (not debt.is_accepted and debt.deadline_ordinal is not None
+                  and debt.deadline_ordinal + retention_days <= today):
+                record = {'op': 'set_accepted', 'debt_id': debt.debt_id, 'value': False, 'on': today}
+            else:
+                continue
+
+            with self._record_lock(debt.debt_id):
+
+                if debt.settled_on is not None or self._debts_by_id.get(debt.debt_id) is not debt:
+                    continue
+
+                with self._index_lock:
+                    self._apply(record)
+
+                self._persist(record)
+
+    def archive_settled(self, retention_days):
+        """Moves debts that were paid or declined at least retention_days ago to the archive.
+
+        Arguments:
+            retention_days {Integer} -- Days a settled debt stays in the database
+
+        Returns:
+            Integer -- Number of archived debts
+        """
+
+        if self.archive is None:
+            return 0
+
+        today = datetime.date.today().toordinal()
+
+        with self._index_lock:
+            debts = list(self.debts)
+
+        self._settle_legacy(debts, today, retention_days)
+
+        settled = [debt for debt in debts
+                   if debt.settled_on is not None and debt.settled_on + retention_days <= today]
+
+        if not settled:
+            return 0
+
+        # archive first: after a crash in between the debts are archived twice, never lost
+        self.archive.add(settled)
+
+        record = {'op': 'archive', 'debt_ids': [debt.debt_id for debt in settled]}
+
+        with self._index_lock:
+            self._apply(record)
+
+        self._persist(record)
+
+        return len(settled)
+
+
+class SqliteDatabase:
+    """
+    Drop-in replacement for the Database class backed by SQLite.
+    Every mutation is a single-row transaction, queries use the table indexes.
+
+    """
+
+    SCHEMA = (
+        'CREATE TABLE IF NOT EXISTS users ('
+        ' chat_id TEXT PRIMARY KEY,'
+        ' name TEXT NOT NULL)',
+        'CREATE TABLE IF NOT EXISTS debts ('
+        ' debt_id TEXT PRIMARY KEY,'
+        ' creditor TEXT NOT NULL,'
+        ' category TEXT NOT NULL,'
+        ' amount TEXT NOT NULL,'
+        ' deadline TEXT NOT NULL,'
+        ' debtor TEXT NOT NULL,'
+        ' is_accepted INTEGER NOT NULL DEFAULT 0,'
+        ' is_paid INTEGER NOT NULL DEFAULT 0)',
+        'CREATE INDEX IF NOT EXISTS debts_by_debtor ON debts (debtor, is_accepted, is_paid)',
+        'CREATE INDEX IF NOT EXISTS debts_by_creditor ON debts (creditor, is_accepted, is_paid)'
+    )
+
+    # applied once each, PRAGMA user_version counts the applied migrations
+    MIGRATIONS = (
+        'ALTER TABLE debts ADD COLUMN settled_on INTEGER',
+        # paid before settlement dates were recorded, counts as settled today (ordinal date)
+        "UPDATE debts SET settled_on = CAST(julianday('now', 'localtime') - 1721424.5 AS INTEGER)"
+        ' WHERE is_paid = 1',
+        'CREATE INDEX IF NOT EXISTS debts_by_settled_on ON debts (settled_on) WHERE settled_on IS NOT NULL',
+        'CREATE INDEX IF NOT EXISTS users_by_name ON users (name)'
+    )
+
+    DEBT_COLUMNS = 'debt_id, creditor, category, amount, deadline, debtor, is_accepted, is_paid, settled_on'
+
+    def __init__(self, path_to_db, path_to_archive=None, commit_interval=None, commit_batch=100):
+
+        self.path_to_db = path_to_db
+        self.archive = Archive(path_to_archive) if path_to_archive else None
+        self.commit_interval = commit_interval
+        self.commit_batch = commit_batch
+        self._committer = None
+        # one writer connection, one reader connection per thread (WAL readers don't block)
+        self._connection = None
+        self._write_lock = threading.Lock()
+        self._readers = threading.local()
+        # called with the records of local mutations (sharding)
+        self.on_record = None
+        # size of the applied mutation records, SQLite doesn't report the bytes it writes (metrics)
+        self.bytes_written = 0
+
+    def init_json(self):
+        """Opens the SQLite file and creates tables and indexes if necessary.
+        The name is kept for compatibility with the Database class.
+        """
+
+        self._connection = sqlite3.connect(
+            self.path_to_db, isolation_level=None, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')
+
+        if self.commit_interval is not None:
+            # commits don't sync the WAL anymore, the group commit checkpoint does
+            self._connection.execute('PRAGMA synchronous=NORMAL')
+            self._committer = GroupCommitter(self._checkpoint, self.commit_interval, self.commit_batch)
+
+        with self._write_lock:
+            for statement in self.SCHEMA:
+                self._connection.execute(statement)
+
+            version = self._connection.execute('PRAGMA user_version').fetchone()[0]
+
+            for statement in self.MIGRATIONS[version:]:
+                self._connection.execute(statement)
+
+            self._connection.execute(f'PRAGMA user_version = {len(self.MIGRATIONS)}')
+
+    def migrate_json(self, path_to_json):
+        """Imports users and debts of a JSON database, as long as the SQLite database is empty.
+
+        Arguments:
+            path_to_json {String} -- Path of the JSON database (journal is replayed as well)
+
+        Returns:
+            Boolean -- Data was migrated
+        """
+
+        if not os.path.exists(path_to_json) or self._query_one('SELECT 1 FROM users LIMIT 1'):
+            return False
+
+        json_database = Database(path_to_json)
+        json_database.init_json()
+
+        with self._write_lock:
+            self._connection.execute('BEGIN')
+            try:
+                self._connection.executemany(
+                    'INSERT OR IGNORE INTO users (chat_id, name) VALUES (?, ?)',
+                    [(user.chat_id, user.name) for user in json_database.users])
+                self._connection.executemany(
+                    f'INSERT OR IGNORE INTO debts ({self.DEBT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                    [self._debt_to_row(debt) for debt in json_database.debts])
+            except sqlite3.Error:
+                self._connection.execute('ROLLBACK')
+                raise
+            self._connection.execute('COMMIT')
+
+        return True
+
+    @staticmethod
+    def _debt_to_row(debt):
+        return (debt.debt_id, debt.creditor, debt.category, debt.amount, debt.deadline,
+                debt.debtor, int(debt.is_accepted), int(debt.is_paid), debt.settled_on)
+
+    @staticmethod
+    def _row_to_debt(row):
+        return Debt(row[0], row[1], row[2], row[3], row[4], row[5], bool(row[6]), bool(row[7]), row[8])
+
+    def _checkpoint(self, _, attempts=3):
+        """Syncs all committed transactions to disk (group commit flush).
+
+        Under synchronous=NORMAL only a completed checkpoint syncs the database file,
+        so the checkpoint waits for readers of older snapshots (FULL) and is retried
+        until every WAL frame is copied. OSError if it doesn't complete: the batch
+        stays pending and is retried by the GroupCommitter.
+        """
+
+        with self._write_lock:
+            for attempt in range(attempts):
+                try:
+                    busy, log_frames, checkpointed_frames = self._connection.execute(
+                        'PRAGMA wal_checkpoint(FULL)').fetchone()
+                except sqlite3.OperationalError as checkpoint_error:
+                    raise OSError(checkpoint_error) from checkpoint_error
+
+                if not busy and checkpointed_frames == log_frames:
+                    return
+
+                time.sleep(0.01 * (attempt + 1))
+
+        raise OSError(f'WAL checkpoint incomplete: {checkpointed_frames} of {log_frames} frames')
+
+    def wait_durable(self, timeout=None):
+        """Blocks until all mutations made so far are synced to disk (group commit).
+        Returns immediately if group commit is disabled.
+
+        Arguments:
+            timeout {Float} -- Seconds to wait at most
+
+        Returns:
+            Boolean -- Mutations are durable
+        """
+
+        if self._committer is None:
+            return True
+
+        return self._committer.wait(timeout=timeout)
+
+    def close(self):
+        """Syncs pending mutations of the group commit and stops its thread
+        """
+
+        if self._committer is not None:
+            self._committer.close()
+
+    def _reader(self):
+        connection = getattr(self._readers, 'connection', None)
+
+        if connection is None:
+            connection = sqlite3.connect(self.path_to_db, isolation_level=None)
+            self._readers.connection = connection
+
+        return connection
+
+    def _query_all(self, sql, parameters=()):
+        return self._reader().execute(sql, parameters).fetchall()
+
+    def _query_one(self, sql, parameters=()):
+        return self._reader().execute(sql, parameters).fetchone()
+
+    def _apply(self, record):
+        """Executes a mutation record (same format as Database._persist) as one transaction.
+
+        Arguments:
+            record {Dictionary} -- Mutation record
+
+        Returns:
+            Boolean -- A row was changed
+        """
+
+        operation = record['op']
+
+        if operation == 'add_user':
+            sql = 'INSERT OR IGNORE INTO users (chat_id, name) VALUES (?, ?)'
+            parameters = (record['user']['chat_id'], record['user']['name'])
+        elif operation == 'add_debt':
+            sql = f'INSERT OR IGNORE INTO debts ({self.DEBT_COLUMNS}) VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)'
+            parameters = self._debt_to_row(Debt.from_dict(record['debt']))
+        elif operation == 'set_accepted':
+            # declined debts and paid debts are settled
+            sql = 'UPDATE debts SET is_accepted = ?, settled_on = ? WHERE debt_id = ?'
+            parameters = (int(record['value']), None if record['value'] else record.get('on'),
+                          record['debt_id'])
+        elif operation == 'set_paid':
+            sql = 'UPDATE debts SET is_paid = ?, settled_on = ? WHERE debt_id = ?'
+            parameters = (int(record['value']), record.get('on') if record['value'] else None,
+                          record['debt_id'])
+        elif operation == 'archive':
+            sql = 'DELETE FROM debts WHERE debt_id = ?'
+            parameters = [(debt_id,) for debt_id in record['debt_ids']]
+        else:
+            raise ValueError(f'Unknown operation {operation}')
+
+        with self._write_lock:
+            if operation == 'archive':
+                self._connection.execute('BEGIN')
+                try:
+                    changed = self._connection.executemany(sql, parameters).rowcount > 0
+                except sqlite3.Error:
+                    self._connection.execute('ROLLBACK')
+                    raise
+                self._connection.execute('COMMIT')
+            else:
+                changed = self._connection.execute(sql, parameters).rowcount > 0
+
+        if changed:
+            self.bytes_written += len(json.dumps(record))
+
+        if self._committer is not None:
+            self._committer.add(record)
+
+        return changed
+
+    def _apply_local(self, record):
+        """Executes a mutation record of this process and publishes it (see on_record)
+
+        Arguments:
+            record {Dictionary} -- Mutation record
+
+        Returns:
+            Boolean -- A row was changed
+        """
+
+        changed = self._apply(record)
+
+        if changed and self.on_record is not None:
+            self.on_record(record)
+
+        return changed
+
+    def apply_record(self, record):
+        """See Database.apply_record
+        """
+        return self._apply(record)
+
+    @property
+    def users(self):
+        """All users in order of registration
+
+        Returns:
+            list -- user.User objects
+        """
+
+        return [User(row[0], row[1])
+                for row in self._query_all('SELECT chat_id, name FROM users ORDER BY rowid')]
+
+    @property
+    def debts(self):
+        """All debts in order of creation
 
-            if user.chat_id == chat_id:
+        Returns:
+            list -- debt.Debt objects
+        """
 
-                user_exists = True
+        return [self._row_to_debt(row)
+                for row in self._query_all(f'SELECT {self.DEBT_COLUMNS} FROM debts ORDER BY rowid')]
 
-        return user_exists
+    def user_exists(self, chat_id):
+        """Checks whether a users exists in the database
+
+        Arguments:
+            chat_id {String} -- Telegram Chat_ID
+
+        Returns:
+            Boolean -- User exists
+        """
+
+        return self._query_one('SELECT 1 FROM users WHERE chat_id = ?', (chat_id,)) is not None
 
     def add_user(self, chat_id, name):
         """Adds new user to the database
@@ -124,12 +1175,7 @@ class Database:
             name {String} -- Telegram username
         """
 
-        if self.user_exists(chat_id):
-            return
-
-        user = User(chat_id, name)
-        self.users.append(user)
-        self.update_json()
+        self._apply_local({'op': 'add_user', 'user': User(chat_id, name).to_dict()})
 
     def add_debt(self, creditor, category, amount, deadline, debtor):
         """Ads a new debt to the database
@@ -138,7 +1184,7 @@ class Database:
             creditor {String} -- Chat_ID of creditor
             category {String} -- Category of the debt
             amount {String} -- Amount
-            deadline {String} -- Deadline for notification. Format: YYYY.MM.DD
+            deadline {String} -- Deadline for notification. Format: YYYY:MM:DD
             debtor {String} -- Chat_ID of debtor
 
         Returns:
@@ -146,9 +1192,8 @@ class Database:
         """
 
         debt = Debt(str(uuid.uuid1()), creditor, category, amount, deadline, debtor)
-        self.debts.append(debt)
-        self.update_json()
-        print(debt)
+        self._apply_local({'op': 'add_debt', 'debt': debt.to_dict()})
+        LOGGER.debug('Debt added', extra={'debt_id': debt.debt_id, 'creditor': creditor, 'debtor': debtor})
 
         return debt
 
@@ -159,7 +1204,9 @@ class Database:
             debt.Debt -- Debt objects where given user is debtor
         """
 
-        return [debt for debt in self.debts if not debt.is_paid and debt.is_accepted and debt.debtor == chat_id]
+        return [self._row_to_debt(row) for row in self._query_all(
+            f'SELECT {self.DEBT_COLUMNS} FROM debts'
+            ' WHERE debtor = ? AND is_accepted = 1 AND is_paid = 0 ORDER BY rowid', (chat_id,))]
 
     def get_open_claims(self, chat_id):
         """Shows all open claims form a user
@@ -168,7 +1215,19 @@ class Database:
             debt.Debt -- Debt objects where given user is creditor
         """
 
-        return [debt for debt in self.debts if not debt.is_paid and debt.is_accepted and debt.creditor == chat_id]
+        return [self._row_to_debt(row) for row in self._query_all(
+            f'SELECT {self.DEBT_COLUMNS} FROM debts'
+            ' WHERE creditor = ? AND is_accepted = 1 AND is_paid = 0 ORDER BY rowid', (chat_id,))]
+
+    def get_all_open_debts(self):
+        """Shows all open debts of all users
+
+        Returns:
+            debt.Debt -- Accepted, unpaid debt objects
+        """
+
+        return [self._row_to_debt(row) for row in self._query_all(
+            f'SELECT {self.DEBT_COLUMNS} FROM debts WHERE is_accepted = 1 AND is_paid = 0')]
 
     def get_debt_by_debt_id(self, debt_id):
         """Returns the debt of a given debt_id
@@ -180,9 +1239,15 @@ class Database:
             debt.Debt -- Object of filtered debt
         """
 
-        for debt in self.debts:
-            if debt.debt_id == debt_id:
-                return debt
+        row = self._query_one(
+            f'SELECT {self.DEBT_COLUMNS} FROM debts WHERE debt_id = ?', (debt_id,))
+
+        if row:
+            return self._row_to_debt(row)
+
+        if self.archive is not None:
+            return self.archive.find(debt_id)
+
         return None
 
     def get_user_by_chat_id(self, chat_id):
@@ -195,10 +1260,45 @@ class Database:
             user.User -- Object of filtered user
         """
 
-        for user in self.users:
-            if user.chat_id == chat_id:
-                return user
-        return None
+        row = self._query_one('SELECT chat_id, name FROM users WHERE chat_id = ?', (chat_id,))
+
+        return User(row[0], row[1]) if row else None
+
+    def get_user_by_name(self, name):
+        """See Database.get_user_by_name
+        """
+
+        row = self._query_one('SELECT chat_id, name FROM users WHERE name = ? ORDER BY rowid LIMIT 1',
+                              (name,))
+
+        return User(row[0], row[1]) if row else None
+
+    def get_contacts(self, chat_id, limit=8):
+        """See Database.get_contacts
+        """
+
+        rows = self._query_all(
+            'SELECT other, count(*) AS debts, max(position) AS last FROM ('
+            ' SELECT debtor AS other, rowid AS position FROM debts WHERE creditor = ?'
+            ' UNION ALL SELECT creditor, rowid FROM debts WHERE debtor = ?)'
+            ' GROUP BY other ORDER BY debts DESC, last DESC LIMIT ?', (chat_id, chat_id, limit))
+
+        return [row[0] for row in rows]
+
+    def user_count(self):
+        """See Database.user_count
+        """
+
+        # users are never deleted, so the largest rowid is the count
+        return self._query_one('SELECT max(rowid) FROM users')[0] or 0
+
+    def get_users_from(self, position):
+        """See Database.get_users_from
+        """
+
+        return [User(row[0], row[1])
+                for row in self._query_all('SELECT chat_id, name FROM users WHERE rowid > ? ORDER BY rowid',
+                                           (position,))]
 
     def set_accepted(self, debt_id, is_accepted):
         """Sets the accepted status of a debt request
@@ -208,17 +1308,14 @@ class Database:
             is_accepted {bool} -- Debtors answer to debt request
 
         Returns:
-            debt.Debt -- Object of the current debt
+            debt.Debt -- Object of the current debt, None if the debt is unknown or archived
         """
-        debt_object = 0
 
-        for debt in self.debts:
-            if debt.debt_id == debt_id:
-                debt.is_accepted = is_accepted
-                debt_object = debt
-                self.update_json()
+        if not self._apply_local({'op': 'set_accepted', 'debt_id': debt_id, 'value': is_accepted,
+                                  'on': datetime.date.today().toordinal()}):
+            return None
 
-        return debt_object
+        return self.get_debt_by_debt_id(debt_id)
 
     def set_paid(self, debt_id, is_paid):
         """Sets the paid status of a debt request
@@ -228,16 +1325,47 @@ class Database:
             is_paid {bool} -- Paid status
 
         Returns:
-            debt.Debt -- Object of the current debt
+            debt.Debt -- Object of the current debt, None if the debt is unknown or archived
         """
-        debt_object = 0
 
-        for debt in self.debts:
-            if debt.debt_id == debt_id:
-                debt.is_paid = is_paid
-                debt_object = debt
-                self.update_json()
+        if not self._apply_local({'op': 'set_paid', 'debt_id': debt_id, 'value': is_paid,
+                                  'on': datetime.date.today().toordinal()}):
+            return None
+
+        return self.get_debt_by_debt_id(debt_id)
+
+    def archive_settled(self, retention_days):
+        """Moves debts that were paid or declined at least retention_days ago to the archive.
+
+        Arguments:
+            retention_days {Integer} -- Days a settled debt stays in the database
+
+        Returns:
+            Integer -- Number of archived debts
+        """
+
+        if self.archive is None:
+            return 0
+
+        today = datetime.date.today()
+        cutoff = today.toordinal() - retention_days
+
+        # settled before settlement dates were recorded (see Database._settle_legacy),
+        # deadlines "YYYY:MM:DD" compare as text
+        with self._write_lock:
+            self._connection.execute(
+                'UPDATE debts SET settled_on = ? WHERE settled_on IS NULL'
+                ' AND (is_paid = 1 OR (is_accepted = 0 AND deadline <= ?))',
+                (today.toordinal(), datetime.date.fromordinal(cutoff).strftime(DEADLINE_FORMAT)))
+
+        settled = [self._row_to_debt(row) for row in self._query_all(
+            f'SELECT {self.DEBT_COLUMNS} FROM debts WHERE settled_on <= ?', (cutoff,))]
 
-        return debt_object
+        if not settled:
+            return 0
 
+        # archive first: after a crash in between the debts are archived twice, never lost
+        self.archive.add(settled)
+        self._apply({'op': 'archive', 'debt_ids': [debt.debt_id for debt in settled]})
 
+        return len(settled)
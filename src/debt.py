@@ -4,8 +4,78 @@ Module: debt
 Description:
 The debt module contains the class of a debt.
 Each unique debt is stored as a debt object.
+
+The deadline is kept as ordinal date and the amount as integer cents plus unit
+(e.g. "7.5€" -> 750, "€"). Both are parsed once when the object is created;
+the attributes deadline and amount still return the original strings.
 """
 
+import datetime
+import re
+import sys
+
+DEADLINE_FORMAT = "%Y:%m:%d"
+
+_AMOUNT_PATTERN = re.compile(r'(\d+)(?:\.(\d{1,2}))?(\D*)')
+
+
+def parse_amount(amount):
+    """Splits an amount like "7.5€" into cents and unit.
+
+    Arguments:
+        amount {String} -- Amount as entered by the user
+
+    Returns:
+        tuple -- (cents, unit), (None, amount) if the text can't be restored from cents and unit
+    """
+
+    match = _AMOUNT_PATTERN.fullmatch(amount)
+
+    if match is None:
+        return None, amount
+
+    cents = int(match.group(1)) * 100 + int((match.group(2) or '0').ljust(2, '0'))
+    unit = sys.intern(match.group(3))
+
+    if format_amount(cents, unit) != amount:
+        return None, amount
+
+    return cents, unit
+
+
+def format_amount(cents, unit):
+    """Formats cents and unit the way amounts are entered, e.g. 750, "€" -> "7.5€"
+
+    Arguments:
+        cents {Integer} -- Amount in cents
+        unit {String} -- Unit of the amount
+
+    Returns:
+        String -- Amount
+    """
+
+    if cents % 100 == 0:
+        return f'{cents // 100}{unit}'
+
+    return f'{cents // 100}.{cents % 100:02d}'.rstrip('0') + unit
+
+
+def parse_deadline(deadline):
+    """Converts a deadline "YYYY:MM:DD" to an ordinal date.
+
+    Arguments:
+        deadline {String} -- Deadline
+
+    Returns:
+        Integer -- Ordinal date, None if the deadline isn't a valid date
+    """
+
+    try:
+        year, month, day = deadline.split(':')
+        return datetime.date(int(year), int(month), int(day)).toordinal()
+    except ValueError:
+        return None
+
 
 class Debt:
     """
@@ -13,15 +83,63 @@ class Debt:
     These can be returned as dictionary entries.
     """
 
-    def __init__(self, debt_id, creditor, category, amount, deadline, debtor, is_accepted=False, is_paid=False):
+    # amount_unit holds the raw amount text if amount_cents is None,
+    # _deadline holds the raw deadline text if it isn't a valid date
+    __slots__ = ('debt_id', 'creditor', 'category', 'debtor', 'is_accepted', 'is_paid',
+                 'amount_cents', 'amount_unit', '_deadline', 'settled_on')
+
+    def __init__(self, debt_id, creditor, category, amount, deadline, debtor, is_accepted=False, is_paid=False,
+                 settled_on=None):
         self.debt_id = debt_id
-        self.creditor = creditor
-        self.category = category
+        # chat ids and categories repeat across many debts and are shared
+        self.creditor = sys.intern(creditor)
+        self.category = sys.intern(category)
         self.amount = amount
         self.deadline = deadline
-        self.debtor = debtor
+        self.debtor = sys.intern(debtor)
         self.is_accepted = is_accepted
         self.is_paid = is_paid
+        # ordinal date on which the debt was paid or declined
+        self.settled_on = settled_on
+
+    @property
+    def amount(self):
+        """Amount as string, e.g. "7.5€"
+        """
+        if self.amount_cents is None:
+            return self.amount_unit
+        return format_amount(self.amount_cents, self.amount_unit)
+
+    @amount.setter
+    def amount(self, amount):
+        self.amount_cents, self.amount_unit = parse_amount(amount)
+
+    @property
+    def deadline(self):
+        """Deadline as string. Format: YYYY:MM:DD
+        """
+        if isinstance(self._deadline, int):
+            return datetime.date.fromordinal(self._deadline).strftime(DEADLINE_FORMAT)
+        return self._deadline
+
+    @deadline.setter
+    def deadline(self, deadline):
+        ordinal = parse_deadline(deadline)
+        self._deadline = deadline if ordinal is None else ordinal
+
+    @property
+    def deadline_ordinal(self):
+        """Deadline as ordinal date, None if the deadline is invalid
+        """
+        return self._deadline if isinstance(self._deadline, int) else None
+
+    @property
+    def deadline_date(self):
+        """Deadline as datetime.date, None if the deadline is invalid
+        """
+        if isinstance(self._deadline, int):
+            return datetime.date.fromordinal(self._deadline)
+        return None
 
     def to_dict(self):
         """Returns debt attributes as dict.
@@ -38,7 +156,9 @@ class Debt:
             'deadline': self.deadline,
             'debtor': self.debtor,
             'is_accepted': self.is_accepted,
-            'is_paid': self.is_paid
+            'is_paid': self.is_paid,
+            'settled_on': (None if self.settled_on is None else
+                           datetime.date.fromordinal(self.settled_on).strftime(DEADLINE_FORMAT))
         }
 
     @staticmethod
@@ -59,5 +179,6 @@ class Debt:
             debt_as_dict['deadline'],
             debt_as_dict['debtor'],
             debt_as_dict['is_accepted'],
-            debt_as_dict['is_paid']
+            debt_as_dict['is_paid'],
+            parse_deadline(debt_as_dict.get('settled_on') or '')
         )
@@ -0,0 +1,206 @@
+"""
+Module: log_pipeline
+
+Description:
+Non-blocking logging: handler threads only put records into a bounded queue, a
+background thread formats and writes them (message arguments, extra fields and
+tracebacks are formatted there, not on the logging thread).
+
+Records are written as key/value lines. Fields passed with extra={...} are appended:
+
+    LOGGER.info('Debt added', extra={'debt_id': debt_id, 'amount': amount})
+    ts=2024-05-01T12:00:00.123 level=INFO logger=database msg="Debt added" debt_id=... amount=5€
+
+High-volume records (below WARNING) are sampled and rate limited per logger before
+they are queued: a logger keeps the configured fraction of its records (longest
+matching logger name prefix in sampling) and at most rate_limit records per second.
+Warnings and errors always pass. If the writer falls behind and the queue is full,
+records are dropped instead of blocking. Dropped records are counted in the metric
+bot_log_records_dropped_total.
+
+Usage:
+
+pipeline = LogPipeline(level=logging.DEBUG, sampling={'telegram': 0.1}, rate_limit=20)
+pipeline.start()
+...
+pipeline.stop()
+"""
+
+import logging
+import logging.handlers
+import queue
+import random
+import sys
+import threading
+import time
+
+import metrics
+
+DROPPED_RECORDS = metrics.counter('bot_log_records_dropped_total', 'Log records not written',
+                                  ['reason'])
+
+# attributes of every LogRecord, the other attributes are fields passed with extra
+_RECORD_ATTRIBUTES = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {'message', 'asctime'}
+
+
+def parse_sampling(text):
+    """Parses a sampling configuration
+
+    Arguments:
+        text {String} -- e.g. "telegram=0.1,webhook=0.5"
+
+    Returns:
+        Dictionary -- Logger name prefix -> fraction of the records kept
+    """
+
+    sampling = {}
+
+    for item in filter(None, (item.strip() for item in text.split(','))):
+        name, _, fraction = item.partition('=')
+        sampling[name.strip()] = float(fraction)
+
+    return sampling
+
+
+def _quote(value):
+    text = str(value)
+    if not text or any(character in text for character in ' "=\n'):
+        return '"' + text.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') + '"'
+    return text
+
+
+class KeyValueFormatter(logging.Formatter):
+    """
+    Formats records as key=value pairs, followed by the fields passed with extra.
+    """
+
+    def format(self, record):
+        fields = [('ts', self.formatTime(record)), ('level', record.levelname),
+                  ('logger', record.name), ('thread', record.threadName), ('msg', record.getMessage())]
+        fields += [(key, value) for key, value in vars(record).items() if key not in _RECORD_ATTRIBUTES]
+        line = ' '.join(f'{key}={_quote(value)}' for key, value in fields)
+
+        if record.exc_info:
+            line += ' exc=' + _quote(self.formatException(record.exc_info))
+
+        return line
+
+    def formatTime(self, record, datefmt=None):
+        seconds = time.strftime('%Y-%m-%dT%H:%M:%S', time.localtime(record.created))
+        return f'{seconds}.{int(record.msecs):03d}'
+
+
+class SamplingFilter(logging.Filter):
+    """
+    Samples and rate limits the records below a level, per logger.
+    """
+
+    def __init__(self, sampling=None, rate_limit=None, below=logging.WARNING):
+        """
+        Arguments:
+            sampling {Dictionary} -- Logger name prefix -> fraction of the records kept
+            rate_limit {Float} -- Records per second and logger, None for no limit
+            below {Integer} -- Records of this level and above always pass
+        """
+
+        super().__init__()
+        self.sampling = dict(sampling or {})
+        self.rate_limit = rate_limit
+        self.below = below
+        # logger name -> [fraction, tokens, last refill]
+        self._loggers = {}
+        self._lock = threading.Lock()
+
+    def _fraction(self, name):
+        prefixes = [prefix for prefix in self.sampling
+                    if name == prefix or name.startswith(prefix + '.')]
+        return self.sampling[max(prefixes, key=len)] if prefixes else 1.0
+
+    def filter(self, record):
+        if record.levelno >= self.below:
+            return True
+
+        with self._lock:
+            state = self._loggers.get(record.name)
+
+            if state is None:
+                state = self._loggers[record.name] = [self._fraction(record.name), self.rate_limit, time.monotonic()]
+
+            if state[0] < 1.0 and random.random() >= state[0]:
+                DROPPED_RECORDS.labels('sampled').inc()
+                return False
+
+            if self.rate_limit is not None:
+                now = time.monotonic()
+                state[1] = min(self.rate_limit, state[1] + (now - state[2]) * self.rate_limit)
+                state[2] = now
+
+                if state[1] < 1:
+                    DROPPED_RECORDS.labels('rate_limited').inc()
+                    return False
+
+                state[1] -= 1
+
+        return True
+
+
+class _DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    Queue handler that drops records when the queue is full instead of reporting an error.
+    Records are queued as they are, the writer thread formats them.
+    """
+
+    def prepare(self, record):
+        # QueueHandler.prepare formats the message and the traceback on the logging thread
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            DROPPED_RECORDS.labels('queue_full').inc()
+
+
+class LogPipeline:
+    """
+    The LogPipeline class routes the root logger through a queue to a writer thread.
+    """
+
+    def __init__(self, level=logging.DEBUG, sampling=None, rate_limit=None, queue_size=10000,
+                 stream=None):
+        """
+        Arguments:
+            level {Integer} -- Level of the root logger
+            sampling {Dictionary} -- See SamplingFilter
+            rate_limit {Float} -- See SamplingFilter
+            queue_size {Integer} -- Records waiting for the writer, further records are dropped
+            stream {File} -- Output, default: stderr
+        """
+
+        self.level = level
+        self.queue = queue.Queue(queue_size)
+        self.handler = _DroppingQueueHandler(self.queue)
+        self.handler.addFilter(SamplingFilter(sampling, rate_limit))
+
+        writer = logging.StreamHandler(stream if stream is not None else sys.stderr)
+        writer.setFormatter(KeyValueFormatter())
+        self.listener = logging.handlers.QueueListener(self.queue, writer)
+
+    def start(self):
+        """Replaces the handlers of the root logger and starts the writer thread
+        """
+
+        root = logging.getLogger()
+
+        for handler in list(root.handlers):
+            root.removeHandler(handler)
+
+        root.addHandler(self.handler)
+        root.setLevel(self.level)
+        self.listener.start()
+
+    def stop(self):
+        """Writes the queued records and stops the writer thread
+        """
+
+        self.listener.stop()
@@ -12,40 +12,286 @@ Press Ctrl-C on the command line or send a signal to the process to stop the
 bot.
 """
 
+import asyncio
 import logging
 import datetime
-import json
 import os
+import signal
+import threading
 
 
-from telegram import (ReplyKeyboardMarkup,
+from telegram import (ReplyKeyboardMarkup, Update,
                       InlineKeyboardButton, InlineKeyboardMarkup)
 from telegram.ext import (Updater, CommandHandler, MessageHandler, Filters,
                           ConversationHandler, CallbackQueryHandler, CallbackContext)
-from database import Database
-
+from database import Database, SqliteDatabase
+from async_database import AsyncDatabase
+from async_runtime import AsyncRuntime
+from reminders import ReminderPolicy, ReminderScheduler
+from outbound import OutboundQueue, INTERACTIVE, REMINDER
+from webhook import WebhookServer
+from sharding import ShardChannel, shard_authkey
+import callback_data
+import metrics
+import tracing
+from log_pipeline import LogPipeline, parse_sampling
+from user_keyboard import UserKeyboards, ALL_USERS_BUTTON, PAGE_BUTTON_PATTERN
+
+
+# Logging settings
+# LOG_MODE=queue writes key/value records on a background thread, LOG_MODE=sync on the calling thread
+LOG_MODE = os.environ.get('LOG_MODE', 'queue')
+LOG_LEVEL = os.environ.get('LOG_LEVEL', 'DEBUG')
+# records below WARNING: fraction kept per logger (LOG_SAMPLING=telegram=0.1,webhook=0.5)
+# and at most LOG_RATE_LIMIT per second and logger (LOG_MODE=queue)
+LOG_SAMPLING = parse_sampling(os.environ.get('LOG_SAMPLING', 'telegram=0.1'))
+LOG_RATE_LIMIT = float(os.environ.get('LOG_RATE_LIMIT', '20')) or None
+LOG_QUEUE_SIZE = int(os.environ.get('LOG_QUEUE_SIZE', '10000'))
 
 # Enable logging
-logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
-                    level=logging.DEBUG)
+LOG_PIPELINE = None
+if LOG_MODE == 'queue':
+    LOG_PIPELINE = LogPipeline(level=LOG_LEVEL, sampling=LOG_SAMPLING, rate_limit=LOG_RATE_LIMIT,
+                               queue_size=LOG_QUEUE_SIZE)
+    LOG_PIPELINE.start()
+else:
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+                        level=LOG_LEVEL)
 
 LOGGER = logging.getLogger(__name__)
 
+# Storage settings
+# DB_BACKEND=sqlite stores users and debts in database.sqlite3 (migrated from database.json)
+DB_BACKEND = os.environ.get('DB_BACKEND', 'json')
+# DB_JOURNAL=1 appends mutations to a journal instead of rewriting database.json
+DB_JOURNAL = os.environ.get('DB_JOURNAL', '0') == '1'
+DB_COMPACT_AFTER = int(os.environ.get('DB_COMPACT_AFTER', '1000'))
+# days until paid/declined debts are moved to the archive (database.archive)
+DB_ARCHIVE_AFTER_DAYS = int(os.environ.get('DB_ARCHIVE_AFTER_DAYS', '30'))
+# DB_COMMIT_INTERVAL=<seconds> writes mutations in groups (one sync per interval or DB_COMMIT_BATCH)
+DB_COMMIT_INTERVAL = (float(os.environ['DB_COMMIT_INTERVAL'])
+                      if 'DB_COMMIT_INTERVAL' in os.environ else None)
+DB_COMMIT_BATCH = int(os.environ.get('DB_COMMIT_BATCH', '100'))
+# DB_WAIT_DURABLE=0 sends confirmations without waiting for the group commit
+DB_WAIT_DURABLE = os.environ.get('DB_WAIT_DURABLE', '1') == '1'
+
+# Sharding settings
+# SHARD_INDEX=<i> runs this process as shard i of SHARD_COUNT (started by sharding.py),
+# it receives updates from the router and keeps its data in database.shard<i>.*
+SHARD_COUNT = int(os.environ.get('SHARD_COUNT', '1'))
+SHARD_INDEX = int(os.environ['SHARD_INDEX']) if 'SHARD_INDEX' in os.environ else None
+DB_NAME = "database" if SHARD_INDEX is None else f"database.shard{SHARD_INDEX}"
+
 # initialization of database (same folder)
-DB = Database("database.json")
-DB.init_json()
+if DB_BACKEND == 'sqlite':
+    DB = SqliteDatabase(DB_NAME + ".sqlite3", path_to_archive=DB_NAME + ".archive",
+                        commit_interval=DB_COMMIT_INTERVAL, commit_batch=DB_COMMIT_BATCH)
+    DB.init_json()
+    DB.migrate_json(DB_NAME + ".json")
+else:
+    DB = Database(DB_NAME + ".json", journal=DB_JOURNAL, compact_after=DB_COMPACT_AFTER,
+                  path_to_archive=DB_NAME + ".archive",
+                  commit_interval=DB_COMMIT_INTERVAL, commit_batch=DB_COMMIT_BATCH)
+    DB.init_json()
+
+# Metrics settings
+# METRICS_PORT=<port> serves Prometheus metrics on http://METRICS_LISTEN:<port>/metrics, 0 disables
+# (shards use the following ports: METRICS_PORT + 1 + SHARD_INDEX)
+METRICS_PORT = int(os.environ.get('METRICS_PORT', '9464'))
+if METRICS_PORT and SHARD_INDEX is not None:
+    METRICS_PORT += 1 + SHARD_INDEX
+METRICS_LISTEN = os.environ.get('METRICS_LISTEN', '127.0.0.1')
+HANDLER_SECONDS = metrics.histogram('bot_handler_seconds', 'Latency of the update handlers', ['handler'])
+HANDLER_ERRORS = metrics.counter('bot_handler_errors_total', 'Exceptions raised by the update handlers',
+                                 ['handler'])
+STORAGE_SECONDS = metrics.histogram('bot_storage_operation_seconds', 'Latency of the database methods',
+                                    ['operation'])
+STORAGE_OPERATIONS = ['add_user', 'add_debt', 'set_accepted', 'set_paid', 'apply_record', 'user_exists',
+                      'user_count', 'get_user_by_chat_id', 'get_user_by_name', 'get_open_debts',
+                      'get_open_claims', 'get_all_open_debts', 'get_debt_by_debt_id', 'get_contacts',
+                      'archive_settled', 'update_json', 'compact', 'wait_durable']
+metrics.instrument_methods(DB, STORAGE_OPERATIONS, STORAGE_SECONDS)
+metrics.function('bot_storage_written_bytes_total', 'Bytes written by the database', 'counter',
+                 lambda: DB.bytes_written)
+
+# Tracing settings
+# TRACE_SAMPLE_RATE=0.01 traces 1% of the updates (handlers, database methods, Bot API calls)
+# and appends the spans to TRACE_FILE (Chrome trace events, open with https://ui.perfetto.dev)
+TRACE_SAMPLE_RATE = float(os.environ.get('TRACE_SAMPLE_RATE', '0'))
+TRACE_FILE = os.environ.get('TRACE_FILE', DB_NAME + ".trace.json")
+TRACER = None
+if TRACE_SAMPLE_RATE > 0:
+    TRACER = tracing.Tracer(TRACE_FILE, TRACE_SAMPLE_RATE)
+    tracing.instrument_methods(DB, STORAGE_OPERATIONS, 'storage')
+
+# ASYNC_MODE=1 runs the callback handlers as coroutines on an asyncio event loop and the
+# conversation steps on the dispatcher's worker pool (DISPATCHER_WORKERS threads),
+# so the dispatcher thread only hands updates over
+ASYNC_MODE = os.environ.get('ASYNC_MODE', '0') == '1'
+DISPATCHER_WORKERS = int(os.environ.get('DISPATCHER_WORKERS', '4'))
+RUNTIME = None
+ADB = None
+if ASYNC_MODE:
+    RUNTIME = AsyncRuntime()
+    ADB = AsyncDatabase(DB)
 
 # Variables
 TIMER_TEST_MODE = False
+# REMINDER_MODE=jobs starts one job queue job per debt instead of the reminder scheduler
+REMINDER_MODE = os.environ.get('REMINDER_MODE', 'scheduler')
+REMINDER_TICK = 30  # seconds between two runs of the reminder dispatch loop
+# REMINDER_DIGEST=0 sends one message per debt instead of one digest per user and tick
+REMINDER_DIGEST = os.environ.get('REMINDER_DIGEST', '1') == '1'
+# escalation: reminders every REMINDER_FAR_INTERVAL_DAYS until REMINDER_NEAR_DAYS before the
+# deadline, then every REMINDER_NEAR_INTERVAL_DAYS, after the deadline every REMINDER_OVERDUE_INTERVAL_DAYS
+REMINDER_POLICY = ReminderPolicy(
+    far_interval_days=int(os.environ.get('REMINDER_FAR_INTERVAL_DAYS', '7')),
+    near_days=int(os.environ.get('REMINDER_NEAR_DAYS', '7')),
+    near_interval_days=int(os.environ.get('REMINDER_NEAR_INTERVAL_DAYS', '1')),
+    overdue_interval_days=int(os.environ.get('REMINDER_OVERDUE_INTERVAL_DAYS', '1')))
+MESSAGE_MAX_LENGTH = 4096  # Telegram limit of a text message
 BOT_HTTP_TOKEN = os.environ.get('schuldestmirbot')
 
+# Webhook settings
+# WEBHOOK_URL=https://host/webhook receives updates over HTTP instead of long polling
+WEBHOOK_URL = os.environ.get('WEBHOOK_URL')
+WEBHOOK_SECRET = os.environ.get('WEBHOOK_SECRET', '')
+WEBHOOK_LISTEN = os.environ.get('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.environ.get('WEBHOOK_PORT', '8443'))
+WEBHOOK_PATH = os.environ.get('WEBHOOK_PATH', '/webhook')
+
 # Range Array for conversation handler
 [USER_SELECTION, CATEGORY_SELECTION,
  AMOUNT_SELECTION, CALENDAR_SELECTION,
  CHOOSING_DEBT, ASK_IF_DEBT_IS_PAID,
  CHOOSING_CLAIM, ASK_IF_CLAIM_IS_PAID] = range(8)
 
-UPDATER = Updater(BOT_HTTP_TOKEN, use_context=True)
+UPDATER = Updater(BOT_HTTP_TOKEN, use_context=True, workers=DISPATCHER_WORKERS)
+if TRACER is not None:
+    tracing.instrument_request(UPDATER.bot.request)
+
+# rate limited delivery of messages that are not a direct reply (reminders, notifications),
+# shards split the global limit
+OUTBOX = OutboundQueue(UPDATER.bot, global_rate=30 / SHARD_COUNT)
+
+# cached debtor selection keyboards for /schuld
+KEYBOARDS = UserKeyboards(DB)
+
+# local message channel to the other shards, local mutations are forwarded to them
+# (outbox files shard-<i>-to-<peer>.outbox in the same folder as the database)
+CHANNEL = None
+if SHARD_INDEX is not None:
+    CHANNEL = ShardChannel(SHARD_INDEX, SHARD_COUNT, DB, shard_authkey(BOT_HTTP_TOKEN),
+                           os.environ.get('SHARD_SOCKET_DIR', '.'))
+    DB.on_record = CHANNEL.publish
+
+
+def _send_reminder_(debt_id):
+    """
+    Sends the reminder of a debt, called by the reminder scheduler
+    Params: string debt_id
+    """
+    cur_debt = DB.get_debt_by_debt_id(debt_id)
+
+    if cur_debt is None or not cur_debt.is_accepted or cur_debt.is_paid:
+        REMINDERS.cancel(debt_id)
+        return
+
+    _send_alarm_(cur_debt)
+
+
+def _user_name_(chat_id):
+    """
+    Name of a user for reminder texts, "Unbekannt" if the user is missing
+    Params: string chat_id
+    """
+    user = DB.get_user_by_chat_id(chat_id)
+
+    if user is None:
+        LOGGER.warning('Reminder for unknown user %s', chat_id)
+        return "Unbekannt"
+
+    return str(user.name)
+
+
+def _send_digest_(debt_ids):
+    """
+    Sends one reminder message per user covering all of their due debts,
+    called by the reminder scheduler
+    Params: list debt_ids
+    """
+    lines_by_chat_id = {}
+    names = {}
+
+    def name_of(chat_id):
+        if chat_id not in names:
+            names[chat_id] = _user_name_(chat_id)
+        return names[chat_id]
+
+    for debt_id in debt_ids:
+        # one broken debt must not cost the other reminders of the tick
+        try:
+            cur_debt = DB.get_debt_by_debt_id(debt_id)
+
+            if cur_debt is None or not cur_debt.is_accepted or cur_debt.is_paid:
+                REMINDERS.cancel(debt_id)
+                continue
+
+            debt_text = str(cur_debt.amount) + " " + cur_debt.category
+            deadline = _format_deadline_(cur_debt) + _overdue_mark_(cur_debt)
+            creditor_line = (name_of(cur_debt.debtor) + " schuldet dir noch " + debt_text +
+                             " bis zum " + deadline)
+            debtor_line = ("Du schuldest " + name_of(cur_debt.creditor) + " noch " + debt_text +
+                           " bis zum " + deadline)
+
+        except Exception:  # pylint: disable=broad-except
+            LOGGER.exception('Reminder of debt %s failed', debt_id)
+            continue
+
+        lines_by_chat_id.setdefault(cur_debt.creditor, []).append(creditor_line)
+        lines_by_chat_id.setdefault(cur_debt.debtor, []).append(debtor_line)
+
+    for chat_id, lines in lines_by_chat_id.items():
+        for text in _split_message_("Erinnerung \U0001F4B8", lines):
+            OUTBOX.send_message(chat_id, priority=REMINDER, text=text)
+
+
+def _overdue_mark_(debt):
+    """
+    Marker appended to the deadline of reminders after the deadline
+    Params: Debt debt
+    """
+    if REMINDER_POLICY.stage(datetime.date.today().toordinal(),
+                             debt.deadline_ordinal) == ReminderPolicy.OVERDUE:
+        return " (überfällig)"
+    return ""
+
+
+def _split_message_(title, lines):
+    """
+    Joins lines into messages below the Telegram length limit
+    Params: string title
+            list lines
+    Returns: list of message texts
+    """
+    texts = []
+    text = title
+
+    for line in lines:
+        if len(text) + 1 + len(line) > MESSAGE_MAX_LENGTH:
+            texts.append(text)
+            text = title
+        text += "\n" + line
+
+    texts.append(text)
+    return texts
+
+
+# sets the time for TEST_MODE to 20 seconds, the schedule survives restarts
+REMINDERS = ReminderScheduler(_send_reminder_, interval=20 if TIMER_TEST_MODE else None,
+                              path_to_state=DB_NAME + ".reminders.json",
+                              send_digest=_send_digest_ if REMINDER_DIGEST else None,
+                              policy=REMINDER_POLICY)
 
 
 def start(update, context):
@@ -83,8 +329,8 @@ def start(update, context):
 
         else:
 
-            data_yes = json.dumps({'action': 'registration', 'data': True})
-            data_no = json.dumps({'action': 'registration', 'data': False})
+            data_yes = callback_data.encode(callback_data.REGISTRATION, True)
+            data_no = callback_data.encode(callback_data.REGISTRATION, False)
 
             # yes / no keyboard
             keyboard_yn = [[InlineKeyboardButton("\U0001F44D", callback_data=data_yes),
@@ -94,9 +340,6 @@ def start(update, context):
             update.message.reply_text(
                 "Möchtest Du dich registrieren?", reply_markup=reply_markup)
 
-            UPDATER.dispatcher.add_handler(
-                CallbackQueryHandler(handle_registration_response))
-
 
 def start_menu(update, context):
     """Start menu to select what you want to do (enter debts, - settle)
@@ -113,7 +356,7 @@ def start_menu(update, context):
         message_id=query.message.message_id,
         text="Bitte wähle dein Anliegen aus:\n")
 
-    context.bot.send_message(
+    OUTBOX.send_message(
         chat_id, text="Klicke auf \u27A1 /schuld um Schulden einzutragen...\n"
         "Klicke auf \u27A1 /ichSchulde um einzusehen, wem du was schuldest..."
         "\nKlicke auf \u27A1 /ichBekomme um einzusehen, was dir wer schuldet...",
@@ -132,8 +375,7 @@ def handle_registration_response(update, context):
     """
 
     query = update.callback_query
-    data = json.loads(update.callback_query.data)
-    user_response = data['data']
+    _, user_response, _ = callback_data.decode(query.data)
 
     # user clicks yes and will be registered
     if user_response:
@@ -163,17 +405,73 @@ def cancel(update, context):
     return ConversationHandler.END
 
 
-def _parse_time_(time):
+def _format_deadline_(debt):
     """
-    Conversion of the Deadline string to datetime object
-    Params: string time
-            Format: "YYYY:MM:DD"
+    Conversion of the deadline to display format "DD.MM.YYYY"
+    (the deadline is parsed once when the debt is loaded)
+    Params: Debt debt
     """
-    year = int(time[0] + time[1] + time[2] + time[3])
-    month = int(time[5] + time[6])
-    day = int(time[8] + time[9])
-    due = datetime.datetime(year, month, day)
-    return due
+    if debt.deadline_date is None:
+        return debt.deadline
+    return debt.deadline_date.strftime("%d.%m.%Y")
+
+
+def _route_(coroutine_function):
+    """
+    Returns the handler of a callback route for a coroutine handler: in ASYNC_MODE it submits
+    the coroutine to the event loop and returns immediately, otherwise it runs it to the end
+    on the calling thread (the adapters below don't suspend then, so no event loop is needed)
+    Params: Callable coroutine_function
+    """
+    if RUNTIME is None:
+        return lambda update, context: _run_now_(coroutine_function(update, context))
+    return lambda update, context: RUNTIME.submit(coroutine_function(update, context))
+
+
+def _run_now_(coroutine):
+    """
+    Runs a coroutine handler outside ASYNC_MODE, where its awaits complete at once
+    Params: Coroutine coroutine
+    """
+    try:
+        coroutine.send(None)
+    except StopIteration as stop:
+        return stop.value
+
+    coroutine.close()
+    raise RuntimeError('Coroutine handler suspended outside ASYNC_MODE')
+
+
+async def _blocking_(function, *args, **kwargs):
+    """
+    Awaits a blocking call (Bot API request, job queue) from a coroutine handler.
+    In ASYNC_MODE it runs on the I/O thread pool, so several calls can be awaited concurrently
+    Params: Callable function
+    """
+    if RUNTIME is None:
+        return function(*args, **kwargs)
+    return await RUNTIME.run_blocking(function, *args, **kwargs)
+
+
+async def _storage_(method_name, *args):
+    """
+    Awaits a database method from a coroutine handler, in ASYNC_MODE through ADB
+    (reads run concurrently, writes in order)
+    Params: string method_name
+    """
+    if ADB is None:
+        return getattr(DB, method_name)(*args)
+    return await getattr(ADB, method_name)(*args)
+
+
+async def _together_(*awaitables):
+    """
+    Awaits several calls, concurrently in ASYNC_MODE
+    Params: Awaitable awaitables
+    """
+    if RUNTIME is None:
+        return [await awaitable for awaitable in awaitables]
+    return await asyncio.gather(*awaitables)
 
 
 def _callback_alarm(context: CallbackContext):
@@ -181,19 +479,27 @@ def _callback_alarm(context: CallbackContext):
     Sends a message once the timer is triggered
     Params: CallbackContext context
     """
-    cur_debt = context.job.context
+    _send_alarm_(context.job.context)
+
 
+def _send_alarm_(cur_debt):
+    """
+    Queues the reminder of a debt for creditor and debtor
+    Params: Debt cur_debt
+    """
     creditor_cid = cur_debt.creditor
     debtor_cid = cur_debt.debtor
-    deadline_time = _parse_time_(cur_debt.deadline)
     debt_text = str(cur_debt.amount) + " " + cur_debt.category
 
-    deadline = deadline_time.strftime("%d.%m.%Y")
+    deadline = _format_deadline_(cur_debt) + _overdue_mark_(cur_debt)
+
+    creditor_name = _user_name_(creditor_cid)
+    debtor_name = _user_name_(debtor_cid)
 
-    context.bot.send_message(creditor_cid, text=str(DB.get_user_by_chat_id(
-        debtor_cid).name) + " schuldet dir noch " + str(debt_text) + " bis zum " + deadline)
-    context.bot.send_message(debtor_cid, text="Du schuldest " + str(DB.get_user_by_chat_id(
-        creditor_cid).name) + " noch " + str(debt_text) + " bis zum " + deadline)
+    OUTBOX.send_message(creditor_cid, priority=REMINDER, text=debtor_name +
+                        " schuldet dir noch " + str(debt_text) + " bis zum " + deadline)
+    OUTBOX.send_message(debtor_cid, priority=REMINDER, text="Du schuldest " + creditor_name +
+                        " noch " + str(debt_text) + " bis zum " + deadline)
 
 
 def start_timer(tele_updater: UPDATER, debt_id):
@@ -205,37 +511,49 @@ def start_timer(tele_updater: UPDATER, debt_id):
 
     cur_debt = DB.get_debt_by_debt_id(debt_id)
 
+    if REMINDER_MODE == 'scheduler':
+        REMINDERS.schedule(debt_id, deadline=cur_debt.deadline_ordinal)
+        return
+
     # Gets the current job queue of the dispatcher
     queue = tele_updater.dispatcher.job_queue
     time = datetime.time(hour=10, minute=0, second=0)
     test_interval = 20  # sets the time for TEST_MODE in seconds
 
+    # jobs are named by debt_id, see check_timers and stop_timer
     if TIMER_TEST_MODE:
-        queue.run_repeating(_callback_alarm, test_interval,
-                            0, context=cur_debt)
+        queue.run_repeating(_callback_alarm, test_interval, 0, context=cur_debt, name=debt_id)
 
     else:
-        queue.run_daily(_callback_alarm, time, context=cur_debt)
+        queue.run_daily(_callback_alarm, time, context=cur_debt, name=debt_id)
 
 
 def check_timers(tele_updater: UPDATER):
     '''
-    Checks whether each debt has a corresponding timer running
+    Checks whether each open debt has a corresponding timer running
+    (single pass over the open debts, timers are looked up by debt_id)
 
     Params: Updater tele_updater
     '''
-    debtlist = DB.debts
-    queue = tele_updater.dispatcher.job_queue
+    # names of the running jobs (debt_id), read once instead of get_jobs_by_name per debt
+    job_names = set()
+    if REMINDER_MODE != 'scheduler':
+        job_names = {job.name for job in tele_updater.dispatcher.job_queue.jobs()}
+
+    for debt in DB.get_all_open_debts():
 
-    for debt in debtlist:
-        job_exists = False
+        # reminders are sent by the shard of the debtor
+        if CHANNEL is not None and not CHANNEL.owns(debt.debtor):
+            continue
 
-        for ajob in queue.jobs():
-            if ajob.context.debt_id == debt.debt_id:
-                job_exists = True
-                break
+        if REMINDER_MODE == 'scheduler':
+            if debt.debt_id in REMINDERS:
+                # schedules saved before deadlines were kept
+                REMINDERS.set_deadline(debt.debt_id, debt.deadline_ordinal)
+            else:
+                start_timer(tele_updater, debt.debt_id)
 
-        if not job_exists and debt.is_accepted and not debt.is_paid:
+        elif debt.debt_id not in job_names:
 
             start_timer(tele_updater, debt.debt_id)
 
@@ -248,14 +566,32 @@ def stop_timer(tele_updater: UPDATER, debt_id):
             string debt_id
 
     """
-    queue = tele_updater.dispatcher.job_queue
+    if REMINDER_MODE == 'scheduler':
+        return REMINDERS.cancel(debt_id)
+
+    jobs = tele_updater.dispatcher.job_queue.get_jobs_by_name(debt_id)
+
+    for job in jobs:
+        job.schedule_removal()
+
+    return bool(jobs)
+
+
+def _callback_reminders(context: CallbackContext):
+    """
+    Dispatch loop of the reminder scheduler, sends all due reminders
+    Params: CallbackContext context
+    """
+    REMINDERS.tick()
+
 
-    for ajob in queue.jobs():  # Iterates through all available jobs
-        jobdebt_id = ajob.context.debt_id
-        if jobdebt_id == debt_id:
-            ajob.schedule_removal()
-            return True
-    return False
+def _callback_archive(context: CallbackContext):
+    """
+    Moves settled debts to the archive once they are older than DB_ARCHIVE_AFTER_DAYS
+    Params: CallbackContext context
+    """
+    archived = DB.archive_settled(DB_ARCHIVE_AFTER_DAYS)
+    LOGGER.info("Archived %d settled debts", archived)
 
 
 def i_owe(update, context):
@@ -305,14 +641,13 @@ def send_debt_list_to_user(update, debts, text):
     buttons = []
 
     for debt in debts:
-        date_parts = debt.deadline.split(":")
-        deadline = f"{date_parts[2]}.{date_parts[1]}.{date_parts[0]}"
+        deadline = _format_deadline_(debt)
         buttons.append(
             [
                 InlineKeyboardButton(
                     f'{debt.category} - {debt.amount} an '
                     f'{DB.get_user_by_chat_id(debt.creditor).name} bis {deadline}',
-                    callback_data=debt.debt_id)
+                    callback_data=callback_data.encode(callback_data.SELECT_DEBT, debt_id=debt.debt_id))
             ]
         )
 
@@ -347,19 +682,15 @@ def handle_ask_if_debt_is_paid(update, context):
         ConversationHandler.END -- call to end the conversation handling
     '''
 
-    update_data = json.loads(update.callback_query.data)
-
-    is_paid = update_data['paid']
-    debt_id = update_data['id']
+    _, is_paid, debt_id = callback_data.decode(update.callback_query.data)
 
     debt = DB.get_debt_by_debt_id(debt_id)
     creditor = DB.get_user_by_chat_id(debt.creditor).name
     debtor = DB.get_user_by_chat_id(debt.debtor).name
 
-    data_yes = json.dumps({'p': True, 'id': debt_id})
-    data_no = json.dumps({'p': False, 'id': debt_id})
+    data_yes = callback_data.encode(callback_data.CONFIRM_PAID, True, debt_id)
+    data_no = callback_data.encode(callback_data.CONFIRM_PAID, False, debt_id)
 
-    print(data_yes, data_no)
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton('\U0001F44D', callback_data=data_yes),
                                       InlineKeyboardButton('\U0001F44E', callback_data=data_no)]])
 
@@ -367,10 +698,9 @@ def handle_ask_if_debt_is_paid(update, context):
         update.effective_message.edit_text(
             f'{creditor} wird verständigt.')
 
-        date_parts = debt.deadline.split(":")
-        deadline = f"{date_parts[2]}.{date_parts[1]}.{date_parts[0]}"
+        deadline = _format_deadline_(debt)
 
-        context.bot.send_message(
+        OUTBOX.send_message(
             chat_id=debt.creditor,
             text=f'Wurde die Schuld über {debt.category} - {debt.amount} mit der'
             f' Frist zum {deadline} von {debtor} beglichen?',
@@ -392,8 +722,9 @@ def ask_if_debt_paid(update):
 
     '''
 
-    data_yes = json.dumps({'paid': True, 'id': update.callback_query.data})
-    data_no = json.dumps({'paid': False, 'id': update.callback_query.data})
+    _, _, debt_id = callback_data.decode(update.callback_query.data)
+    data_yes = callback_data.encode(callback_data.ASK_PAID, True, debt_id)
+    data_no = callback_data.encode(callback_data.ASK_PAID, False, debt_id)
 
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton('\U0001F44D', callback_data=data_yes),
                                       InlineKeyboardButton('\U0001F44E', callback_data=data_no)]])
@@ -402,7 +733,7 @@ def ask_if_debt_paid(update):
         'Hast du die Schuld bereits beglichen?', reply_markup=keyboard)
 
 
-def handle_accept_debt_is_paid(update, context):
+async def handle_accept_debt_is_paid(update, context):
     '''Handles the 'yes'/'no' buttons on the creditors side.
     On confirmation the debt will be marked as paid,
     otherwise the user gets notified that the creditor declined his request.
@@ -415,28 +746,31 @@ def handle_accept_debt_is_paid(update, context):
 
     '''
 
-    update_data = json.loads(update.callback_query.data)
+    _, is_paid, debt_id = callback_data.decode(update.callback_query.data)
 
-    is_paid = update_data['p']
-    debt_id = update_data['id']
+    debt = await _storage_('set_paid', debt_id, is_paid)
 
-    debt = DB.get_debt_by_debt_id(debt_id)
+    if debt is None:
+        # archived or unknown, e.g. an old button
+        await _blocking_(update.effective_message.edit_text, 'Diese Schuld ist bereits erledigt.')
+        return ConversationHandler.END
 
-    DB.set_paid(debt_id, is_paid)
+    if DB_WAIT_DURABLE:
+        await _storage_('wait_durable')
 
     if is_paid:
-        update.effective_message.edit_text(
-            'Die Schuld ist nun als beglichen markiert.')
-
-        stop_timer(UPDATER, debt_id)
+        await _together_(
+            _blocking_(update.effective_message.edit_text, 'Die Schuld ist nun als beglichen markiert.'),
+            _blocking_(stop_timer, UPDATER, debt_id))
 
     else:
-        update.effective_message.edit_text(
-            'Der Schuldner wurde benachrichtigt. Die Schuld ist noch nicht beglichen.')
-        context.bot.send_message(
+        creditor = await _storage_('get_user_by_chat_id', debt.creditor)
+        OUTBOX.send_message(
             chat_id=debt.debtor,
-            text=f'{DB.get_user_by_chat_id(debt.creditor).name}'
+            text=f'{creditor.name}'
             f' hat deine Anfrage zum Begleichen von {debt.category} - {debt.amount} nicht akzeptiert.')
+        await _blocking_(update.effective_message.edit_text,
+                         'Der Schuldner wurde benachrichtigt. Die Schuld ist noch nicht beglichen.')
 
     return ConversationHandler.END
 
@@ -491,15 +825,20 @@ def handle_ask_if_claim_is_paid(update, context):
         ConversationHandler.END -- call to end the conversation handling
     '''
 
-    update_data = json.loads(update.callback_query.data)
-    is_paid = update_data['paid']
+    _, is_paid, debt_id = callback_data.decode(update.callback_query.data)
 
-    DB.set_paid(update_data['id'], is_paid)
+    if DB.set_paid(debt_id, is_paid) is None:
+        # archived or unknown, e.g. an old button
+        update.effective_message.edit_text('Diese Schuld ist bereits erledigt.')
+        return ConversationHandler.END
+
+    if DB_WAIT_DURABLE:
+        DB.wait_durable()
 
     if is_paid:
         update.effective_message.edit_text(
             'Die Schuld wurde als beglichen markiert')
-        stop_timer(UPDATER, update_data['id'])
+        stop_timer(UPDATER, debt_id)
     else:
         update.effective_message.edit_text('Ok')
 
@@ -525,13 +864,12 @@ def send_claim_list_to_user(update, claims, text):
         return False
     buttons = []
     for debt in claims:
-        date_parts = debt.deadline.split(":")
-        deadline = f"{date_parts[2]}.{date_parts[1]}.{date_parts[0]}"
+        deadline = _format_deadline_(debt)
 
         buttons.append([InlineKeyboardButton(
             f'{debt.category} - {debt.amount} von {(DB.get_user_by_chat_id(debt.debtor)).name} '
             f'bis {deadline}',
-            callback_data=debt.debt_id)])
+            callback_data=callback_data.encode(callback_data.SELECT_DEBT, debt_id=debt.debt_id))])
 
     update.effective_message.reply_text(
         text, reply_markup=InlineKeyboardMarkup(buttons))
@@ -548,8 +886,9 @@ def ask_if_claim_paid(update):
 
     '''
 
-    data_yes = json.dumps({'paid': True, 'id': update.callback_query.data})
-    data_no = json.dumps({'paid': False, 'id': update.callback_query.data})
+    _, _, debt_id = callback_data.decode(update.callback_query.data)
+    data_yes = callback_data.encode(callback_data.ASK_PAID, True, debt_id)
+    data_no = callback_data.encode(callback_data.ASK_PAID, False, debt_id)
 
     keyboard = InlineKeyboardMarkup([[InlineKeyboardButton('\U0001F44D', callback_data=data_yes),
                                       InlineKeyboardButton('\U0001F44E', callback_data=data_no)]])
@@ -569,34 +908,12 @@ def cancel_define_debt(update, context):
     return ConversationHandler.END
 
 
-def is_user(user):
-    """
-    returns True if "user" is part of registered user list
-    """
-    for _, listobject in enumerate(get_user_list()):
-        if listobject[1] == user:
-            return True
-    return False
-
-
 def get_chat_id(user):
     """
-    returns the chat id of "user" by accessing user list array
+    returns the chat id of "user", "" if no user has that name (index lookup)
     """
-    for _, listobject in enumerate(get_user_list()):
-        if listobject[1] == user:
-            return listobject[0]
-    return ""
-
-
-def get_user_list():
-    """
-    returns array of user tuples with chat id and username
-    """
-    users = []
-    for user in DB.users:
-        users.append([user.chat_id, user.name])
-    return users
+    found = DB.get_user_by_name(user)
+    return found.chat_id if found is not None else ""
 
 
 def new_debt(update, context):
@@ -610,14 +927,10 @@ def new_debt(update, context):
     if DB.user_exists(chat_id):
 
         context.user_data.clear()
-        reply_keyboard = [["Abbrechen ✖"]]
-        for _, user in enumerate(get_user_list()):  # adds every user to array
-            # makes sure active user does not get listed
-            if update.effective_chat.id != int(user[0]):
-                reply_keyboard.append(["👤 " + user[1]])
-        markup = ReplyKeyboardMarkup(reply_keyboard, one_time_keyboard=True)
+        # top contacts, all users are one button (or a typed name) away
         update.message.reply_text(
-            "Bitte wähle einen Benutzer aus:", reply_markup=markup)
+            "Bitte wähle einen Benutzer aus oder gib einen Namen ein:",
+            reply_markup=KEYBOARDS.contacts_keyboard(chat_id))
         return USER_SELECTION
 
     start(update, context)
@@ -630,9 +943,12 @@ def user_selection(update, context):
     --> sends category keyboard
     """
     text = str(update.message.text).replace("👤 ", "")
+    chat_id = str(update.effective_chat.id)
+    debtor = DB.get_user_by_name(text)
 
-    if is_user(text) and int(get_chat_id(text)) != update.effective_chat.id:
+    if debtor is not None and debtor.chat_id != chat_id:
         context.user_data["debtor"] = text
+        context.user_data["debtor_id"] = debtor.chat_id
 
         reply_keyboard = [
             ["Getränke 🍻", "Essen 🍕", "Mobilität 🚗"],
@@ -647,6 +963,14 @@ def user_selection(update, context):
 
         return CATEGORY_SELECTION
 
+    # search for similar names
+    names = KEYBOARDS.search(text, chat_id)
+
+    if names:
+        update.message.reply_text(
+            "Meintest du einen dieser Benutzer?", reply_markup=KEYBOARDS.search_keyboard(names))
+        return USER_SELECTION
+
     update.message.reply_text(
         f"Tut uns leid, aber wir konnten '{text}' leider nicht in unserer Datenbank finden."
         "\nDu kannst es aber gerne erneut versuchen.")
@@ -654,6 +978,19 @@ def user_selection(update, context):
     return USER_SELECTION
 
 
+def user_selection_page(update, context):
+    """
+    called when the user opens the list of all users or turns a page of it
+    """
+    match = PAGE_BUTTON_PATTERN.match(update.message.text)
+    page = int(match.group(1)) - 1 if match else 0
+
+    update.message.reply_text(
+        f"Seite {page + 1}:", reply_markup=KEYBOARDS.keyboard(str(update.effective_chat.id), page))
+
+    return USER_SELECTION
+
+
 def category_selection_back(update, context):
     """
     removes debtor from userdata
@@ -824,22 +1161,26 @@ def calendar_selection(update, context):
 
     # sends overview of the debt
     creditor_id = str(update.message.from_user.id)
-    debtor_id = get_chat_id(context.user_data["debtor"])
+    debtor_id = context.user_data.get("debtor_id") or get_chat_id(context.user_data["debtor"])
     debt = [context.user_data["debt"], context.user_data["amount"]]
+
+    # Save debt to json file
+    schuld_obj = DB.add_debt(creditor_id, debt[0], debt[1], date[0], debtor_id)
+
+    # confirm only once the debt is stored durably
+    if DB_WAIT_DURABLE:
+        DB.wait_durable()
+
     update.message.reply_text(f"Folgende Schuld "
                               f"wurde in Auftrag gegeben:\n"
                               f"Schuldner: {context.user_data['debtor']}\n"
                               f"Schuld: {debt[0]} - {debt[1]}\n"
                               f"Deadline: {date[1]}", reply_markup=get_start_keyboard())
 
-    # Save debt to json file
-    print(date)
-    schuld_obj = DB.add_debt(creditor_id, debt[0], debt[1], date[0], debtor_id)
-
     # Send message to prospective debtor
 
-    data_yes = json.dumps({'1': True, 'id': schuld_obj.debt_id})
-    data_no = json.dumps({'1': False, 'id': schuld_obj.debt_id})
+    data_yes = callback_data.encode(callback_data.ACCEPT_DEBT, True, schuld_obj.debt_id)
+    data_no = callback_data.encode(callback_data.ACCEPT_DEBT, False, schuld_obj.debt_id)
     keyboard = InlineKeyboardMarkup(
         [
             [InlineKeyboardButton(
@@ -850,11 +1191,12 @@ def calendar_selection(update, context):
         ]
     )
 
-    context.bot.send_message(chat_id=debtor_id, text=f"Willst Du folgende Schuld annehmen?\n"
-                             f"Gläubiger: {DB.get_user_by_chat_id(creditor_id).name}\n"
-                             f"Schuld {debt[0]} - {debt[1]}\n"
-                             f"Deadline: {date[1]}",
-                             reply_markup=keyboard)
+    OUTBOX.send_message(chat_id=debtor_id, priority=INTERACTIVE,
+                        text=f"Willst Du folgende Schuld annehmen?\n"
+                        f"Gläubiger: {DB.get_user_by_chat_id(creditor_id).name}\n"
+                        f"Schuld {debt[0]} - {debt[1]}\n"
+                        f"Deadline: {date[1]}",
+                        reply_markup=keyboard)
 
     context.user_data.clear()
     return ConversationHandler.END
@@ -914,7 +1256,7 @@ def date_handler(deadline):
     return None
 
 
-def handle_accept_debt(update, context):
+async def handle_accept_debt(update, context):
     """
     handles user input from acccept/deny debt
     if accept --> start timer
@@ -922,25 +1264,29 @@ def handle_accept_debt(update, context):
 
     """
 
-    query = json.loads(update.callback_query.data)
-    is_accepted = query['1']
-    debt_id = query['id']
+    _, is_accepted, debt_id = callback_data.decode(update.callback_query.data)
 
-    debt = DB.get_debt_by_debt_id(debt_id)
+    debt = await _storage_('set_accepted', debt_id, is_accepted)
 
-    DB.set_accepted(debt_id, is_accepted)
+    if debt is None:
+        # archived or unknown, e.g. an old button
+        await _blocking_(update.effective_message.edit_text, 'Diese Schuld ist bereits erledigt.')
+        return
 
-    if is_accepted:
-        update.effective_message.edit_text("Du hast die Schuld angenommen.")
+    if DB_WAIT_DURABLE:
+        await _storage_('wait_durable')
 
-        start_timer(UPDATER, debt_id)
+    if is_accepted:
+        await _together_(
+            _blocking_(update.effective_message.edit_text, "Du hast die Schuld angenommen."),
+            _blocking_(start_timer, UPDATER, debt_id))
 
     else:
-        update.effective_message.edit_text("Du hast die Schuld abgelehnt.")
-
-        context.bot.send_message(
-            chat_id=debt.creditor, text=f"{DB.get_user_by_chat_id(debt.debtor).name}"
+        debtor = await _storage_('get_user_by_chat_id', debt.debtor)
+        OUTBOX.send_message(
+            chat_id=debt.creditor, text=f"{debtor.name}"
             f" hat die Schuld über {debt.category} - {debt.amount} abgelehnt.")
+        await _blocking_(update.effective_message.edit_text, "Du hast die Schuld abgelehnt.")
 
 
 def done(update, context):
@@ -955,25 +1301,29 @@ def done(update, context):
 
 def callback_general(update, context):
     """
-    General callback handler for debt is paid, registration and accept debt.
+    General callback handler for debt is paid, registration and accept debt,
+    routed by the action code of the button
     """
 
-    callback_data = json.loads(update.callback_query.data)
-    action = ""
-    if "action" in callback_data:
-        action = callback_data["action"]
+    try:
+        action, _, _ = callback_data.decode(update.callback_query.data)
+    except ValueError as decode_error:
+        # not a button of this bot, e.g. forged callback data
+        LOGGER.warning('Callback ignored: %s', decode_error)
+        return
+
+    handler = CALLBACK_ROUTES.get(action)
 
-    # handle accept debt as paid
-    if "p" in callback_data:
-        handle_accept_debt_is_paid(update, context)
+    if handler is not None:
+        handler(update, context)
 
-    # handle registration
-    if action == "registration":
-        handle_registration_response(update, context)
 
-    # handle_accept_debt
-    if "1" in callback_data:
-        handle_accept_debt(update, context)
+# action code -> handler of the buttons outside of conversations
+CALLBACK_ROUTES = {
+    callback_data.CONFIRM_PAID: _route_(handle_accept_debt_is_paid),
+    callback_data.REGISTRATION: handle_registration_response,
+    callback_data.ACCEPT_DEBT: _route_(handle_accept_debt),
+}
 
 
 def error(update, context):
@@ -1007,9 +1357,10 @@ def cancel_i_owe(update, context):
     return ConversationHandler.END
 
 
-def main():
+def add_handlers(dispatcher):
     """
-    Main function: contains handlers, starts the dispatcher
+    Registers the handlers of the bot
+    Params: Dispatcher dispatcher
     """
 
     se_conv_handler = ConversationHandler(
@@ -1038,6 +1389,10 @@ def main():
                                             i_get),
                              MessageHandler(Filters.regex("^/start"),
                                             start),
+                             MessageHandler(Filters.regex(PAGE_BUTTON_PATTERN),
+                                            user_selection_page),
+                             MessageHandler(Filters.regex("^" + ALL_USERS_BUTTON + "$"),
+                                            user_selection_page),
                              MessageHandler(Filters.text,
                                             user_selection),
                              ],
@@ -1108,16 +1463,15 @@ def main():
         fallbacks=[MessageHandler(Filters.regex("^Done$"), done)]
     )
 
-    # Timer debt check
-    check_timers(UPDATER)
-
     # Handler /ichSchulde
     i_owe_handler = ConversationHandler(
         entry_points=[CommandHandler("ichSchulde", i_owe)],
         states={
-            CHOOSING_DEBT: [CallbackQueryHandler(handle_choosing_debt)],
+            CHOOSING_DEBT: [CallbackQueryHandler(handle_choosing_debt,
+                                                 pattern=callback_data.pattern(callback_data.SELECT_DEBT))],
             ASK_IF_DEBT_IS_PAID: [
-                CallbackQueryHandler(handle_ask_if_debt_is_paid)]
+                CallbackQueryHandler(handle_ask_if_debt_is_paid,
+                                     pattern=callback_data.pattern(callback_data.ASK_PAID))]
         },
         fallbacks=[CommandHandler("abbrechenIchSchulde", cancel_i_owe)]
     )
@@ -1126,32 +1480,183 @@ def main():
     i_get_handler = ConversationHandler(
         entry_points=[CommandHandler("ichBekomme", i_get)],
         states={
-            CHOOSING_CLAIM: [CallbackQueryHandler(handle_choosing_claim)],
+            CHOOSING_CLAIM: [CallbackQueryHandler(handle_choosing_claim,
+                                                  pattern=callback_data.pattern(callback_data.SELECT_DEBT))],
             ASK_IF_CLAIM_IS_PAID: [
-                CallbackQueryHandler(handle_ask_if_claim_is_paid)]
+                CallbackQueryHandler(handle_ask_if_claim_is_paid,
+                                     pattern=callback_data.pattern(callback_data.ASK_PAID))]
         },
         fallbacks=[CommandHandler("abbrechenIchBekomme", cancel_i_get)]
     )
 
-    UPDATER.dispatcher.add_handler(CommandHandler("start", start))
+    dispatcher.add_handler(CommandHandler("start", start))
 
-    UPDATER.dispatcher.add_handler(se_conv_handler)
+    dispatcher.add_handler(se_conv_handler)
 
-    UPDATER.dispatcher.add_handler(i_owe_handler)
-    UPDATER.dispatcher.add_handler(i_get_handler)
+    dispatcher.add_handler(i_owe_handler)
+    dispatcher.add_handler(i_get_handler)
 
     # log all errors
-    UPDATER.dispatcher.add_error_handler(error)
+    dispatcher.add_error_handler(error)
+
+    dispatcher.add_handler(CallbackQueryHandler(callback_general))
+
+    if ASYNC_MODE:
+        # conversation steps run on the dispatcher's worker pool, the conversation
+        # handler resolves their next state when they finish
+        for conversation in (se_conv_handler, i_owe_handler, i_get_handler):
+            for handler in metrics.iter_handlers([conversation]):
+                handler.run_async = True
+
+    for handlers in dispatcher.handlers.values():
+        metrics.instrument_handlers(handlers, HANDLER_SECONDS, HANDLER_ERRORS)
+
+    if TRACER is not None:
+        for handlers in dispatcher.handlers.values():
+            tracing.instrument_handlers(handlers)
+        TRACER.instrument_dispatcher(dispatcher)
+
+    metrics.function('bot_update_queue_depth', 'Updates waiting for the dispatcher', 'gauge',
+                     dispatcher.update_queue.qsize)
+    metrics.function('bot_job_queue_depth', 'Scheduled job queue jobs', 'gauge',
+                     lambda: len(dispatcher.job_queue.jobs()))
+
+
+def _apply_shard_record_(record):
+    """
+    Applies a mutation of another shard, stops the reminders of debts settled there
+    Params: dict record
+    """
+    DB.apply_record(record)
+
+    if ((record['op'] == 'set_paid' and record['value'])
+            or (record['op'] == 'set_accepted' and not record['value'])):
+        stop_timer(UPDATER, record['debt_id'])
+
+
+def run_shard():
+    """
+    Processes the updates the router forwards to this shard until SIGINT/SIGTERM
+    """
+    dispatcher = UPDATER.dispatcher
+    stopped = threading.Event()
+
+    for signal_number in (signal.SIGINT, signal.SIGTERM):
+        signal.signal(signal_number, lambda *_: stopped.set())
+
+    dispatcher.job_queue.start()
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher')
+    dispatcher_thread.start()
+
+    CHANNEL.serve(lambda update_as_dict: dispatcher.update_queue.put(
+        Update.de_json(update_as_dict, UPDATER.bot)), _apply_shard_record_)
+
+    stopped.wait()
+
+    CHANNEL.close()
+    dispatcher.job_queue.stop()
+    dispatcher.stop()
+    dispatcher_thread.join()
+
+
+def run_webhook():
+    """
+    Receives updates with the webhook server until Ctrl-C
+    """
+    dispatcher = UPDATER.dispatcher
+    server = WebhookServer(dispatcher, WEBHOOK_SECRET, listen=WEBHOOK_LISTEN, port=WEBHOOK_PORT,
+                           url_path=WEBHOOK_PATH)
+
+    dispatcher.job_queue.start()
+    dispatcher_thread = threading.Thread(target=dispatcher.start, name='dispatcher')
+    dispatcher_thread.start()
+
+    UPDATER.bot.set_webhook(url=WEBHOOK_URL, allowed_updates=["message", "callback_query"],
+                            api_kwargs={'secret_token': WEBHOOK_SECRET})
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        dispatcher.job_queue.stop()
+        dispatcher.stop()
+        dispatcher_thread.join()
+
+
+def main():
+    """
+    Main function: registers handlers and jobs, starts the dispatcher
+    (long polling or, with WEBHOOK_URL, webhook mode)
+    """
+
+    add_handlers(UPDATER.dispatcher)
+
+    # Timer debt check
+    check_timers(UPDATER)
+
+    metrics.function('bot_reminders_scheduled', 'Debts in the reminder schedule', 'gauge',
+                     lambda: len(REMINDERS))
+    metrics.function('bot_outbound_queue_depth', 'Messages waiting in the outbound queue', 'gauge',
+                     lambda: len(OUTBOX))
+
+    if TRACER is not None:
+        TRACER.start()
+
+    metrics_server = None
+    if METRICS_PORT:
+        metrics_server = metrics.MetricsServer(METRICS_LISTEN, METRICS_PORT)
+        metrics_server.start()
+
+    if REMINDER_MODE == 'scheduler':
+        UPDATER.dispatcher.job_queue.run_repeating(_callback_reminders, REMINDER_TICK, first=0)
+
+    # Archive settled debts now and every night
+    UPDATER.dispatcher.job_queue.run_once(_callback_archive, 0)
+    UPDATER.dispatcher.job_queue.run_daily(
+        _callback_archive, datetime.time(hour=3, minute=0, second=0))
+
+    # Start the event loop for coroutine handlers
+    if RUNTIME is not None:
+        RUNTIME.start()
+
+    OUTBOX.start()
+
+    if CHANNEL is not None:
+        run_shard()
+
+    elif WEBHOOK_URL:
+        run_webhook()
+
+    else:
+        # Start the Bot
+        UPDATER.start_polling()
+
+        # Run the bot until you press Ctrl-C or the process receives SIGINT,
+        # SIGTERM or SIGABRT. This should be used most of the time, since
+        # start_polling() is non-blocking and will stop the bot gracefully.
+        UPDATER.idle()
+
+    if RUNTIME is not None:
+        # finish the submitted handlers before the queues and the database close
+        RUNTIME.stop()
+        ADB.close()
+
+    OUTBOX.stop()
+
+    if metrics_server is not None:
+        metrics_server.stop()
 
-    UPDATER.dispatcher.add_handler(CallbackQueryHandler(callback_general))
+    if TRACER is not None:
+        TRACER.stop()
 
-    # Start the Bot
-    UPDATER.start_polling()
+    # write pending group commits and the reminder schedule
+    DB.close()
+    REMINDERS.save()
 
-    # Run the bot until you press Ctrl-C or the process receives SIGINT,
-    # SIGTERM or SIGABRT. This should be used most of the time, since
-    # start_polling() is non-blocking and will stop the bot gracefully.
-    UPDATER.idle()
+    if LOG_PIPELINE is not None:
+        LOG_PIPELINE.stop()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,350 @@
+"""
+Module: outbound
+
+Description:
+Rate limited delivery of outgoing messages.
+
+Messages are queued instead of being sent by the handler threads. Sender threads deliver
+them while respecting a global and a per-chat token bucket (Telegram allows about 30
+messages per second overall and 1 per second per chat). Interactive messages are sent before
+reminders, a "429 Too Many Requests" (RetryAfter) pauses sending for the requested time and
+transient network errors are retried with exponential backoff (a rejected message, BadRequest
+or Unauthorized, is not). The queue is bounded.
+
+The messages of a chat are delivered in the order they were queued: every chat belongs to
+one sender thread (hash of the chat id) and waits in a FIFO, and the next message of a
+chat is only sent when the previous one was sent or given up. The priority of a chat is
+the priority of its oldest message.
+
+Usage:
+
+outbox = OutboundQueue(bot)
+outbox.start()
+outbox.send_message(chat_id, text="...", priority=REMINDER)
+outbox.stop()                 # sends the queued messages for up to 10 seconds
+"""
+
+import collections
+import heapq
+import itertools
+import logging
+import threading
+import time
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, TelegramError, Unauthorized
+
+import metrics
+import tracing
+
+LOGGER = logging.getLogger(__name__)
+
+SEND_SECONDS = metrics.histogram('bot_outbound_send_seconds', 'Latency of sendMessage calls')
+SENT_MESSAGES = metrics.counter('bot_outbound_messages_total', 'Outgoing messages by result', ['result'])
+
+# priority lanes, lower is sent first
+INTERACTIVE = 0
+REMINDER = 1
+
+
+class TokenBucket:
+    """
+    The token bucket allows rate messages per second with bursts of up to capacity messages.
+    """
+
+    __slots__ = ('rate', 'capacity', 'tokens', 'updated')
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def wait_time(self, now):
+        """Returns the seconds until a token is available
+
+        Arguments:
+            now {Float} -- time.monotonic()
+
+        Returns:
+            Float -- 0 if a token is available
+        """
+
+        self._refill(now)
+        return 0 if self.tokens >= 1 else (1 - self.tokens) / self.rate
+
+    def take(self, now):
+        """Takes a token, call only if wait_time returned 0
+
+        Arguments:
+            now {Float} -- time.monotonic()
+        """
+
+        self._refill(now)
+        self.tokens -= 1
+
+    def is_full(self, now):
+        """Returns whether the bucket is full, i.e. it can be dropped without effect
+        """
+
+        self._refill(now)
+        return self.tokens >= self.capacity
+
+
+class _Sender:
+    """
+    Queued messages of the chats of one sender thread.
+    """
+
+    __slots__ = ('condition', 'lanes', 'chats')
+
+    def __init__(self, lock):
+        self.condition = threading.Condition(lock)
+        # one heap of (ready_at, seq, chat_id) per priority lane, one entry per chat
+        # that has a message to send
+        self.lanes = [[], []]
+        # chat_id -> FIFO of the chat's messages, the first one is the next (or in flight)
+        self.chats = {}
+
+    def push(self, chat_id, ready_at, seq):
+        """Makes a chat eligible for sending at ready_at, in the lane of its first message
+        """
+
+        heapq.heappush(self.lanes[self.chats[chat_id][0]['priority']], (ready_at, seq, chat_id))
+
+
+class OutboundQueue:
+    """
+    The outbound queue delivers messages through a Bot object with rate limits, priorities and retries.
+    """
+
+    def __init__(self, bot, global_rate=30, per_chat_rate=1, per_chat_burst=3, max_size=10000,
+                 max_retries=5, senders=4):
+        """
+        Arguments:
+            bot {telegram.Bot} -- Bot used for sending
+            global_rate {Float} -- Messages per second over all chats
+            per_chat_rate {Float} -- Messages per second per chat
+            per_chat_burst {Integer} -- Messages a chat may receive at once
+            max_size {Integer} -- Messages that can be queued, further messages are rejected
+            max_retries {Integer} -- Attempts per message on network errors
+            senders {Integer} -- Sender threads (sending blocks during the HTTP request)
+        """
+
+        self.bot = bot
+        self.per_chat_rate = per_chat_rate
+        self.per_chat_burst = per_chat_burst
+        self.max_size = max_size
+        self.max_retries = max_retries
+        self._global_bucket = TokenBucket(global_rate, global_rate)
+        self._chat_buckets = {}
+        self._size = 0
+        self._paused_until = 0
+        self._seq = itertools.count()
+        self._running = False
+        # time.monotonic() after which stop() discards the messages still queued
+        self._stop_at = None
+        self._lock = threading.Lock()
+        self._senders = [_Sender(self._lock) for _ in range(senders)]
+        self._threads = [threading.Thread(target=self._run, args=(sender,), name=f'outbound-{number}',
+                                          daemon=True)
+                         for number, sender in enumerate(self._senders)]
+
+    def __len__(self):
+        return self._size
+
+    def start(self):
+        """Starts the sender threads
+        """
+
+        self._running = True
+
+        for thread in self._threads:
+            thread.start()
+
+    def stop(self, timeout=10):
+        """Sends the queued messages for up to timeout seconds and stops the sender threads.
+        Messages still queued then are discarded.
+
+        Arguments:
+            timeout {Float} -- Seconds to keep sending
+        """
+
+        with self._lock:
+            self._running = False
+            self._stop_at = time.monotonic() + timeout
+            for sender in self._senders:
+                sender.condition.notify()
+
+        for thread in self._threads:
+            thread.join()
+
+        if self._size:
+            LOGGER.warning('Outbound queue stopped, %d messages discarded', self._size)
+
+    def _sender(self, chat_id):
+        return self._senders[hash(str(chat_id)) % len(self._senders)]
+
+    def send_message(self, chat_id, priority=INTERACTIVE, **kwargs):
+        """Queues a message, arguments as for Bot.send_message
+
+        Arguments:
+            chat_id {String} -- Telegram Chat_ID
+            priority {Integer} -- INTERACTIVE or REMINDER
+
+        Returns:
+            Boolean -- Message was queued, False if the queue is full
+        """
+
+        sender = self._sender(chat_id)
+
+        with self._lock:
+
+            if self._size >= self.max_size:
+                LOGGER.warning('Outbound queue full, message to %s dropped', chat_id)
+                SENT_MESSAGES.labels('dropped').inc()
+                return False
+
+            message = {'chat_id': chat_id, 'kwargs': kwargs, 'priority': priority, 'attempt': 0,
+                       'trace': tracing.current()}
+            self._size += 1
+            chat = sender.chats.get(chat_id)
+
+            if chat is not None:
+                # waits behind the earlier messages of the chat
+                chat.append(message)
+                return True
+
+            sender.chats[chat_id] = collections.deque([message])
+            sender.push(chat_id, time.monotonic(), next(self._seq))
+            sender.condition.notify()
+
+        return True
+
+    def _chat_bucket(self, chat_id, now):
+
+        bucket = self._chat_buckets.get(chat_id)
+
+        if bucket is None:
+            # forget chats that have been quiet for a while
+            if len(self._chat_buckets) > 10 * self.max_size:
+                self._chat_buckets = {key: value for key, value in self._chat_buckets.items()
+                                      if not value.is_full(now)}
+            bucket = self._chat_buckets[chat_id] = TokenBucket(self.per_chat_rate, self.per_chat_burst)
+
+        return bucket
+
+    def _next_message(self, sender):
+        """Waits for a message of the sender's chats that may be sent now.
+        The message stays first in its chat until _done. Caller holds the lock.
+
+        Returns:
+            Dictionary -- Message, None if the queue was stopped
+        """
+
+        while True:
+
+            now = time.monotonic()
+
+            if not self._running and (not sender.chats or now >= self._stop_at):
+                return None
+
+            wait = max(0, self._paused_until - now) or self._global_bucket.wait_time(now)
+
+            if wait == 0:
+                wait = None
+
+                for lane in sender.lanes:
+                    while lane and lane[0][0] <= now:
+                        _, seq, chat_id = heapq.heappop(lane)
+                        chat_bucket = self._chat_bucket(chat_id, now)
+                        chat_wait = chat_bucket.wait_time(now)
+
+                        if chat_wait == 0:
+                            chat_bucket.take(now)
+                            self._global_bucket.take(now)
+                            self._size -= 1
+                            return sender.chats[chat_id][0]
+
+                        # chat is rate limited, other chats may go first
+                        heapq.heappush(lane, (now + chat_wait, seq, chat_id))
+
+                    if lane:
+                        wait = lane[0][0] - now if wait is None else min(wait, lane[0][0] - now)
+
+            if not self._running:
+                wait = self._stop_at - now if wait is None else min(wait, self._stop_at - now)
+
+            sender.condition.wait(wait)
+
+    def _done(self, sender, message, retry_delay=None):
+        """Finishes the first message of a chat: it is sent again after retry_delay seconds,
+        or removed and the next message of the chat becomes eligible
+        """
+
+        chat_id = message['chat_id']
+
+        with self._lock:
+            chat = sender.chats[chat_id]
+
+            if retry_delay is not None:
+                message['attempt'] += 1
+                self._size += 1
+                sender.push(chat_id, time.monotonic() + retry_delay, next(self._seq))
+            else:
+                chat.popleft()
+                if chat:
+                    sender.push(chat_id, time.monotonic(), next(self._seq))
+                else:
+                    del sender.chats[chat_id]
+
+    def _run(self, sender):
+
+        while True:
+
+            with self._lock:
+                message = self._next_message(sender)
+
+            if message is None:
+                return
+
+            start = time.perf_counter()
+            retry_delay = None
+
+            try:
+                with tracing.activate(message['trace']), \
+                        tracing.span('send_message', 'outbound', attempt=message['attempt']):
+                    self.bot.send_message(message['chat_id'], **message['kwargs'])
+                SENT_MESSAGES.labels('sent').inc()
+
+            except RetryAfter as flood_error:
+                # Telegram asks to slow down: pause all senders
+                SENT_MESSAGES.labels('retry_after').inc()
+                with self._lock:
+                    self._paused_until = time.monotonic() + flood_error.retry_after
+                retry_delay = flood_error.retry_after
+
+            except (BadRequest, Unauthorized) as final_error:
+                # BadRequest is a NetworkError, but sending again fails the same way
+                # (chat not found, message too long, bot blocked)
+                SENT_MESSAGES.labels('failed').inc()
+                LOGGER.error('Message to %s failed: %s', message['chat_id'], final_error)
+
+            except NetworkError as network_error:
+                if message['attempt'] + 1 >= self.max_retries:
+                    SENT_MESSAGES.labels('failed').inc()
+                    LOGGER.error('Giving up message to %s: %s', message['chat_id'], network_error)
+                else:
+                    SENT_MESSAGES.labels('retried').inc()
+                    retry_delay = 2 ** message['attempt']
+
+            except TelegramError as telegram_error:
+                SENT_MESSAGES.labels('failed').inc()
+                LOGGER.error('Message to %s failed: %s', message['chat_id'], telegram_error)
+
+            finally:
+                SEND_SECONDS.observe(time.perf_counter() - start)
+                self._done(sender, message, retry_delay)
@@ -0,0 +1,404 @@
+"""
+Module: reminders
+
+Description:
+Scheduler for debt reminders.
+
+Instead of one job per debt, all due reminders are kept in a heap keyed by their next
+fire time. A single dispatch loop (one repeating job) calls tick(), which pops only the
+reminders that are due and schedules them again. Per debt the scheduler keeps one heap
+entry and two small dictionary entries.
+
+Usage:
+
+scheduler = ReminderScheduler(send_reminder)      send_reminder(debt_id) sends the messages
+scheduler.schedule(debt_id)
+scheduler.tick()                                  called regularly, e.g. every minute
+scheduler.cancel(debt_id)
+
+With a ReminderPolicy and a deadline per debt (schedule(debt_id, deadline=...)), the
+interval between reminders depends on the time left until the deadline, e.g. weekly
+until a week before the deadline, then daily. The heap stays the only index: it is
+sorted by the next fire time the policy computed, so a tick touches due debts only.
+
+With send_digest, tick() hands all reminders due in the same tick to one call
+(send_digest(debt_ids)), so they can be batched into one message per user.
+
+With path_to_state the schedule (next fire time and last sent time per debt) is saved
+after each tick that changed it and loaded lazily on first use after a restart.
+Reminders missed while the bot was down are sent once, not once per missed day, and
+only in the daily send window (reminder_time to send_until): after a restart at night
+they wait for the next reminder_time.
+"""
+
+import datetime
+import heapq
+import json
+import os
+import threading
+import time
+
+
+def next_daily(after, at_time):
+    """Returns the next point in time at a given time of day.
+
+    Arguments:
+        after {Float} -- Timestamp
+        at_time {datetime.time} -- Time of day (local time)
+
+    Returns:
+        Float -- Timestamp of the next at_time after "after"
+    """
+
+    after_datetime = datetime.datetime.fromtimestamp(after)
+    candidate = datetime.datetime.combine(after_datetime.date(), at_time)
+
+    if candidate <= after_datetime:
+        candidate += datetime.timedelta(days=1)
+
+    return candidate.timestamp()
+
+
+class ReminderPolicy:
+    """
+    The reminder policy escalates the reminder frequency as the deadline approaches.
+    """
+
+    UPCOMING = 'upcoming'
+    DUE_SOON = 'due_soon'
+    OVERDUE = 'overdue'
+
+    def __init__(self, far_interval_days=7, near_days=7, near_interval_days=1, overdue_interval_days=1):
+        """
+        Arguments:
+            far_interval_days {Integer} -- Days between reminders until near_days before the deadline
+            near_days {Integer} -- Days before the deadline from which near_interval_days applies
+            near_interval_days {Integer} -- Days between reminders close to the deadline
+            overdue_interval_days {Integer} -- Days between reminders after the deadline
+        """
+
+        for name, days in (('far_interval_days', far_interval_days), ('near_interval_days', near_interval_days),
+                           ('overdue_interval_days', overdue_interval_days)):
+            if days < 1:
+                raise ValueError(f'{name} must be at least 1 day, got {days}')
+
+        if near_days < 0:
+            raise ValueError(f'near_days must not be negative, got {near_days}')
+
+        self.far_interval_days = far_interval_days
+        self.near_days = near_days
+        self.near_interval_days = near_interval_days
+        self.overdue_interval_days = overdue_interval_days
+
+    def stage(self, day, deadline):
+        """Returns the stage of a debt on a day
+
+        Arguments:
+            day {Integer} -- Ordinal date
+            deadline {Integer} -- Ordinal date of the deadline, None if unknown
+
+        Returns:
+            String -- UPCOMING, DUE_SOON or OVERDUE
+        """
+
+        if deadline is None:
+            return self.DUE_SOON
+        if day > deadline:
+            return self.OVERDUE
+        if deadline - day <= self.near_days:
+            return self.DUE_SOON
+        return self.UPCOMING
+
+    def next_day(self, day, deadline):
+        """Returns the day of the next reminder
+
+        Arguments:
+            day {Integer} -- Ordinal date of the earliest possible reminder
+            deadline {Integer} -- Ordinal date of the deadline, None if unknown (daily reminders)
+
+        Returns:
+            Integer -- Ordinal date
+        """
+
+        stage = self.stage(day, deadline)
+
+        if stage == self.UPCOMING:
+            # never skip the first day of the near window
+            return min(day + self.far_interval_days - 1, deadline - self.near_days)
+        if stage == self.OVERDUE:
+            return day + self.overdue_interval_days - 1
+        return day + self.near_interval_days - 1
+
+
+class ReminderScheduler:
+    """
+    The reminder scheduler keeps the next fire time of every reminder
+    and dispatches the due ones.
+    """
+
+    def __init__(self, send_reminder, reminder_time=datetime.time(hour=10), interval=None,
+                 path_to_state=None, send_digest=None, policy=None, send_until=datetime.time(hour=21)):
+        """
+        Arguments:
+            send_reminder {Callable} -- Called with the debt_id of each due reminder
+            send_digest {Callable} -- Called once per tick with the list of due debt_ids,
+                                      replaces send_reminder
+            reminder_time {datetime.time} -- Daily time of the reminders
+            interval {Float} -- Seconds between reminders instead of daily (test mode)
+            path_to_state {String} -- JSON file the schedule is kept in across restarts
+            policy {ReminderPolicy} -- Escalation by deadline, default: daily reminders
+            send_until {datetime.time} -- End of the daily window missed reminders are sent in
+        """
+
+        self.send_reminder = send_reminder
+        self.send_digest = send_digest
+        self.reminder_time = reminder_time
+        self.send_until = send_until
+        self.interval = interval
+        self.path_to_state = path_to_state
+        self.policy = policy
+        self._heap = []
+        # debt_id -> next fire time; heap entries that don't match are outdated
+        self._next_fire = {}
+        # debt_id -> time the last reminder was sent
+        self._last_sent = {}
+        # debt_id -> ordinal date of the deadline
+        self._deadlines = {}
+        self._loaded = path_to_state is None
+        self._dirty = False
+        self._lock = threading.Lock()
+        self._save_lock = threading.Lock()
+
+    def __len__(self):
+        with self._lock:
+            self._load()
+            return len(self._next_fire)
+
+    def __contains__(self, debt_id):
+        with self._lock:
+            self._load()
+            return debt_id in self._next_fire
+
+    def _load(self):
+        """Loads the saved schedule on first use. Missed reminders are coalesced
+        into one reminder in the next send window. Caller holds the lock.
+        """
+
+        if self._loaded:
+            return
+
+        self._loaded = True
+
+        try:
+            with open(self.path_to_state) as state_file:
+                state = json.load(state_file)
+        except (FileNotFoundError, json.decoder.JSONDecodeError):
+            return
+
+        now = time.time()
+        window = self._next_window(now)
+
+        for debt_id, (fire_at, last_sent, *deadline) in state['reminders'].items():
+            self._next_fire[debt_id] = fire_at if fire_at >= now else window
+            if last_sent is not None:
+                self._last_sent[debt_id] = last_sent
+            if deadline and deadline[0] is not None:
+                self._deadlines[debt_id] = deadline[0]
+
+        self._heap = [(fire_at, debt_id) for debt_id, fire_at in self._next_fire.items()]
+        heapq.heapify(self._heap)
+
+    def _next_window(self, now):
+        """Returns when a missed reminder may be sent: now during the send window of the day,
+        the next reminder_time otherwise
+        """
+
+        if self.interval is not None:
+            return now
+
+        now_datetime = datetime.datetime.fromtimestamp(now)
+
+        if self.reminder_time <= now_datetime.time() <= self.send_until:
+            return now
+
+        return next_daily(now, self.reminder_time)
+
+    def save(self):
+        """Writes the schedule to path_to_state if it changed since the last save
+        """
+
+        with self._save_lock:
+
+            with self._lock:
+                if self.path_to_state is None or not self._dirty:
+                    return
+                state = {'reminders': {debt_id: [fire_at, self._last_sent.get(debt_id),
+                                                 self._deadlines.get(debt_id)]
+                                       for debt_id, fire_at in self._next_fire.items()}}
+                self._dirty = False
+
+            path_to_tmp = self.path_to_state + '.tmp'
+
+            with open(path_to_tmp, 'w') as state_file:
+                json.dump(state, state_file)
+                state_file.flush()
+                os.fsync(state_file.fileno())
+
+            os.replace(path_to_tmp, self.path_to_state)
+
+    def last_sent(self, debt_id):
+        """Returns when the last reminder of a debt was sent
+
+        Arguments:
+            debt_id {String} -- ID of a debt
+
+        Returns:
+            Float -- Timestamp, None if no reminder was sent yet
+        """
+
+        with self._lock:
+            self._load()
+            return self._last_sent.get(debt_id)
+
+    def _following(self, after, deadline=None):
+        if self.interval is not None:
+            return after + self.interval
+
+        following = next_daily(after, self.reminder_time)
+
+        if self.policy is None:
+            return following
+
+        next_day = self.policy.next_day(datetime.date.fromtimestamp(following).toordinal(), deadline)
+        return datetime.datetime.combine(datetime.date.fromordinal(next_day),
+                                         self.reminder_time).timestamp()
+
+    def deadline(self, debt_id):
+        """Returns the deadline a debt was scheduled with
+
+        Arguments:
+            debt_id {String} -- ID of a debt
+
+        Returns:
+            Integer -- Ordinal date, None if unknown
+        """
+
+        with self._lock:
+            self._load()
+            return self._deadlines.get(debt_id)
+
+    def set_deadline(self, debt_id, deadline):
+        """Sets the deadline of a scheduled debt, applies from its next reminder on
+
+        Arguments:
+            debt_id {String} -- ID of a debt
+            deadline {Integer} -- Ordinal date
+        """
+
+        with self._lock:
+            self._load()
+            if debt_id in self._next_fire and self._deadlines.get(debt_id) != deadline:
+                self._deadlines[debt_id] = deadline
+                self._dirty = True
+
+    def schedule(self, debt_id, fire_at=None, deadline=None):
+        """Schedules the reminders of a debt
+
+        Arguments:
+            debt_id {String} -- ID of a debt
+            fire_at {Float} -- Timestamp of the first reminder, default: next regular time
+            deadline {Integer} -- Ordinal date of the deadline, used by the policy
+        """
+
+        if fire_at is None:
+            fire_at = (time.time() if self.interval is not None
+                       else self._following(time.time(), deadline))
+
+        with self._lock:
+            self._load()
+            self._next_fire[debt_id] = fire_at
+            if deadline is not None:
+                self._deadlines[debt_id] = deadline
+            heapq.heappush(self._heap, (fire_at, debt_id))
+            self._dirty = True
+
+    def cancel(self, debt_id):
+        """Stops the reminders of a debt
+
+        Arguments:
+            debt_id {String} -- ID of a debt
+
+        Returns:
+            Boolean -- Reminder was scheduled
+        """
+
+        with self._lock:
+            self._load()
+            scheduled = self._next_fire.pop(debt_id, None) is not None
+            self._last_sent.pop(debt_id, None)
+            self._deadlines.pop(debt_id, None)
+            self._dirty = self._dirty or scheduled
+
+            # drop outdated entries once they make up most of the heap
+            if len(self._heap) > 2 * len(self._next_fire) + 64:
+                self._heap = [(fire_at, debt_id) for debt_id, fire_at in self._next_fire.items()]
+                heapq.heapify(self._heap)
+
+        return scheduled
+
+    def pop_due(self, now=None):
+        """Removes the due reminders and schedules their next occurrence
+
+        Arguments:
+            now {Float} -- Current timestamp
+
+        Returns:
+            list -- debt_ids of the due reminders
+        """
+
+        now = time.time() if now is None else now
+        due = []
+
+        with self._lock:
+            self._load()
+
+            while self._heap and self._heap[0][0] <= now:
+                fire_at, debt_id = heapq.heappop(self._heap)
+
+                if self._next_fire.get(debt_id) != fire_at:
+                    continue
+
+                due.append(debt_id)
+
+            for debt_id in due:
+                fire_at = self._following(now, self._deadlines.get(debt_id))
+                self._next_fire[debt_id] = fire_at
+                self._last_sent[debt_id] = now
+                heapq.heappush(self._heap, (fire_at, debt_id))
+
+            self._dirty = self._dirty or bool(due)
+
+        return due
+
+    def tick(self, now=None):
+        """Sends all due reminders. This is the dispatch loop body.
+
+        Arguments:
+            now {Float} -- Current timestamp
+
+        Returns:
+            Integer -- Number of sent reminders
+        """
+
+        due = self.pop_due(now)
+
+        if self.send_digest is not None:
+            if due:
+                self.send_digest(due)
+        else:
+            for debt_id in due:
+                self.send_reminder(debt_id)
+
+        self.save()
+
+        return len(due)
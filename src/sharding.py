@@ -0,0 +1,628 @@
+"""
+Module: sharding
+
+Description:
+Runs the bot as several worker processes (shards), partitioned by chat_id.
+
+A router process receives all updates (webhook or long polling) and forwards each one
+to the shard of its chat, shard_of(chat_id). Every shard is a normal bot process
+(main.py with SHARD_INDEX set) with its own database files, conversation states and
+reminders. Shards and router talk over local sockets (multiprocessing.connection).
+
+Data placement:
+
+    users   -- on every shard (the debtor is chosen by name), add_user is broadcast
+    debts   -- on the shards of creditor and debtor, every mutation is sent to the other one
+    reminders -- sent by the shard of the debtor only
+
+The mutation records are the ones the databases already journal (see Database._persist),
+so a shard applies them with database.apply_record. Records are delivered in order per
+pair of processes. The receiver acknowledges every message once it is handled (a record
+once it is applied and persisted), and the sender sends unacknowledged messages again
+after a reconnect. Records for another shard are kept in an outbox file per peer
+(shard-<i>-to-<peer>.outbox) until they are acknowledged, so they survive restarts of
+both shards. The router confirms updates to Telegram (next polling offset, webhook
+response) only after the shard acknowledged them.
+
+Usage:
+
+python sharding.py                         starts SHARD_COUNT shards and the router
+SHARD_COUNT=4 SHARD_INDEX=0 python main.py starts a single shard (router: python sharding.py --router)
+"""
+
+import collections
+import hashlib
+import itertools
+import json
+import logging
+import os
+import subprocess
+import sys
+import threading
+import time
+import uuid
+import zlib
+from multiprocessing import AuthenticationError
+from multiprocessing.connection import Client, Listener
+
+from telegram import Bot
+
+from webhook import WebhookServer
+
+LOGGER = logging.getLogger(__name__)
+
+
+def shard_of(chat_id, shards):
+    """Returns the shard of a chat
+
+    Arguments:
+        chat_id {String} -- Telegram Chat_ID
+        shards {Integer} -- Number of shards
+
+    Returns:
+        Integer -- Shard index
+    """
+
+    return zlib.crc32(str(chat_id).encode('utf-8')) % shards
+
+
+def update_chat_id(update_as_dict):
+    """Returns the chat an update belongs to
+
+    Arguments:
+        update_as_dict {Dictionary} -- Update as sent by Telegram
+
+    Returns:
+        String -- Chat_ID, None if the update has no chat
+    """
+
+    for kind in ('message', 'edited_message', 'channel_post'):
+        if kind in update_as_dict:
+            return str(update_as_dict[kind]['chat']['id'])
+
+    callback_query = update_as_dict.get('callback_query')
+
+    if callback_query is not None:
+        if 'message' in callback_query:
+            return str(callback_query['message']['chat']['id'])
+        return str(callback_query['from']['id'])
+
+    return None
+
+
+def shard_address(shard, socket_dir='.'):
+    """Returns the socket path of a shard
+    """
+
+    return os.path.join(socket_dir, f'shard-{shard}.sock')
+
+
+def shard_authkey(bot_token):
+    """Derives the key that authenticates the processes of one bot
+    """
+
+    return hashlib.sha256(('shard:' + (bot_token or '')).encode('utf-8')).digest()
+
+
+class _Outbox:
+    """
+    Messages to one peer that were not acknowledged yet, in a file (one JSON line
+    [seq, message] per message). The acknowledged sequence number is kept in
+    "<path>.acked", with the origin that identifies the sender to the receiver.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.path_to_acked = path + '.acked'
+
+        try:
+            with open(self.path_to_acked) as acked_file:
+                state = json.load(acked_file)
+        except (OSError, ValueError):
+            state = {'origin': uuid.uuid4().hex, 'acked': 0}
+
+        self.origin = state['origin']
+        self.acked = state['acked']
+        self.messages = []
+
+        try:
+            with open(path, 'rb') as outbox_file:
+                for line in outbox_file:
+                    # a torn last line was never acknowledged nor sent
+                    if not line.endswith(b'\n'):
+                        break
+                    seq, message = json.loads(line)
+                    if seq > self.acked:
+                        self.messages.append((seq, message))
+        except FileNotFoundError:
+            pass
+
+        self.last_seq = self.messages[-1][0] if self.messages else self.acked
+
+        # drop the acknowledged messages and a torn line
+        with open(path + '.tmp', 'w') as outbox_file:
+            outbox_file.write(''.join(json.dumps([seq, message]) + '\n' for seq, message in self.messages))
+            outbox_file.flush()
+            os.fsync(outbox_file.fileno())
+        os.replace(path + '.tmp', path)
+        self._save_acked()
+
+        self._file = open(path, 'a')
+
+    def append(self, seq, message):
+        """Writes a message to disk before it is sent
+        """
+
+        self._file.write(json.dumps([seq, message]) + '\n')
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def ack(self, seq, empty):
+        """Records that the messages up to seq were acknowledged
+
+        Arguments:
+            seq {Integer} -- Acknowledged sequence number
+            empty {Boolean} -- No unacknowledged messages are left, the file is emptied
+        """
+
+        self.acked = seq
+        self._save_acked()
+
+        if empty:
+            self._file.truncate(0)
+
+    def _save_acked(self):
+        # a lost update only makes the receiver skip messages it already handled
+        with open(self.path_to_acked + '.tmp', 'w') as acked_file:
+            json.dump({'origin': self.origin, 'acked': self.acked}, acked_file)
+        os.replace(self.path_to_acked + '.tmp', self.path_to_acked)
+
+    def close(self):
+        self._file.close()
+
+
+class _Link:
+    """
+    Ordered delivery of messages to one process, from a background thread. Messages are
+    sent again after a reconnect until the receiver acknowledges them. With an outbox
+    file they also survive a restart of this process.
+    """
+
+    def __init__(self, address, authkey, path_to_outbox=None, window=100):
+        """
+        Arguments:
+            address {String} -- Socket of the receiver
+            authkey {Bytes} -- See shard_authkey
+            path_to_outbox {String} -- Outbox file, None keeps messages in memory only
+            window {Integer} -- Messages sent ahead of the acknowledgements
+        """
+
+        self.address = address
+        self.authkey = authkey
+        self.window = window
+        self._outbox = _Outbox(path_to_outbox) if path_to_outbox else None
+
+        if self._outbox is not None:
+            self.origin = self._outbox.origin
+            self._pending = collections.deque(self._outbox.messages)
+            self._last_seq = self._outbox.last_seq
+            self._acked = self._outbox.acked
+        else:
+            self.origin = uuid.uuid4().hex
+            self._pending = collections.deque()
+            self._last_seq = self._acked = 0
+
+        self._sent = self._acked
+        self._closing = False
+        self._stopped = False
+        self._condition = threading.Condition()
+        self._connection = None
+        self._thread = threading.Thread(target=self._run, name=f'link-{address}', daemon=True)
+        self._thread.start()
+
+    def send(self, message):
+        """Queues a message (in the outbox first)
+
+        Arguments:
+            message {Tuple} -- (kind, payload)
+
+        Returns:
+            Integer -- Sequence number of the message, see wait_acked
+        """
+
+        with self._condition:
+            self._last_seq += 1
+
+            if self._outbox is not None:
+                self._outbox.append(self._last_seq, message)
+
+            self._pending.append((self._last_seq, message))
+            self._condition.notify_all()
+
+            return self._last_seq
+
+    def wait_acked(self, seq=None, timeout=None):
+        """Blocks until the receiver acknowledged a message
+
+        Arguments:
+            seq {Integer} -- Sequence number, default: all messages sent so far
+            timeout {Float} -- Seconds to wait at most
+
+        Returns:
+            Boolean -- Message was acknowledged
+        """
+
+        with self._condition:
+            seq = self._last_seq if seq is None else seq
+            return self._condition.wait_for(lambda: self._acked >= seq, timeout)
+
+    def close(self, timeout=10):
+        """Waits until the queued messages are acknowledged (at most timeout seconds)
+        and closes the connection. Messages that are not acknowledged stay in the outbox.
+        """
+
+        with self._condition:
+            self._closing = True
+            self._condition.notify_all()
+
+        self._thread.join(timeout)
+
+        if self._thread.is_alive():
+            LOGGER.warning('Shard link %s: %d messages not acknowledged', self.address, len(self._pending))
+            # stop retrying
+            with self._condition:
+                self._stopped = True
+
+    def _ack(self, seq):
+        with self._condition:
+            while self._pending and self._pending[0][0] <= seq:
+                self._pending.popleft()
+
+            self._acked = max(self._acked, seq)
+
+            if self._outbox is not None:
+                self._outbox.ack(self._acked, not self._pending)
+
+            self._condition.notify_all()
+
+    def _run(self):
+        delay = 0.1
+
+        while True:
+            with self._condition:
+                self._condition.wait_for(lambda: self._pending or self._closing)
+
+                if not self._pending or self._stopped:
+                    break
+
+                unsent = [(seq, message) for seq, message in itertools.islice(self._pending, self.window)
+                          if seq > self._sent]
+
+            try:
+                if self._connection is None:
+                    self._connection = Client(self.address, family='AF_UNIX', authkey=self.authkey)
+                    self._connection.send(('hello', self.origin))
+
+                for seq, (kind, payload) in unsent:
+                    self._connection.send((kind, seq, payload))
+                    self._sent = seq
+
+                # ('ack', seq): the receiver handled the messages up to seq
+                _, seq = self._connection.recv()
+                self._ack(seq)
+                delay = 0.1
+            except (OSError, EOFError) as link_error:
+                # shard not up (yet) or restarted: reconnect and send the unacknowledged messages again
+                LOGGER.warning('Shard link %s: %r, retrying', self.address, link_error)
+                if self._connection is not None:
+                    self._connection.close()
+                self._connection = None
+                self._sent = self._acked
+                time.sleep(delay)
+                delay = min(delay * 2, 5)
+
+        if self._connection is not None:
+            self._connection.close()
+
+        if self._outbox is not None:
+            self._outbox.close()
+
+
+class ShardChannel:
+    """
+    The shard channel connects one shard to the others: it forwards the records of
+    local mutations and receives updates and records.
+    """
+
+    def __init__(self, shard, shards, database, authkey, socket_dir='.', outbox_dir='.'):
+        """
+        Arguments:
+            shard {Integer} -- Index of this shard
+            shards {Integer} -- Number of shards
+            database {Database} -- Database of this shard
+            authkey {Bytes} -- See shard_authkey
+            socket_dir {String} -- Directory of the shard sockets
+            outbox_dir {String} -- Directory of the outbox files
+        """
+
+        self.shard = shard
+        self.shards = shards
+        self.database = database
+        self.authkey = authkey
+        self.socket_dir = socket_dir
+        self._links = {peer: _Link(shard_address(peer, socket_dir), authkey,
+                                   os.path.join(outbox_dir, f'shard-{shard}-to-{peer}.outbox'))
+                       for peer in range(shards) if peer != shard}
+        self._listener = None
+        # origin of a sender -> sequence number of the last message handled
+        self._received = {}
+
+    def owns(self, chat_id):
+        """Returns whether a chat belongs to this shard
+        """
+
+        return shard_of(chat_id, self.shards) == self.shard
+
+    def publish(self, record):
+        """Sends a mutation record to the shards that keep a copy of the data.
+        Used as database.on_record.
+
+        Arguments:
+            record {Dictionary} -- Mutation record
+        """
+
+        operation = record['op']
+
+        if operation == 'add_user':
+            peers = self._links.keys()
+        elif operation == 'add_debt':
+            peers = {shard_of(record['debt']['creditor'], self.shards),
+                     shard_of(record['debt']['debtor'], self.shards)}
+        elif operation in ('set_accepted', 'set_paid'):
+            debt = self.database.get_debt_by_debt_id(record['debt_id'])
+            if debt is None:
+                return
+            peers = {shard_of(debt.creditor, self.shards), shard_of(debt.debtor, self.shards)}
+        else:
+            # archiving is local to every shard
+            return
+
+        for peer in peers:
+            if peer != self.shard:
+                self._links[peer].send(('record', record))
+
+    def serve(self, handle_update, handle_record):
+        """Receives messages of the router and the other shards on background threads
+
+        Arguments:
+            handle_update {Callable} -- Called with every update (Dictionary)
+            handle_record {Callable} -- Called with every mutation record of another shard
+        """
+
+        address = shard_address(self.shard, self.socket_dir)
+
+        if os.path.exists(address):
+            os.remove(address)
+
+        self._listener = Listener(address, family='AF_UNIX', authkey=self.authkey)
+        threading.Thread(target=self._accept, args=(handle_update, handle_record),
+                         name='shard-listener', daemon=True).start()
+
+    def _accept(self, handle_update, handle_record):
+        while True:
+            try:
+                connection = self._listener.accept()
+            except AuthenticationError:
+                LOGGER.warning('Shard connection with wrong key rejected')
+                continue
+            except OSError:
+                # listener closed
+                return
+            threading.Thread(target=self._receive, args=(connection, handle_update, handle_record),
+                             name='shard-receiver', daemon=True).start()
+
+    def _receive(self, connection, handle_update, handle_record):
+        # one thread per sending process keeps its messages in order
+        with connection:
+            try:
+                _, origin = connection.recv()
+
+                while True:
+                    kind, seq, payload = connection.recv()
+
+                    # messages sent again after a reconnect are only acknowledged
+                    if seq > self._received.get(origin, 0):
+                        try:
+                            if kind == 'update':
+                                handle_update(payload)
+                            else:
+                                handle_record(payload)
+                        except OSError:
+                            # not persisted: without an acknowledgement the sender retries
+                            LOGGER.exception('Shard message %s failed', kind)
+                            return
+                        except Exception:  # pylint: disable=broad-except
+                            LOGGER.exception('Shard message %s failed', kind)
+
+                        self._received[origin] = seq
+
+                    connection.send(('ack', seq))
+            except (EOFError, OSError):
+                return
+
+    def close(self, timeout=10):
+        """Stops receiving and delivers the queued records, those not acknowledged within
+        timeout seconds stay in the outboxes
+        """
+
+        if self._listener is not None:
+            self._listener.close()
+
+        for link in self._links.values():
+            link.close(timeout)
+
+
+class _RouterWebhookServer(WebhookServer):
+    """
+    Webhook server of the router, forwards updates instead of dispatching them.
+    """
+
+    def __init__(self, router, secret_token, **kwargs):
+        self.router = router
+        super().__init__(None, secret_token, **kwargs)
+
+    def dispatch(self, update_as_dict):
+        # answered with an error unless the shard has the update, so Telegram sends it again
+        if not self.router.route(update_as_dict, timeout=10):
+            raise TimeoutError('Shard did not acknowledge the update')
+
+
+class ShardRouter:
+    """
+    The shard router forwards updates to the shard of their chat.
+    """
+
+    def __init__(self, shards, authkey, socket_dir='.'):
+        self.shards = shards
+        self._links = [_Link(shard_address(shard, socket_dir), authkey) for shard in range(shards)]
+
+    def route(self, update_as_dict, timeout=None):
+        """Forwards an update to its shard, updates without chat go to shard 0
+
+        Arguments:
+            update_as_dict {Dictionary} -- Update as sent by Telegram
+            timeout {Float} -- Seconds to wait for the acknowledgement of the shard,
+                               None doesn't wait (see flush)
+
+        Returns:
+            Boolean -- The shard acknowledged the update (always True without timeout)
+        """
+
+        chat_id = update_chat_id(update_as_dict)
+        shard = 0 if chat_id is None else shard_of(chat_id, self.shards)
+        seq = self._links[shard].send(('update', update_as_dict))
+
+        if timeout is None:
+            return True
+
+        return self._links[shard].wait_acked(seq, timeout)
+
+    def flush(self, timeout=None):
+        """Blocks until the shards acknowledged all updates routed so far
+
+        Arguments:
+            timeout {Float} -- Seconds to wait at most per shard
+
+        Returns:
+            Boolean -- All updates were acknowledged
+        """
+
+        return all([link.wait_acked(timeout=timeout) for link in self._links])
+
+    def close(self):
+        """Delivers the queued updates
+        """
+
+        for link in self._links:
+            link.close()
+
+
+def poll(bot, router, timeout=30):
+    """Receives updates by long polling and routes them until Ctrl-C
+
+    Arguments:
+        bot {telegram.Bot} -- Bot of the router
+        router {ShardRouter} -- Router
+        timeout {Integer} -- Long polling timeout in seconds
+    """
+
+    offset = None
+
+    while True:
+        try:
+            updates = bot.get_updates(offset=offset, timeout=timeout,
+                                      allowed_updates=["message", "callback_query"])
+        except KeyboardInterrupt:
+            return
+        except Exception as poll_error:  # pylint: disable=broad-except
+            LOGGER.warning('Polling failed: %s', poll_error)
+            time.sleep(1)
+            continue
+
+        for update in updates:
+            router.route(update.to_dict())
+
+        # confirm the updates to Telegram (next offset) once the shards have them
+        try:
+            router.flush()
+        except KeyboardInterrupt:
+            return
+
+        if updates:
+            offset = updates[-1].update_id + 1
+
+
+def run_router(shards):
+    """Runs the router process: webhook server with WEBHOOK_URL, long polling otherwise
+
+    Arguments:
+        shards {Integer} -- Number of shards
+    """
+
+    bot_token = os.environ.get('schuldestmirbot')
+    router = ShardRouter(shards, shard_authkey(bot_token), os.environ.get('SHARD_SOCKET_DIR', '.'))
+    bot = Bot(bot_token)
+    webhook_url = os.environ.get('WEBHOOK_URL')
+
+    try:
+        if webhook_url:
+            secret_token = os.environ.get('WEBHOOK_SECRET', '')
+            server = _RouterWebhookServer(router, secret_token,
+                                          listen=os.environ.get('WEBHOOK_LISTEN', '0.0.0.0'),
+                                          port=int(os.environ.get('WEBHOOK_PORT', '8443')),
+                                          url_path=os.environ.get('WEBHOOK_PATH', '/webhook'))
+            bot.set_webhook(url=webhook_url, allowed_updates=["message", "callback_query"],
+                            api_kwargs={'secret_token': secret_token})
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                server.server_close()
+        else:
+            bot.delete_webhook()
+            poll(bot, router)
+    finally:
+        router.close()
+
+
+def main():
+    """Starts SHARD_COUNT shard processes and runs the router in this process
+    (python sharding.py --router runs only the router)
+    """
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
+                        level=logging.INFO)
+
+    shards = int(os.environ.get('SHARD_COUNT', '2'))
+
+    if '--router' in sys.argv:
+        run_router(shards)
+        return
+
+    main_py = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'main.py')
+    workers = [subprocess.Popen([sys.executable, main_py],
+                                env=dict(os.environ, SHARD_COUNT=str(shards), SHARD_INDEX=str(shard)))
+               for shard in range(shards)]
+
+    try:
+        run_router(shards)
+    finally:
+        for worker in workers:
+            worker.terminate()
+        for worker in workers:
+            worker.wait()
+
+
+if __name__ == '__main__':
+    main()
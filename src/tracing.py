@@ -0,0 +1,329 @@
+"""
+Module: tracing
+
+Description:
+Sampled tracing of updates: a sampled update gets a trace, and the handler callbacks,
+database methods and Bot API calls made for it are recorded as spans.
+
+The trace of the running update is kept per thread. Messages queued in the outbound
+queue carry it to the sender thread (see activate), so delayed sends show up in the
+trace of the update that caused them. Without a trace, an instrumented function costs
+one thread-local lookup.
+
+Spans are written by a background thread as Chrome trace events ("X" events, JSON array
+format) that chrome://tracing and https://ui.perfetto.dev open directly. Every event
+carries trace_id, span_id and parent_id in its args, for analysis by script:
+
+[
+{"name": "update", "cat": "update", "ph": "X", "ts": 1714557600000000, "dur": 5300, "pid": 4242,
+ "tid": 1401, "args": {"trace_id": "5f0c...", "span_id": 1, "parent_id": null, "kind": "/schuld"}},
+{"name": "add_debt", "cat": "storage", ...},
+
+Usage:
+
+tracer = Tracer('database.trace.json', sample_rate=0.01)
+tracer.instrument_dispatcher(dispatcher)
+instrument_methods(database, ['add_debt', ...], 'storage')
+instrument_request(bot.request)
+tracer.start()
+...
+tracer.stop()
+"""
+
+import contextlib
+import functools
+import itertools
+import json
+import logging
+import os
+import queue
+import random
+import threading
+import time
+import uuid
+
+import metrics
+
+LOGGER = logging.getLogger(__name__)
+
+DROPPED_EVENTS = metrics.counter('bot_trace_events_dropped_total', 'Spans not written, the writer fell behind')
+
+_LOCAL = threading.local()
+_SPAN_IDS = itertools.count(1)
+
+
+class Trace:
+    """
+    The Trace class identifies a sampled update and the tracer that writes its spans.
+    """
+
+    __slots__ = ('trace_id', 'tracer', 'root_id')
+
+    def __init__(self, tracer):
+        self.trace_id = uuid.uuid4().hex
+        self.tracer = tracer
+        self.root_id = None
+
+
+def current():
+    """Returns the trace of the current thread, None if there is none
+    """
+
+    return getattr(_LOCAL, 'trace', None)
+
+
+@contextlib.contextmanager
+def activate(trace):
+    """Makes a trace the current trace of this thread, e.g. in the thread sending
+    a queued message. A trace of None does nothing.
+
+    Arguments:
+        trace {Trace} -- Trace, see current
+    """
+
+    if trace is None:
+        yield
+        return
+
+    previous = current()
+    previous_parents = getattr(_LOCAL, 'parents', None)
+    _LOCAL.trace, _LOCAL.parents = trace, [trace.root_id]
+
+    try:
+        yield
+    finally:
+        _LOCAL.trace, _LOCAL.parents = previous, previous_parents
+
+
+@contextlib.contextmanager
+def span(name, category, **attributes):
+    """Records a span in the current trace, does nothing without a trace
+
+    Arguments:
+        name {String} -- Span name, e.g. the method name
+        category {String} -- e.g. "storage"
+        attributes -- Added to the args of the event
+    """
+
+    trace = current()
+
+    if trace is None:
+        yield
+        return
+
+    span_id = next(_SPAN_IDS)
+    parents = _LOCAL.parents
+    parent_id = parents[-1] if parents else None
+    parents.append(span_id)
+    start = time.time_ns()
+
+    try:
+        yield
+    finally:
+        parents.pop()
+        trace.tracer.emit(trace, name, category, start, time.time_ns() - start, span_id, parent_id, attributes)
+
+
+def traced(function, name, category):
+    """Wraps a function to record a span when it is called in a trace
+
+    Arguments:
+        function {Callable} -- Function
+        name {String} -- Span name
+        category {String} -- Span category
+
+    Returns:
+        Callable -- Wrapped function
+    """
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        if getattr(_LOCAL, 'trace', None) is None:
+            return function(*args, **kwargs)
+        with span(name, category):
+            return function(*args, **kwargs)
+
+    wrapper.traced = True
+    return wrapper
+
+
+def instrument_methods(instance, method_names, category):
+    """Replaces methods of an object by traced wrappers (span name: method name)
+
+    Arguments:
+        instance {Object} -- e.g. the database
+        method_names {list} -- Names of the methods, missing ones are skipped
+        category {String} -- Span category
+    """
+
+    for name in method_names:
+        method = getattr(instance, name, None)
+
+        if method is not None and not getattr(method, 'traced', False):
+            setattr(instance, name, traced(method, name, category))
+
+
+def instrument_handlers(handlers):
+    """Wraps the callbacks of python-telegram-bot handlers, see metrics.iter_handlers
+    (span name: callback name)
+
+    Arguments:
+        handlers {list} -- Handlers
+    """
+
+    for handler in metrics.iter_handlers(handlers):
+        callback = handler.callback
+
+        if not getattr(callback, 'traced', False):
+            handler.callback = traced(callback, getattr(callback, '__name__', type(callback).__name__),
+                                      'handler')
+
+
+def instrument_request(request):
+    """Records the Bot API calls of a telegram.utils.request.Request (span name: API method)
+
+    Arguments:
+        request {Request} -- Request of the bot, bot.request
+    """
+
+    post = request.post
+
+    if getattr(post, 'traced', False):
+        return
+
+    @functools.wraps(post)
+    def traced_post(url, *args, **kwargs):
+        if getattr(_LOCAL, 'trace', None) is None:
+            return post(url, *args, **kwargs)
+        with span(url.rsplit('/', 1)[-1], 'bot_api'):
+            return post(url, *args, **kwargs)
+
+    traced_post.traced = True
+    request.post = traced_post
+
+
+def update_kind(update):
+    """Returns a short description of an update: command, "text" or "callback:<action code>"
+    """
+
+    callback_query = getattr(update, 'callback_query', None)
+
+    if callback_query is not None:
+        return 'callback:' + (callback_query.data or '')[:1]
+
+    text = getattr(getattr(update, 'effective_message', None), 'text', None) or ''
+    return text.split()[0] if text.startswith('/') else 'text'
+
+
+class Tracer:
+    """
+    The Tracer class samples updates and writes the spans of their traces to a file.
+    """
+
+    def __init__(self, path, sample_rate, queue_size=10000):
+        """
+        Arguments:
+            path {String} -- Trace file (Chrome trace events), appended to
+            sample_rate {Float} -- Fraction of the updates traced
+            queue_size {Integer} -- Events waiting for the writer, further events are dropped
+        """
+
+        self.path = path
+        self.sample_rate = sample_rate
+        self._events = queue.Queue(queue_size)
+        self._thread = threading.Thread(target=self._write, name='tracer', daemon=True)
+        self._pid = os.getpid()
+
+    @contextlib.contextmanager
+    def trace(self, name, **attributes):
+        """Starts a trace with a root span if the update is sampled
+
+        Arguments:
+            name {String} -- Name of the root span
+            attributes -- Added to the args of the root span
+
+        Yields:
+            Trace -- The trace, None if not sampled
+        """
+
+        if random.random() >= self.sample_rate:
+            yield None
+            return
+
+        trace = Trace(self)
+        previous, previous_parents = current(), getattr(_LOCAL, 'parents', None)
+        _LOCAL.trace, _LOCAL.parents = trace, []
+
+        try:
+            with span(name, 'update', **attributes):
+                trace.root_id = _LOCAL.parents[-1]
+                yield trace
+        finally:
+            _LOCAL.trace, _LOCAL.parents = previous, previous_parents
+
+    def instrument_dispatcher(self, dispatcher):
+        """Starts a trace for sampled updates processed by a dispatcher
+
+        Arguments:
+            dispatcher {Dispatcher} -- python-telegram-bot dispatcher
+        """
+
+        process_update = dispatcher.process_update
+
+        if getattr(process_update, 'traced', False):
+            return
+
+        @functools.wraps(process_update)
+        def traced_process_update(update):
+            with self.trace('update', kind=update_kind(update)):
+                return process_update(update)
+
+        traced_process_update.traced = True
+        dispatcher.process_update = traced_process_update
+
+    def emit(self, trace, name, category, start_ns, duration_ns, span_id, parent_id, attributes):
+        """Queues a span for the writer, see span
+        """
+
+        event = {'name': name, 'cat': category, 'ph': 'X', 'ts': start_ns // 1000, 'dur': duration_ns // 1000,
+                 'pid': self._pid, 'tid': threading.get_ident(),
+                 'args': dict(attributes, trace_id=trace.trace_id, span_id=span_id, parent_id=parent_id)}
+
+        try:
+            self._events.put_nowait(event)
+        except queue.Full:
+            DROPPED_EVENTS.inc()
+
+    def start(self):
+        """Starts the writer thread
+        """
+
+        self._thread.start()
+
+    def stop(self):
+        """Writes the queued events and stops the writer thread
+        """
+
+        self._events.put(None)
+        self._thread.join()
+
+    def _write(self):
+
+        # JSON array format: the closing bracket is optional, so events can be appended
+        with open(self.path, 'a') as trace_file:
+
+            if trace_file.tell() == 0:
+                trace_file.write('[\n')
+
+            while True:
+                event = self._events.get()
+
+                if event is None:
+                    return
+
+                try:
+                    trace_file.write(json.dumps(event, default=str) + ',\n')
+                    if self._events.empty():
+                        trace_file.flush()
+                except OSError as os_error:
+                    LOGGER.error('Writing trace failed: %s', os_error)
@@ -13,6 +13,8 @@ class User:
     These can be returned as dictionary entries.
     """
 
+    __slots__ = ('chat_id', 'name')
+
     def __init__(self, chat_id, name):
         self.chat_id = chat_id
         self.name = name
@@ -0,0 +1,244 @@
+"""
+Module: user_keyboard
+
+Description:
+Prebuilt keyboards for choosing a debtor in /schuld.
+
+/schuld first shows the top contacts of the user (database.get_contacts: the users they
+had the most and most recent debts with) and a button for the list of all users.
+The names of all users are read from the database once, a registration (the user count
+changes) only adds the new names. Keyboards are built per user (the user is left out) and
+page, and kept in a small LRU cache, so a repeated /schuld costs one dictionary lookup;
+a registration drops only the cached last pages.
+Large user bases are split into pages of page_size users with buttons to turn pages.
+Names that don't match a user exactly are searched (case-insensitive substring) through
+an index of the name parts of up to NGRAM characters.
+
+Usage:
+
+keyboards = UserKeyboards(database)
+markup = keyboards.contacts_keyboard(chat_id)
+markup = keyboards.keyboard(chat_id, page=0)
+names = keyboards.search("ann")
+"""
+
+import re
+import threading
+from collections import OrderedDict
+
+from telegram import ReplyKeyboardMarkup
+
+USER_PREFIX = "👤 "
+CANCEL_BUTTON = "Abbrechen ✖"
+ALL_USERS_BUTTON = "👥 Alle Benutzer"
+PAGE_BUTTON_PATTERN = re.compile(r"^(?:⬅|➡) Seite (\d+)$")
+# length of the name parts in the search index
+NGRAM = 3
+
+
+class UserKeyboards:
+    """
+    The UserKeyboards class caches the user selection keyboards.
+    """
+
+    def __init__(self, database, page_size=30, cache_size=1024, contacts=8):
+        """
+        Arguments:
+            database {Database} -- Database with user_count(), get_users_from(), get_contacts()
+                                   and get_user_by_chat_id()
+            page_size {Integer} -- Users per keyboard page
+            contacts {Integer} -- Contacts on the first keyboard
+            cache_size {Integer} -- Keyboards kept in the cache
+        """
+
+        self.database = database
+        self.page_size = page_size
+        self.cache_size = cache_size
+        self.contacts = contacts
+        self._user_count = 0
+        self._users = []
+        # chat_id -> position in _users
+        self._positions = {}
+        # lowercase part of a name (up to NGRAM characters) -> positions of the names containing it
+        self._ngrams = {}
+        self._keyboards = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _refresh(self):
+        """Adds the users registered since the last call. Only the cached keyboards
+        of the last pages change (names are appended), the others are kept.
+        Caller holds the lock.
+        """
+
+        user_count = self.database.user_count()
+
+        if user_count == self._user_count:
+            return
+
+        new_users = set()
+        for user in self.database.get_users_from(len(self._users)):
+            self._add(user.chat_id, user.name)
+            new_users.add(user.chat_id)
+
+        # the new names go to the last page of every user, which may also get a ➡ button
+        # (pages beyond the last are shown as the last one), the new users aren't listed any more
+        first_changed = (self._user_count - 1) // self.page_size - 1
+        for key in [key for key in self._keyboards if key[1] >= first_changed or key[0] in new_users]:
+            del self._keyboards[key]
+
+        self._user_count = user_count
+
+    def _add(self, chat_id, name):
+        position = len(self._users)
+        self._users.append((chat_id, name))
+        self._positions[chat_id] = position
+
+        lower = name.lower()
+        for length in range(1, NGRAM + 1):
+            for start in range(len(lower) - length + 1):
+                positions = self._ngrams.setdefault(lower[start:start + length], [])
+                if not positions or positions[-1] != position:
+                    positions.append(position)
+
+    def _others(self, chat_id, start, stop):
+        """Returns the names between start and stop of the list without the user
+
+        Arguments:
+            chat_id {String} -- Chat_ID of the user, not listed
+            start {Integer} -- First index
+            stop {Integer} -- Index after the last
+
+        Returns:
+            list -- Names
+        """
+
+        own = self._positions.get(chat_id)
+
+        if own is not None and own < stop:
+            # the names after the user move up by one
+            if own < start:
+                start, stop = start + 1, stop + 1
+            else:
+                stop += 1
+
+        return [name for user_chat_id, name in self._users[start:stop] if user_chat_id != chat_id]
+
+    def contacts_keyboard(self, chat_id):
+        """Returns the keyboard with the top contacts of a user, the full keyboard
+        if the user has none yet
+
+        Arguments:
+            chat_id {String} -- Chat_ID of the user choosing
+
+        Returns:
+            telegram.ReplyKeyboardMarkup -- Keyboard
+        """
+
+        names = []
+
+        for contact in self.database.get_contacts(chat_id, self.contacts):
+            user = self.database.get_user_by_chat_id(contact)
+            if user is not None:
+                names.append(user.name)
+
+        if not names:
+            return self.keyboard(chat_id)
+
+        return ReplyKeyboardMarkup([[CANCEL_BUTTON]] + [[USER_PREFIX + name] for name in names] +
+                                   [[ALL_USERS_BUTTON]], one_time_keyboard=True)
+
+    def keyboard(self, chat_id, page=0):
+        """Returns the keyboard with the other users
+
+        Arguments:
+            chat_id {String} -- Chat_ID of the user choosing, not listed
+            page {Integer} -- Page number, starting at 0
+
+        Returns:
+            telegram.ReplyKeyboardMarkup -- Keyboard
+        """
+
+        with self._lock:
+            self._refresh()
+            key = (chat_id, page)
+            markup = self._keyboards.get(key)
+
+            if markup is not None:
+                self._keyboards.move_to_end(key)
+                return markup
+
+            others = len(self._users) - (chat_id in self._positions)
+            pages = max(1, -(-others // self.page_size))
+            page = min(max(page, 0), pages - 1)
+
+            rows = [[CANCEL_BUTTON]]
+            rows += [[USER_PREFIX + name] for name in self._others(chat_id, page * self.page_size,
+                                                                   (page + 1) * self.page_size)]
+
+            navigation = []
+            if page > 0:
+                navigation.append(f"⬅ Seite {page}")
+            if page < pages - 1:
+                navigation.append(f"➡ Seite {page + 2}")
+            if navigation:
+                rows.append(navigation)
+
+            markup = ReplyKeyboardMarkup(rows, one_time_keyboard=True)
+            self._keyboards[key] = markup
+
+            if len(self._keyboards) > self.cache_size:
+                self._keyboards.popitem(last=False)
+
+            return markup
+
+    def search(self, text, chat_id=None, limit=None):
+        """Returns the names of users containing a text
+
+        Arguments:
+            text {String} -- Part of a name, case-insensitive
+            chat_id {String} -- Chat_ID of the user searching, not listed
+            limit {Integer} -- Maximum number of names, default: page_size
+
+        Returns:
+            list -- Names
+        """
+
+        limit = self.page_size if limit is None else limit
+        text = text.lower()
+
+        with self._lock:
+            self._refresh()
+            users = self._users
+            # names containing all parts of the text, rarest part first
+            parts = sorted((self._ngrams.get(text[start:start + NGRAM], []) for start in
+                            range(max(1, len(text) - NGRAM + 1))), key=len)
+
+        if not text:
+            candidates = range(len(users))
+        else:
+            candidates = parts[0]
+            for positions in parts[1:]:
+                candidates = sorted(set(candidates).intersection(positions))
+
+        names = []
+        for position in candidates:
+            user_chat_id, name = users[position]
+            if user_chat_id != chat_id and text in name.lower():
+                names.append(name)
+                if len(names) == limit:
+                    break
+
+        return names
+
+    def search_keyboard(self, names):
+        """Returns a keyboard with search results
+
+        Arguments:
+            names {list} -- Names, see search
+
+        Returns:
+            telegram.ReplyKeyboardMarkup -- Keyboard
+        """
+
+        return ReplyKeyboardMarkup([[CANCEL_BUTTON]] + [[USER_PREFIX + name] for name in names],
+                                   one_time_keyboard=True)
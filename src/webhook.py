@@ -0,0 +1,206 @@
+"""
+Module: webhook
+
+Description:
+Receives updates over HTTP (Telegram webhook) instead of long polling.
+
+Telegram posts every update as JSON to the webhook URL, with the secret token given to
+setWebhook in the header X-Telegram-Bot-Api-Secret-Token. Requests without the right token
+are rejected. Valid updates are put on the update queue of the dispatcher and the request is
+answered at once. Requests without a valid Content-Length or with a body larger than
+max_body_size are rejected before the body is read. Callback queries are answered inside
+the HTTP response (answerCallbackQuery as webhook reply), which stops the loading
+animation of the button without an extra Bot API request.
+
+The server keeps no state of its own, so several processes can run behind a load balancer.
+Conversation states live in the process that handled the previous update, so the balancer
+has to route the updates of a chat to the same process (e.g. hash of the chat id,
+see module sharding, which overrides dispatch() to forward updates to shard processes).
+
+Usage:
+
+server = WebhookServer(dispatcher, secret_token, port=8443)
+server.serve_forever()
+
+Posting recorded updates (one JSON update per line) to a running server:
+
+python webhook.py http://localhost:8443/webhook <secret_token> updates.jsonl
+"""
+
+import hmac
+import json
+import logging
+import sys
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from telegram import Update
+
+LOGGER = logging.getLogger(__name__)
+
+SECRET_TOKEN_HEADER = 'X-Telegram-Bot-Api-Secret-Token'
+
+
+class WebhookServer(ThreadingHTTPServer):
+    """
+    The webhook server hands updates posted by Telegram to a dispatcher.
+    """
+
+    daemon_threads = True
+
+    def __init__(self, dispatcher, secret_token, listen='0.0.0.0', port=8443, url_path='/webhook',
+                 max_body_size=1 << 20):
+        """
+        Arguments:
+            dispatcher {telegram.ext.Dispatcher} -- Dispatcher processing the updates
+            secret_token {String} -- Token Telegram sends in every request
+            listen {String} -- Address to listen on
+            port {Integer} -- Port to listen on
+            url_path {String} -- Path of the webhook URL
+            max_body_size {Integer} -- Larger requests are rejected
+        """
+
+        if not secret_token:
+            raise ValueError('The webhook needs a secret token')
+
+        self.dispatcher = dispatcher
+        self.secret_token = secret_token
+        self.url_path = url_path
+        self.max_body_size = max_body_size
+        super().__init__((listen, port), _WebhookHandler)
+
+    def handle_update(self, update_as_dict):
+        """Hands an update over for processing
+
+        Arguments:
+            update_as_dict {Dictionary} -- Update as sent by Telegram
+
+        Returns:
+            Dictionary -- Bot API method to reply with, None for an empty reply
+                          (also for updates that can't be parsed, they are logged and dropped)
+        """
+
+        try:
+            self.dispatch(update_as_dict)
+
+            callback_query = update_as_dict.get('callback_query')
+
+            if callback_query is not None:
+                return {'method': 'answerCallbackQuery', 'callback_query_id': callback_query['id']}
+
+        except (KeyError, TypeError, ValueError, AttributeError) as parse_error:
+            # answered with 200 anyway: Telegram would send a rejected update again and again
+            LOGGER.warning('Invalid update %s dropped: %r', update_as_dict.get('update_id'), parse_error)
+
+        return None
+
+    def dispatch(self, update_as_dict):
+        """Queues an update for the dispatcher
+
+        Arguments:
+            update_as_dict {Dictionary} -- Update as sent by Telegram
+        """
+
+        self.dispatcher.update_queue.put(Update.de_json(update_as_dict, self.dispatcher.bot))
+
+
+class _WebhookHandler(BaseHTTPRequestHandler):
+
+    def do_POST(self):
+        """Handles one update posted by Telegram
+        """
+
+        if self.path != self.server.url_path:
+            self._reply(404)
+            return
+
+        secret_token = self.headers.get(SECRET_TOKEN_HEADER, '')
+
+        if not hmac.compare_digest(secret_token.encode('utf-8'),
+                                   self.server.secret_token.encode('utf-8')):
+            LOGGER.warning('Webhook request with invalid secret token from %s', self.client_address[0])
+            self._reply(403)
+            return
+
+        content_length = self.headers.get('Content-Length')
+
+        if content_length is None:
+            self._reply(411)
+            return
+
+        try:
+            length = int(content_length)
+        except ValueError:
+            self._reply(400)
+            return
+
+        if length < 0:
+            self._reply(400)
+            return
+
+        if length > self.server.max_body_size:
+            self._reply(413)
+            return
+
+        try:
+            update_as_dict = json.loads(self.rfile.read(length))
+        except ValueError:
+            self._reply(400)
+            return
+
+        if not isinstance(update_as_dict, dict):
+            self._reply(400)
+            return
+
+        try:
+            reply = self.server.handle_update(update_as_dict)
+        except OSError as dispatch_error:
+            # Telegram sends the update again
+            LOGGER.warning('Update not dispatched: %s', dispatch_error)
+            self._reply(503)
+            return
+
+        self._reply(200, reply)
+
+    def _reply(self, status, body=None):
+        data = b'' if body is None else json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        LOGGER.debug('%s - %s', self.client_address[0], format % args)
+
+
+def post_update(url, update_as_dict, secret_token):
+    """Posts an update to a webhook server, like Telegram does
+
+    Arguments:
+        url {String} -- Webhook URL
+        update_as_dict {Dictionary} -- Update
+        secret_token {String} -- Secret token of the server
+
+    Returns:
+        Tuple -- HTTP status and the decoded reply (None if empty)
+    """
+
+    request = urllib.request.Request(url, data=json.dumps(update_as_dict).encode('utf-8'),
+                                     headers={'Content-Type': 'application/json',
+                                              SECRET_TOKEN_HEADER: secret_token})
+
+    try:
+        with urllib.request.urlopen(request) as response:
+            body = response.read()
+            return response.status, json.loads(body) if body else None
+    except urllib.error.HTTPError as http_error:
+        return http_error.code, None
+
+
+if __name__ == '__main__':
+    with open(sys.argv[3]) as updates_file:
+        for line in updates_file:
+            if line.strip():
+                print(*post_update(sys.argv[1], json.loads(line), sys.argv[2]))
@@ -0,0 +1,100 @@
+"""
+Tests of the archive of settled debts.
+"""
+
+import datetime
+import json
+import os
+
+from archive import Archive
+from database import Database, SqliteDatabase
+from debt import Debt
+
+TODAY = datetime.date.today().toordinal()
+
+
+def settled_debt(number, settled_on=TODAY):
+    debt = Debt(f'debt-{number}', '1', 'Essen', '5€', '2030:01:01', '2', True, True)
+    debt.settled_on = settled_on
+    return debt
+
+
+def write_database(path, debts):
+    with open(path, 'w') as json_file:
+        json.dump({'users': [{'chat_id': '1', 'name': 'anna'}, {'chat_id': '2', 'name': 'ben'}],
+                   'debts': [debt.to_dict() for debt in debts]}, json_file)
+
+
+def test_add_and_find(tmp_path):
+    archive = Archive(str(tmp_path / 'archive'))
+    archive.add([settled_debt(1)])
+    archive.add([settled_debt(2)])
+
+    assert archive.find('debt-1').debt_id == 'debt-1'
+    assert archive.find('debt-2').is_paid
+    assert archive.find('debt-3') is None
+
+
+def test_truncated_member_is_skipped_and_repaired(tmp_path):
+    archive = Archive(str(tmp_path / 'archive'))
+    archive.add([settled_debt(1)])
+    path = os.path.join(archive.path_to_archive, archive.partitions()[0] + Archive.SUFFIX)
+
+    # crash in the middle of writing a second member
+    with open(path, 'ab') as archive_file:
+        archive_file.write(b'\x1f\x8b\x08\x00partial')
+
+    assert archive.find('debt-1').debt_id == 'debt-1'
+    assert archive.find('debt-2') is None
+
+    archive.add([settled_debt(2)])
+
+    assert archive.find('debt-1') is not None
+    assert archive.find('debt-2') is not None
+
+
+def test_archived_debts_are_found_and_not_changed(tmp_path):
+    write_database(tmp_path / 'database.json', [settled_debt(1, TODAY - 40)])
+    database = Database(str(tmp_path / 'database.json'), journal=True,
+                        path_to_archive=str(tmp_path / 'archive'))
+    database.init_json()
+
+    assert database.archive_settled(30) == 1
+    assert database.debts == []
+    assert database.get_debt_by_debt_id('debt-1').debt_id == 'debt-1'
+    assert database.set_paid('debt-1', True) is None
+    assert database.set_accepted('debt-1', False) is None
+
+
+def test_legacy_settlements_are_persisted(tmp_path):
+    legacy_paid = Debt('debt-1', '1', 'Essen', '5€', '2030:01:01', '2', True, True)
+    legacy_declined = Debt('debt-2', '1', 'Essen', '5€', '2000:01:01', '2', False, False)
+    pending = Debt('debt-3', '1', 'Essen', '5€', '2030:01:01', '2', False, False)
+    write_database(tmp_path / 'database.json', [legacy_paid, legacy_declined, pending])
+
+    def open_database():
+        database = Database(str(tmp_path / 'database.json'), journal=True,
+                            path_to_archive=str(tmp_path / 'archive'))
+        database.init_json()
+        return database
+
+    assert open_database().archive_settled(30) == 0
+
+    reopened = open_database()
+    assert reopened.get_debt_by_debt_id('debt-1').settled_on == TODAY
+    assert reopened.get_debt_by_debt_id('debt-2').settled_on == TODAY
+    assert reopened.get_debt_by_debt_id('debt-3').settled_on is None
+
+
+def test_sqlite_archive(tmp_path):
+    write_database(tmp_path / 'database.json',
+                   [settled_debt(1, TODAY - 40),
+                    Debt('debt-2', '1', 'Essen', '5€', '2000:01:01', '2', False, False)])
+    database = SqliteDatabase(str(tmp_path / 'database.sqlite3'), path_to_archive=str(tmp_path / 'archive'))
+    database.init_json()
+    database.migrate_json(str(tmp_path / 'database.json'))
+
+    assert database.archive_settled(30) == 1
+    assert database.get_debt_by_debt_id('debt-1').debt_id == 'debt-1'
+    assert database.get_debt_by_debt_id('debt-2').settled_on == TODAY
+    assert database.set_paid('debt-1', True) is None
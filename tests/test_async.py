@@ -0,0 +1,82 @@
+"""
+Tests of AsyncDatabase and AsyncRuntime.
+"""
+
+import asyncio
+import threading
+import time
+
+from async_database import AsyncDatabase
+from async_runtime import AsyncRuntime
+
+
+class SlowDatabase:
+
+    def __init__(self):
+        self.calls = []
+        self.readers = 0
+        self.max_readers = 0
+        self._lock = threading.Lock()
+
+    def get_user_by_chat_id(self, chat_id):
+        with self._lock:
+            self.readers += 1
+            self.max_readers = max(self.max_readers, self.readers)
+        time.sleep(0.05)
+        with self._lock:
+            self.readers -= 1
+        return chat_id
+
+    def add_user(self, chat_id, name):
+        time.sleep(0.01 if chat_id == '1' else 0)
+        self.calls.append(chat_id)
+
+
+def test_reads_run_concurrently():
+    database = SlowDatabase()
+    async_database = AsyncDatabase(database, readers=4)
+
+    async def read():
+        return await asyncio.gather(*(async_database.get_user_by_chat_id(str(i)) for i in range(4)))
+
+    assert asyncio.run(read()) == ['0', '1', '2', '3']
+    assert database.max_readers > 1
+    async_database.close()
+
+
+def test_writes_keep_their_order():
+    database = SlowDatabase()
+    async_database = AsyncDatabase(database)
+
+    async def write():
+        await asyncio.gather(*(async_database.add_user(str(i), 'name') for i in range(1, 5)))
+
+    asyncio.run(write())
+
+    assert database.calls == ['1', '2', '3', '4']
+    async_database.close()
+
+
+def test_stop_waits_for_submitted_coroutines():
+    runtime = AsyncRuntime()
+    runtime.start()
+    finished = []
+
+    async def handler():
+        await runtime.run_blocking(time.sleep, 0.05)
+        finished.append(True)
+
+    runtime.submit(handler())
+    runtime.stop()
+
+    assert finished == [True]
+
+
+def test_stop_cancels_coroutines_after_timeout():
+    runtime = AsyncRuntime()
+    runtime.start()
+
+    future = runtime.submit(asyncio.sleep(60))
+    runtime.stop(timeout=0.05)
+
+    assert future.cancelled()
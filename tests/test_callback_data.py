@@ -0,0 +1,46 @@
+"""
+Tests of the callback data codec.
+"""
+
+import json
+import uuid
+
+import pytest
+
+import callback_data
+from callback_data import ACCEPT_DEBT, ASK_PAID, CONFIRM_PAID, REGISTRATION, SELECT_DEBT, decode, encode
+
+DEBT_ID = str(uuid.uuid1())
+
+
+@pytest.mark.parametrize('action', [REGISTRATION, SELECT_DEBT, ASK_PAID, CONFIRM_PAID, ACCEPT_DEBT])
+@pytest.mark.parametrize('flag', [True, False, None])
+@pytest.mark.parametrize('debt_id', [DEBT_ID, 'legacy-id', None])
+def test_round_trip(action, flag, debt_id):
+    data = encode(action, flag, debt_id)
+
+    assert len(data.encode('utf-8')) <= 64
+    assert decode(data) == (action, flag, debt_id)
+    assert callback_data.pattern(action).match(data)
+
+
+def test_uuid_handle_is_short():
+    assert len(encode(ACCEPT_DEBT, True, DEBT_ID)) == 24
+
+
+@pytest.mark.parametrize('data, expected', [
+    (json.dumps({'action': 'registration', 'data': True}), (REGISTRATION, True, None)),
+    (json.dumps({'p': False, 'id': DEBT_ID}), (CONFIRM_PAID, False, DEBT_ID)),
+    (json.dumps({'paid': True, 'id': DEBT_ID}), (ASK_PAID, True, DEBT_ID)),
+    (json.dumps({'1': True, 'id': DEBT_ID}), (ACCEPT_DEBT, True, DEBT_ID)),
+    (DEBT_ID, (SELECT_DEBT, None, DEBT_ID)),
+])
+def test_legacy_buttons(data, expected):
+    assert decode(data) == expected
+    assert callback_data.pattern(expected[0]).match(data)
+
+
+@pytest.mark.parametrize('data', ['', 'a', 'ax', 'a1!!!', 'a1AAAA', '{', '{"action": "registration"}', None])
+def test_malformed_data_raises_value_error(data):
+    with pytest.raises(ValueError):
+        decode(data)
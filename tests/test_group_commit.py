@@ -0,0 +1,87 @@
+"""
+Tests of the group commit of Database and SqliteDatabase.
+"""
+
+import sqlite3
+import threading
+import time
+
+import pytest
+
+from database import Database, GroupCommitter, SqliteDatabase
+
+
+def test_mutations_are_flushed_in_batches():
+    batches = []
+    committer = GroupCommitter(batches.append, commit_interval=0.05, commit_batch=1000)
+
+    threads = [threading.Thread(target=committer.add, args=(item,)) for item in range(50)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert committer.wait(timeout=5)
+    assert sorted(item for batch in batches for item in batch) == list(range(50))
+    assert len(batches) < 50
+    committer.close()
+
+
+def test_failed_flush_is_retried():
+    batches = []
+    failures = [OSError('disk full')]
+
+    def flush(batch):
+        if failures:
+            raise failures.pop()
+        batches.append(batch)
+
+    committer = GroupCommitter(flush, commit_interval=0.01, commit_batch=10)
+    committer.add('record')
+
+    with pytest.raises(OSError):
+        committer.wait(timeout=5)
+
+    deadline = time.monotonic() + 5
+    while not batches and time.monotonic() < deadline:
+        time.sleep(0.01)
+
+    assert committer.wait(timeout=5)
+    assert batches == [['record']]
+    committer.close()
+
+
+def test_journal_group_commit_is_durable(tmp_path):
+    database = Database(str(tmp_path / 'database.json'), journal=True, commit_interval=0.05)
+    database.init_json()
+    database.add_user('1', 'anna')
+    debt = database.add_debt('1', 'Essen', '5€', '2030:01:01', '1')
+
+    assert database.wait_durable(timeout=5)
+
+    reopened = Database(str(tmp_path / 'database.json'), journal=True)
+    reopened.init_json()
+    assert reopened.get_debt_by_debt_id(debt.debt_id) is not None
+    database.close()
+
+
+def test_sqlite_group_commit_checkpoints_the_whole_wal(tmp_path):
+    path = str(tmp_path / 'database.sqlite3')
+    database = SqliteDatabase(path, commit_interval=0.05)
+    database.init_json()
+    database.add_user('1', 'anna')
+    debt = database.add_debt('1', 'Essen', '5€', '2030:01:01', '1')
+    database.set_paid(debt.debt_id, True)
+    # reader connection of this thread
+    assert database.get_debt_by_debt_id(debt.debt_id).is_paid
+
+    assert database.wait_durable(timeout=5)
+
+    busy, log_frames, checkpointed_frames = sqlite3.connect(path).execute(
+        'PRAGMA wal_checkpoint(PASSIVE)').fetchone()
+    assert busy == 0 and checkpointed_frames == log_frames
+    database.close()
+
+    reopened = SqliteDatabase(path)
+    reopened.init_json()
+    assert reopened.get_debt_by_debt_id(debt.debt_id).is_paid
@@ -0,0 +1,69 @@
+"""
+Tests of the journal mode of Database.
+"""
+
+from database import Database
+
+
+def open_database(tmp_path, **kwargs):
+    database = Database(str(tmp_path / 'database.json'), journal=True, **kwargs)
+    database.init_json()
+    return database
+
+
+def test_replay_restores_mutations(tmp_path):
+    database = open_database(tmp_path, compact_after=1000)
+    database.add_user('1', 'anna')
+    database.add_user('2', 'ben')
+    debt = database.add_debt('1', 'Essen', '5€', '2030:01:01', '2')
+    database.set_accepted(debt.debt_id, True)
+
+    reopened = open_database(tmp_path)
+
+    assert [user.name for user in reopened.users] == ['anna', 'ben']
+    assert reopened.get_open_debts('2')[0].debt_id == debt.debt_id
+
+
+def test_torn_record_survives_two_restarts(tmp_path):
+    database = open_database(tmp_path)
+    database.add_user('1', 'anna')
+    database.compact()
+
+    # crash in the middle of an append
+    with open(database.path_to_journal, 'a') as journal:
+        journal.write('{"op": "add_us')
+
+    first = open_database(tmp_path)
+    assert first.user_exists('1')
+    first.add_user('2', 'ben')
+
+    second = open_database(tmp_path)
+    assert second.user_exists('2')
+    second.add_user('3', 'carl')
+
+    third = open_database(tmp_path)
+    assert [user.chat_id for user in third.users] == ['1', '2', '3']
+
+
+def test_record_without_newline_is_cut_off(tmp_path):
+    database = open_database(tmp_path)
+    database.add_user('1', 'anna')
+
+    with open(database.path_to_journal, 'a') as journal:
+        journal.write('{"op": "add_user", "user": {"chat_id": "2", "name": "ben"}}')
+
+    reopened = open_database(tmp_path)
+    reopened.add_user('3', 'carl')
+
+    assert [user.chat_id for user in open_database(tmp_path).users] == ['1', '3']
+
+
+def test_compaction_empties_journal(tmp_path):
+    database = open_database(tmp_path, compact_after=2)
+    database.add_user('1', 'anna')
+    database.add_user('2', 'ben')
+
+    with open(database.path_to_journal) as journal:
+        assert journal.read() == ''
+
+    assert open_database(tmp_path).user_count() == 2
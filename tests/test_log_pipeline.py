@@ -0,0 +1,80 @@
+"""
+Tests of the log pipeline and its sampling filter.
+"""
+
+import io
+import logging
+import threading
+
+import pytest
+
+from log_pipeline import LogPipeline, SamplingFilter, parse_sampling
+
+
+def record(name, level=logging.DEBUG):
+    return logging.LogRecord(name, level, __file__, 1, 'message', (), None)
+
+
+def test_parse_sampling():
+    assert parse_sampling('telegram=0.1, webhook=0.5,') == {'telegram': 0.1, 'webhook': 0.5}
+    assert parse_sampling('') == {}
+
+
+def test_longest_prefix_decides_the_fraction():
+    sampling_filter = SamplingFilter({'telegram': 0.0, 'telegram.ext': 1.0})
+
+    assert not sampling_filter.filter(record('telegram'))
+    assert not sampling_filter.filter(record('telegram.bot'))
+    assert sampling_filter.filter(record('telegram.ext.dispatcher'))
+    assert sampling_filter.filter(record('telegramx'))
+
+
+def test_warnings_always_pass():
+    sampling_filter = SamplingFilter({'telegram': 0.0}, rate_limit=1)
+
+    assert all(sampling_filter.filter(record('telegram', logging.WARNING)) for _ in range(100))
+
+
+def test_rate_limit_per_logger():
+    sampling_filter = SamplingFilter(rate_limit=5)
+
+    passed = sum(sampling_filter.filter(record('database')) for _ in range(100))
+
+    assert 5 <= passed <= 6
+    assert sampling_filter.filter(record('webhook'))
+
+
+@pytest.fixture
+def root_logger():
+    root = logging.getLogger()
+    handlers, level = list(root.handlers), root.level
+    yield root
+    for handler in list(root.handlers):
+        root.removeHandler(handler)
+    for handler in handlers:
+        root.addHandler(handler)
+    root.setLevel(level)
+
+
+def test_records_are_formatted_on_the_writer_thread(root_logger):
+    stream = io.StringIO()
+    pipeline = LogPipeline(stream=stream)
+    threads = []
+
+    class Argument:
+        def __str__(self):
+            threads.append(threading.current_thread().name)
+            return 'argument'
+
+    pipeline.start()
+    try:
+        raise RuntimeError('boom')
+    except RuntimeError:
+        logging.getLogger('database').error('Failed %s', Argument(), exc_info=True, extra={'debt_id': 'd1'})
+    pipeline.stop()
+
+    line = stream.getvalue()
+    assert 'msg="Failed argument"' in line
+    assert 'debt_id=d1' in line
+    assert 'RuntimeError: boom' in line
+    assert threads and threading.current_thread().name not in threads
@@ -0,0 +1,68 @@
+"""
+Tests of the metrics instrumentation and exposition.
+"""
+
+import pytest
+
+import metrics
+
+
+class Storage:
+
+    def get(self, key):
+        return key
+
+    def set(self, key):
+        return self.get(key)
+
+    def fail(self):
+        raise OSError('disk')
+
+
+def test_nested_calls_are_recorded_once():
+    latency = metrics.Histogram('test_storage_seconds', 'Latency', ['operation'])
+    errors = metrics.Counter('test_storage_errors_total', 'Errors', ['operation'])
+    storage = Storage()
+    metrics.instrument_methods(storage, ['get', 'set', 'fail', 'missing'], latency, errors)
+
+    assert storage.set('a') == 'a'
+    assert latency.labels('set').count == 1
+    assert latency.labels('get').count == 0
+
+    storage.get('b')
+    assert latency.labels('get').count == 1
+
+    with pytest.raises(OSError):
+        storage.fail()
+    assert errors.labels('fail').value == 1
+
+    # the scope is left after an exception
+    storage.get('c')
+    assert latency.labels('get').count == 2
+
+
+def test_methods_are_instrumented_once():
+    latency = metrics.Histogram('test_twice_seconds', 'Latency', ['operation'])
+    storage = Storage()
+    metrics.instrument_methods(storage, ['get'], latency)
+    metrics.instrument_methods(storage, ['get'], latency)
+
+    storage.get('a')
+
+    assert latency.labels('get').count == 1
+
+
+def test_render_prometheus_text():
+    registry = metrics.Registry()
+    histogram = registry.get_or_add(metrics.Histogram('test_seconds', 'Latency', ['handler'], buckets=(0.1, 1)))
+    counter = registry.get_or_add(metrics.Counter('test_total', 'Count'))
+    histogram.labels('start').observe(0.5)
+    counter.inc(2)
+
+    text = registry.render()
+
+    assert 'test_seconds_bucket{handler="start",le="0.1"} 0' in text
+    assert 'test_seconds_bucket{handler="start",le="1"} 1' in text
+    assert 'test_seconds_bucket{handler="start",le="+Inf"} 1' in text
+    assert 'test_seconds_count{handler="start"} 1' in text
+    assert 'test_total 2' in text
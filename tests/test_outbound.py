@@ -0,0 +1,117 @@
+"""
+Tests of the outbound queue with a fake Bot.
+"""
+
+import threading
+import time
+
+import pytest
+
+pytest.importorskip('telegram')
+
+from telegram.error import BadRequest, NetworkError, RetryAfter, Unauthorized  # noqa: E402
+
+from outbound import REMINDER, OutboundQueue, TokenBucket  # noqa: E402
+
+
+class FakeBot:
+
+    def __init__(self, errors=None):
+        # (chat_id, text) -> exceptions raised by the next attempts
+        self.errors = dict(errors or {})
+        self.sent = []
+        self.calls = []
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text):
+        with self._lock:
+            self.calls.append((chat_id, text, time.monotonic()))
+            errors = self.errors.get((chat_id, text))
+            if errors:
+                raise errors.pop(0)
+            self.sent.append((chat_id, text))
+
+
+def test_token_bucket_rate():
+    bucket = TokenBucket(rate=10, capacity=2)
+    now = time.monotonic()
+
+    bucket.take(now)
+    bucket.take(now)
+
+    assert bucket.wait_time(now) == pytest.approx(0.1)
+    assert bucket.wait_time(now + 0.11) == 0
+    assert not bucket.is_full(now + 0.11)
+    assert bucket.is_full(now + 0.21)
+
+
+def test_global_rate_is_kept():
+    bot = FakeBot()
+    outbox = OutboundQueue(bot, global_rate=20, per_chat_burst=5)
+    outbox.start()
+    start = time.monotonic()
+
+    for number in range(30):
+        outbox.send_message(number, text='hi')
+    outbox.stop()
+
+    # a burst of 20, the other 10 at 20 per second
+    assert len(bot.sent) == 30
+    assert bot.calls[-1][2] - start >= 0.45
+
+
+def test_retry_after_pauses_and_resends():
+    bot = FakeBot({(1, 'hi'): [RetryAfter(0.2)]})
+    outbox = OutboundQueue(bot)
+    outbox.start()
+
+    outbox.send_message(1, text='hi')
+    outbox.stop()
+
+    assert bot.sent == [(1, 'hi')]
+    assert len(bot.calls) == 2
+    assert bot.calls[1][2] - bot.calls[0][2] >= 0.2
+
+
+def test_messages_of_a_chat_keep_their_order():
+    bot = FakeBot({(1, '0'): [NetworkError('timeout')]})
+    outbox = OutboundQueue(bot, per_chat_rate=50, per_chat_burst=1)
+    outbox.start()
+
+    for number in range(5):
+        outbox.send_message(1, priority=REMINDER if number % 2 else 0, text=str(number))
+        outbox.send_message(2, text=str(number))
+    outbox.stop()
+
+    assert [text for chat_id, text in bot.sent if chat_id == 1] == ['0', '1', '2', '3', '4']
+    assert [text for chat_id, text in bot.sent if chat_id == 2] == ['0', '1', '2', '3', '4']
+
+
+@pytest.mark.parametrize('final_error', [BadRequest('Chat not found'), Unauthorized('Forbidden: bot was blocked')])
+def test_rejected_message_is_not_retried(final_error):
+    bot = FakeBot({(1, 'hi'): [final_error]})
+    outbox = OutboundQueue(bot)
+    outbox.start()
+    start = time.monotonic()
+
+    outbox.send_message(1, text='hi')
+    outbox.send_message(1, text='next')
+    outbox.stop()
+
+    assert [text for _, text, _ in bot.calls] == ['hi', 'next']
+    assert bot.sent == [(1, 'next')]
+    # the next message of the chat isn't held back by a retry backoff
+    assert bot.calls[-1][2] - start < 0.5
+
+
+def test_stop_discards_messages_after_timeout():
+    bot = FakeBot({(1, 'hi'): [NetworkError('timeout')]})
+    outbox = OutboundQueue(bot)
+    outbox.start()
+
+    outbox.send_message(1, text='hi')
+    # the retry would be in 1 second
+    outbox.stop(timeout=0.2)
+
+    assert bot.sent == []
+    assert len(outbox) == 1
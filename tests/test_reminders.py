@@ -0,0 +1,81 @@
+"""
+Tests of the reminder scheduler and its escalation policy.
+"""
+
+import datetime
+import time
+
+import pytest
+
+from reminders import ReminderPolicy, ReminderScheduler
+
+DAY = datetime.date(2030, 1, 1).toordinal()
+
+
+def at(day, hour, minute=0):
+    return datetime.datetime.combine(datetime.date.fromordinal(day), datetime.time(hour, minute)).timestamp()
+
+
+@pytest.mark.parametrize('arguments', [{'far_interval_days': 0}, {'near_interval_days': 0},
+                                       {'overdue_interval_days': -1}, {'near_days': -1}])
+def test_policy_rejects_invalid_intervals(arguments):
+    with pytest.raises(ValueError):
+        ReminderPolicy(**arguments)
+
+
+def test_policy_escalates_towards_the_deadline():
+    policy = ReminderPolicy(far_interval_days=7, near_days=3, near_interval_days=1, overdue_interval_days=2)
+    deadline = DAY + 20
+
+    assert policy.stage(DAY, deadline) == ReminderPolicy.UPCOMING
+    assert policy.next_day(DAY, deadline) == DAY + 6
+    # the first day of the near window is not skipped
+    assert policy.next_day(DAY + 14, deadline) == deadline - 3
+    assert policy.stage(deadline - 3, deadline) == ReminderPolicy.DUE_SOON
+    assert policy.next_day(deadline - 3, deadline) == deadline - 3
+    assert policy.stage(deadline + 1, deadline) == ReminderPolicy.OVERDUE
+    assert policy.next_day(deadline + 1, deadline) == deadline + 2
+    assert policy.next_day(DAY, None) == DAY
+
+
+def test_scheduler_sends_due_reminders_at_the_policy_days():
+    sent = []
+    scheduler = ReminderScheduler(sent.append, policy=ReminderPolicy(far_interval_days=7, near_days=3))
+    scheduler.schedule('debt', fire_at=at(DAY, 10), deadline=DAY + 20)
+
+    assert scheduler.tick(now=at(DAY, 9)) == 0
+    assert scheduler.tick(now=at(DAY, 10)) == 1
+    assert sent == ['debt']
+    assert scheduler.tick(now=at(DAY + 6, 9)) == 0
+    assert scheduler.tick(now=at(DAY + 7, 10)) == 1
+
+    assert scheduler.cancel('debt')
+    assert scheduler.tick(now=at(DAY + 30, 10)) == 0
+
+
+def test_missed_reminders_wait_for_the_send_window(tmp_path, monkeypatch):
+    path = str(tmp_path / 'reminders.json')
+    scheduler = ReminderScheduler(None, path_to_state=path)
+    scheduler.schedule('missed', fire_at=at(DAY, 10))
+    scheduler.schedule('later', fire_at=at(DAY + 5, 10))
+    scheduler.save()
+
+    # restart at night
+    monkeypatch.setattr(time, 'time', lambda: at(DAY + 2, 3))
+    reopened = ReminderScheduler(None, path_to_state=path)
+
+    assert reopened.pop_due(now=at(DAY + 2, 3)) == []
+    assert reopened.pop_due(now=at(DAY + 2, 10)) == ['missed']
+    assert sorted(reopened.pop_due(now=at(DAY + 5, 10))) == ['later', 'missed']
+
+
+def test_missed_reminders_are_sent_during_the_send_window(tmp_path, monkeypatch):
+    path = str(tmp_path / 'reminders.json')
+    scheduler = ReminderScheduler(None, path_to_state=path)
+    scheduler.schedule('missed', fire_at=at(DAY, 10))
+    scheduler.save()
+
+    monkeypatch.setattr(time, 'time', lambda: at(DAY + 2, 15))
+    reopened = ReminderScheduler(None, path_to_state=path)
+
+    assert reopened.pop_due(now=at(DAY + 2, 15)) == ['missed']
@@ -0,0 +1,106 @@
+"""
+Tests of shard routing and the delivery of records between shards.
+"""
+
+import threading
+
+import pytest
+
+pytest.importorskip('telegram')
+
+from database import Database  # noqa: E402
+from sharding import ShardChannel, ShardRouter, shard_of, update_chat_id  # noqa: E402
+
+AUTHKEY = b'test'
+
+# shard_of(chat_id, 2): '1' -> 1, '4' -> 0
+CHAT_OF_SHARD = {0: '4', 1: '1'}
+
+
+def open_shard(tmp_path, shard):
+    database = Database(str(tmp_path / f'database.shard{shard}.json'), journal=True)
+    database.init_json()
+    channel = ShardChannel(shard, 2, database, AUTHKEY, str(tmp_path), str(tmp_path))
+    database.on_record = channel.publish
+    return database, channel
+
+
+def test_shard_of_is_stable_and_in_range():
+    assert all(0 <= shard_of(str(chat_id), 4) < 4 for chat_id in range(1000))
+    assert shard_of('4', 2) == 0 and shard_of('1', 2) == 1
+    assert len({shard_of(str(chat_id), 4) for chat_id in range(1000)}) == 4
+
+
+def test_update_chat_id():
+    assert update_chat_id({'message': {'chat': {'id': 7}}}) == '7'
+    assert update_chat_id({'callback_query': {'from': {'id': 8}}}) == '8'
+    assert update_chat_id({'callback_query': {'from': {'id': 8}, 'message': {'chat': {'id': 9}}}}) == '9'
+    assert update_chat_id({'poll': {}}) is None
+
+
+def test_debt_is_copied_to_the_shard_of_the_debtor(tmp_path):
+    database_0, channel_0 = open_shard(tmp_path, 0)
+    database_1, channel_1 = open_shard(tmp_path, 1)
+    applied = threading.Event()
+
+    def handle_record(record):
+        database_1.apply_record(record)
+        applied.set()
+
+    channel_1.serve(None, handle_record)
+
+    debt = database_0.add_debt(CHAT_OF_SHARD[0], 'Essen', '5€', '2030:01:01', CHAT_OF_SHARD[1])
+
+    assert applied.wait(5)
+    assert database_1.get_debt_by_debt_id(debt.debt_id).creditor == CHAT_OF_SHARD[0]
+
+    channel_0.close()
+    channel_1.close()
+
+
+def test_debt_between_users_of_one_shard_stays_local(tmp_path):
+    database_0, channel_0 = open_shard(tmp_path, 0)
+
+    database_0.add_debt(CHAT_OF_SHARD[0], 'Essen', '5€', '2030:01:01', CHAT_OF_SHARD[0])
+
+    assert (tmp_path / 'shard-0-to-1.outbox').read_text() == ''
+    channel_0.close(timeout=0.1)
+
+
+def test_records_survive_a_restart_of_both_shards(tmp_path):
+    database_0, channel_0 = open_shard(tmp_path, 0)
+    database_0.add_user(CHAT_OF_SHARD[0], 'anna')
+    debt = database_0.add_debt(CHAT_OF_SHARD[0], 'Essen', '5€', '2030:01:01', CHAT_OF_SHARD[1])
+
+    # shard 1 is down, the records stay in the outbox
+    channel_0.close(timeout=0.2)
+
+    database_0, channel_0 = open_shard(tmp_path, 0)
+    database_1, channel_1 = open_shard(tmp_path, 1)
+    channel_1.serve(None, database_1.apply_record)
+
+    assert channel_0._links[1].wait_acked(timeout=5)
+    assert database_1.user_exists(CHAT_OF_SHARD[0])
+    assert database_1.get_debt_by_debt_id(debt.debt_id) is not None
+    assert (tmp_path / 'shard-0-to-1.outbox').read_text() == ''
+
+    channel_0.close()
+    channel_1.close()
+
+
+def test_router_flush_waits_for_the_shards(tmp_path):
+    router = ShardRouter(2, AUTHKEY, str(tmp_path))
+    update = {'update_id': 1, 'message': {'chat': {'id': int(CHAT_OF_SHARD[1])}}}
+
+    router.route(update)
+    assert not router.flush(timeout=0.2)
+
+    _, channel_1 = open_shard(tmp_path, 1)
+    received = []
+    channel_1.serve(received.append, None)
+
+    assert router.flush(timeout=5)
+    assert received == [update]
+
+    router.close()
+    channel_1.close()
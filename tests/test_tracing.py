@@ -0,0 +1,96 @@
+"""
+Tests of the sampled tracing and its trace file.
+"""
+
+import json
+import threading
+
+import tracing
+from tracing import Tracer
+
+
+class Storage:
+
+    def add_debt(self):
+        with tracing.span('inner', 'test'):
+            return 'debt'
+
+
+def read_events(path):
+    # the writer leaves the array open, as the JSON array format allows
+    text = path.read_text().rstrip().rstrip(',')
+    return json.loads(text + '\n]')
+
+
+def test_unsampled_update_has_no_trace(tmp_path):
+    tracer = Tracer(str(tmp_path / 'trace.json'), sample_rate=0.0)
+    tracer.start()
+
+    with tracer.trace('update') as trace:
+        assert trace is None
+        assert tracing.current() is None
+        with tracing.span('add_debt', 'storage'):
+            pass
+    tracer.stop()
+
+    assert read_events(tmp_path / 'trace.json') == []
+
+
+def test_spans_of_a_sampled_update(tmp_path):
+    tracer = Tracer(str(tmp_path / 'trace.json'), sample_rate=1.0)
+    storage = Storage()
+    tracing.instrument_methods(storage, ['add_debt', 'missing'], 'storage')
+    tracer.start()
+
+    with tracer.trace('update', kind='/schuld') as trace:
+        assert tracing.current() is trace
+        assert storage.add_debt() == 'debt'
+    tracer.stop()
+
+    assert tracing.current() is None
+    events = {event['name']: event for event in read_events(tmp_path / 'trace.json')}
+    assert set(events) == {'update', 'add_debt', 'inner'}
+    assert {event['args']['trace_id'] for event in events.values()} == {trace.trace_id}
+    assert events['update']['args']['parent_id'] is None
+    assert events['update']['args']['kind'] == '/schuld'
+    assert events['update']['args']['span_id'] == trace.root_id
+    assert events['add_debt']['args']['parent_id'] == trace.root_id
+    assert events['add_debt']['cat'] == 'storage'
+    assert events['inner']['args']['parent_id'] == events['add_debt']['args']['span_id']
+    assert all(event['ph'] == 'X' and event['dur'] >= 0 for event in events.values())
+
+
+def test_activated_trace_in_another_thread(tmp_path):
+    tracer = Tracer(str(tmp_path / 'trace.json'), sample_rate=1.0)
+    tracer.start()
+    seen = []
+
+    def send(trace):
+        with tracing.activate(trace):
+            seen.append(tracing.current())
+            with tracing.span('sendMessage', 'bot_api'):
+                pass
+        seen.append(tracing.current())
+
+    with tracer.trace('update') as trace:
+        sender = threading.Thread(target=send, args=(tracing.current(),))
+        sender.start()
+        sender.join()
+    tracer.stop()
+
+    assert seen == [trace, None]
+    events = {event['name']: event for event in read_events(tmp_path / 'trace.json')}
+    assert events['sendMessage']['args']['trace_id'] == trace.trace_id
+    assert events['sendMessage']['args']['parent_id'] == trace.root_id
+    assert events['sendMessage']['tid'] != events['update']['tid']
+
+
+def test_trace_file_is_appended(tmp_path):
+    for _ in range(2):
+        tracer = Tracer(str(tmp_path / 'trace.json'), sample_rate=1.0)
+        tracer.start()
+        with tracer.trace('update'):
+            pass
+        tracer.stop()
+
+    assert [event['name'] for event in read_events(tmp_path / 'trace.json')] == ['update', 'update']
@@ -0,0 +1,60 @@
+"""
+Tests of the cached user selection keyboards.
+"""
+
+import pytest
+
+pytest.importorskip('telegram')
+
+from database import Database  # noqa: E402
+from user_keyboard import USER_PREFIX, UserKeyboards  # noqa: E402
+
+
+@pytest.fixture
+def database(tmp_path):
+    database = Database(str(tmp_path / 'database.json'))
+    database.init_json()
+    for number in range(5):
+        database.add_user(str(number), f'user{number}')
+    return database
+
+
+def names(markup):
+    return [row[0].text[len(USER_PREFIX):] for row in markup.keyboard if row[0].text.startswith(USER_PREFIX)]
+
+
+def navigation(markup):
+    return [button.text for button in markup.keyboard[-1]]
+
+
+def test_pages_leave_out_the_user(database):
+    keyboards = UserKeyboards(database, page_size=2)
+
+    assert names(keyboards.keyboard('1', 0)) == ['user0', 'user2']
+    assert names(keyboards.keyboard('1', 1)) == ['user3', 'user4']
+    assert navigation(keyboards.keyboard('1', 1)) == ['⬅ Seite 1']
+    # pages beyond the last show the last one
+    assert names(keyboards.keyboard('1', 5)) == ['user3', 'user4']
+
+
+def test_registration_keeps_the_first_pages(database):
+    keyboards = UserKeyboards(database, page_size=2)
+    first_page = keyboards.keyboard('9', 0)
+    keyboards.keyboard('1', 1)
+
+    database.add_user('5', 'user5')
+
+    assert keyboards.keyboard('9', 0) is first_page
+    assert names(keyboards.keyboard('1', 1)) == ['user3', 'user4']
+    assert navigation(keyboards.keyboard('1', 1)) == ['⬅ Seite 1', '➡ Seite 3']
+    assert names(keyboards.keyboard('1', 2)) == ['user5']
+
+
+def test_search(database):
+    keyboards = UserKeyboards(database)
+    database.add_user('5', 'Anna Schmidt')
+
+    assert keyboards.search('SCHM') == ['Anna Schmidt']
+    assert keyboards.search('user', chat_id='0', limit=2) == ['user1', 'user2']
+    assert keyboards.search('r3') == ['user3']
+    assert keyboards.search('xyz') == []
@@ -0,0 +1,102 @@
+"""
+Tests of the webhook server with a stub dispatcher.
+"""
+
+import http.client
+import json
+import queue
+import threading
+
+import pytest
+
+pytest.importorskip('telegram')
+
+from telegram import Bot  # noqa: E402
+
+from webhook import SECRET_TOKEN_HEADER, WebhookServer, post_update  # noqa: E402
+
+SECRET = 'secret'
+
+USER = {'id': 1001, 'is_bot': False, 'first_name': 'Anna', 'username': 'anna'}
+MESSAGE = {'message_id': 5, 'date': 1714557600, 'from': USER,
+           'chat': {'id': 1001, 'type': 'private', 'first_name': 'Anna'}, 'text': '/start'}
+
+
+class StubDispatcher:
+
+    def __init__(self):
+        self.update_queue = queue.Queue()
+        self.bot = Bot('123:TEST')
+
+
+@pytest.fixture
+def server():
+    webhook_server = WebhookServer(StubDispatcher(), SECRET, listen='127.0.0.1', port=0, max_body_size=1000)
+    thread = threading.Thread(target=webhook_server.serve_forever, daemon=True)
+    thread.start()
+    yield webhook_server
+    webhook_server.shutdown()
+    webhook_server.server_close()
+
+
+def url(webhook_server):
+    return f'http://127.0.0.1:{webhook_server.server_address[1]}/webhook'
+
+
+def post_raw(webhook_server, headers, body=b''):
+    connection = http.client.HTTPConnection('127.0.0.1', webhook_server.server_address[1], timeout=5)
+    connection.putrequest('POST', '/webhook')
+    for name, value in dict({SECRET_TOKEN_HEADER: SECRET}, **headers).items():
+        connection.putheader(name, value)
+    connection.endheaders(body)
+    status = connection.getresponse().status
+    connection.close()
+    return status
+
+
+def test_update_is_queued(server):
+    assert post_update(url(server), {'update_id': 1, 'message': MESSAGE}, SECRET) == (200, None)
+
+    update = server.dispatcher.update_queue.get_nowait()
+    assert update.update_id == 1
+    assert update.effective_message.text == '/start'
+
+
+def test_wrong_secret_token_is_rejected(server):
+    assert post_update(url(server), {'update_id': 1, 'message': MESSAGE}, 'wrong') == (403, None)
+    assert post_update(url(server), {'update_id': 1, 'message': MESSAGE}, '') == (403, None)
+    assert server.dispatcher.update_queue.empty()
+
+
+def test_callback_query_is_answered_in_the_response(server):
+    callback_query = {'id': '77', 'from': USER, 'message': MESSAGE, 'chat_instance': '-1', 'data': 'a1'}
+    status, reply = post_update(url(server), {'update_id': 2, 'callback_query': callback_query}, SECRET)
+
+    assert status == 200
+    assert reply == {'method': 'answerCallbackQuery', 'callback_query_id': '77'}
+    assert server.dispatcher.update_queue.get_nowait().callback_query.data == 'a1'
+
+
+def test_invalid_update_is_dropped(server):
+    # valid JSON, but no Update: answered, so Telegram doesn't send it again
+    assert post_update(url(server), {'update_id': 3, 'message': {'text': 'hi'}}, SECRET) == (200, None)
+    assert server.dispatcher.update_queue.empty()
+
+    # the server keeps serving
+    assert post_update(url(server), {'update_id': 4, 'message': MESSAGE}, SECRET) == (200, None)
+
+
+@pytest.mark.parametrize('headers, status', [
+    ({}, 411),
+    ({'Content-Length': 'abc'}, 400),
+    ({'Content-Length': '-1'}, 400),
+    ({'Content-Length': '5000'}, 413),
+])
+def test_invalid_content_length_is_rejected(server, headers, status):
+    assert post_raw(server, headers) == status
+    assert server.dispatcher.update_queue.empty()
+
+
+def test_body_that_is_not_an_update_is_rejected(server):
+    body = json.dumps([1, 2]).encode('utf-8')
+    assert post_raw(server, {'Content-Length': str(len(body))}, body) == 400